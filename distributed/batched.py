@@ -0,0 +1,160 @@
+""" Batched sending of many small messages over a single stream
+
+Workers and the scheduler exchange a great many small messages, like
+``compute-task`` and ``task-finished``.  Writing each of these on its own
+costs a system call and a wake-up on the other end.  ``BatchedSend``
+coalesces messages sent within a short interval and writes them as a single
+list, which the receiving end reads with ``core.read`` like any other
+message.
+"""
+from __future__ import print_function, division, absolute_import
+
+import logging
+from time import time
+
+from tornado import gen, locks
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+from .core import write
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedSend(object):
+    """ Batch messages in batches on a stream
+
+    This takes an IOStream and an interval (in ms) and ensures that we send no
+    more than one message every interval milliseconds.  We send lists of
+    messages.
+
+    The first message after a quiet period goes out immediately.  Further
+    messages sent within ``interval`` of the last write wait and travel
+    together in the next batch.
+
+    Example
+    -------
+    >>> stream = yield connect(ip, port)  # doctest: +SKIP
+    >>> bstream = BatchedSend(interval=10)  # 10 ms
+    >>> bstream.start(stream)
+    >>> bstream.send('Hello,')  # doctest: +SKIP
+    >>> bstream.send('world!')  # doctest: +SKIP
+
+    On the other side, the recipient will get a message like the following::
+
+        ['Hello,', 'world!']
+
+    Messages sent before ``start`` are buffered until we have a stream.
+
+    While the other end reads slowly, messages pile up in the buffer.  With a
+    ``limit`` we call ourselves ``full`` once that many messages wait and
+    set the ``room`` event once they have gone out again, so that producers
+    can wait for the other end to catch up::
+
+        if bstream.full:
+            yield bstream.room.wait()
+    """
+    def __init__(self, interval, loop=None, limit=None):
+        self.loop = loop or IOLoop.current()
+        self.interval = interval / 1000.
+        self.limit = limit
+        self.waker = locks.Event()
+        self.stopped = locks.Event()
+        self.room = locks.Event()
+        self.room.set()
+        self.please_stop = False
+        self.buffer = []
+        self.stream = None
+        self.last_transmission = 0
+        self.message_count = 0
+        self.batch_count = 0
+
+    def start(self, stream):
+        self.stream = stream
+        # We do our own batching, don't let Nagle's algorithm add latency
+        stream.set_nodelay(True)
+        self.loop.add_callback(self._background_send)
+
+    def __str__(self):
+        return '<BatchedSend: %d in buffer>' % len(self.buffer)
+
+    __repr__ = __str__
+
+    @gen.coroutine
+    def _background_send(self):
+        try:
+            while not self.please_stop:
+                yield self.waker.wait()
+                self.waker.clear()
+                if not self.buffer:
+                    continue
+                delay = self.last_transmission + self.interval - time()
+                if delay > 0:
+                    yield gen.sleep(delay)
+                yield self._flush()
+        except StreamClosedError:
+            logger.info("Batched stream closed, dropping %d messages",
+                        len(self.buffer))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.stopped.set()
+            self.room.set()  # nobody should wait for a stream that is gone
+
+    @gen.coroutine
+    def _flush(self):
+        payload, self.buffer = self.buffer, []
+        self.last_transmission = time()
+        self.batch_count += 1
+        self.message_count += len(payload)
+        try:
+            yield write(self.stream, payload)
+        except StreamClosedError:
+            raise
+        except Exception:
+            # One bad message shouldn't take down the rest of the batch.
+            # Serialization fails before we write anything, so we can retry
+            # each message on its own and drop only those that fail.
+            for msg in payload:
+                try:
+                    yield write(self.stream, [msg])
+                except StreamClosedError:
+                    raise
+                except Exception:
+                    logger.warn("Could not send message, dropping: %s",
+                                str(msg)[:1000], exc_info=True)
+        if not self.full:
+            self.room.set()
+
+    def send(self, msg):
+        """ Schedule a message for sending to the other side
+
+        This completes quickly and synchronously
+        """
+        self.buffer.append(msg)
+        self.waker.set()
+        if self.full:
+            self.room.clear()
+
+    @property
+    def full(self):
+        """ Whether ``limit`` messages or more wait in the buffer """
+        return self.limit is not None and len(self.buffer) >= self.limit
+
+    @gen.coroutine
+    def close(self, close_stream=True):
+        """ Flush any remaining messages and stop sending """
+        self.please_stop = True
+        self.waker.set()
+        if self.stream is None:
+            return
+        yield self.stopped.wait()
+        if not self.stream.closed():
+            try:
+                if self.buffer:
+                    yield self._flush()
+            except StreamClosedError:
+                pass
+            if close_stream:
+                self.stream.close()
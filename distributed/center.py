@@ -4,7 +4,6 @@ from collections import defaultdict
 import logging
 from functools import partial
 import socket
-from toolz import first
 
 from tornado import gen
 from tornado.gen import Return
@@ -39,6 +38,10 @@ class Center(Server):
     *   ``worker_services:: {worker: {str: port}}``:
         Ports of other running services on each worker.
         E.g. ``{('192.168.1.100', 8000): {'http': 9001, 'nanny': 9002}}``
+    *   ``memory_limit:: {worker: int}``:
+        Bytes of memory that each worker may hold, None for no limit
+    *   ``resources:: {worker: {str: float}}``:
+        Amounts of abstract resources like ``{'GPU': 2}`` on each worker
 
     Workers and clients check in with the Center to discover available resources
 
@@ -88,35 +91,36 @@ class Center(Server):
         self.has_what = defaultdict(set)
         self.ncores = dict()
         self.worker_services = defaultdict(dict)
+        self.memory_limit = dict()
+        self.resources = dict()
         self.status = None
 
         d = {func.__name__: func
              for func in [self.add_keys, self.remove_keys, self.get_who_has,
                           self.get_has_what, self.register, self.get_ncores,
                           self.unregister, self.delete_data, self.terminate,
-                          self.get_worker_services, self.broadcast]}
+                          self.get_worker_services, self.get_memory_limit,
+                          self.get_resources, self.broadcast]}
         d = {k[len('get_'):] if k.startswith('get_') else k: v for k, v in
                 d.items()}
         d['ping'] = pingpong
 
         super(Center, self).__init__(d, **kwargs)
 
-    @property
-    def port(self):
-        return first(self._sockets.values()).getsockname()[1]
-
     @gen.coroutine
     def terminate(self, stream=None):
         self.stop()
         return b'OK'
 
     def register(self, stream, address=None, keys=(), ncores=None,
-                 services=None):
+                 services=None, memory_limit=None, resources=None):
         self.has_what[address] = set(keys)
         for key in keys:
             self.who_has[key].add(address)
         self.ncores[address] = ncores
         self.worker_services[address] = services
+        self.memory_limit[address] = memory_limit
+        self.resources[address] = resources or {}
         logger.info("Register %s", str(address))
         return b'OK'
 
@@ -128,6 +132,10 @@ class Center(Server):
             del self.ncores[address]
         with ignoring(KeyError):
             del self.worker_services[address]
+        with ignoring(KeyError):
+            del self.memory_limit[address]
+        with ignoring(KeyError):
+            del self.resources[address]
         for key in keys:
             s = self.who_has[key]
             s.remove(address)
@@ -174,6 +182,18 @@ class Center(Server):
         else:
             return self.worker_services
 
+    def get_memory_limit(self, stream, addresses=None):
+        if addresses is not None:
+            return {k: self.memory_limit.get(k, None) for k in addresses}
+        else:
+            return self.memory_limit
+
+    def get_resources(self, stream, addresses=None):
+        if addresses is not None:
+            return {k: self.resources.get(k, None) for k in addresses}
+        else:
+            return self.resources
+
     @gen.coroutine
     def delete_data(self, stream, keys=None):
         who_has2 = {k: v for k, v in self.who_has.items() if k in keys}
@@ -13,6 +13,20 @@ from tornado import gen
 
 logger = logging.getLogger('distributed.dworker')
 
+
+def parse_resources(text):
+    """ Parse resources from the command line
+
+    >>> parse_resources('MEM=64e9,SLOT=2')
+    {'MEM': 64000000000.0, 'SLOT': 2.0}
+    """
+    resources = dict()
+    for item in filter(None, text.split(',')):
+        name, amount = item.split('=')
+        resources[name.strip()] = float(amount)
+    return resources
+
+
 ip = get_ip()
 
 
@@ -27,7 +41,13 @@ ip = get_ip()
 @click.option('--nprocs', type=int, default=1,
               help="Number of worker processes.  Defaults to one.")
 @click.option('--no-nanny', is_flag=True)
-def main(center, host, port, nthreads, nprocs, no_nanny):
+@click.option('--memory-limit', type=int, default=None,
+              help="Bytes of data per process that the scheduler lets it hold")
+@click.option('--resources', type=str, default='',
+              help="Abstract resources per process for tasks that ask for "
+                   "them, like MEM=64e9,SLOT=2")
+def main(center, host, port, nthreads, nprocs, no_nanny, memory_limit,
+         resources):
     try:
         center_ip, center_port = center.split(':')
         center_port = int(center_port)
@@ -44,12 +64,19 @@ def main(center, host, port, nthreads, nprocs, no_nanny):
     if nprocs > 1 and port != 0:
         raise ValueError("Can not specify a port when using multiple processes")
 
+    try:
+        resources = parse_resources(resources)
+    except ValueError:
+        raise click.BadParameter("Use NAME=AMOUNT,NAME=AMOUNT, got %r"
+                                 % resources, param_hint='--resources')
+
     services = {'http': HTTPWorker}
 
     loop = IOLoop.current()
     t = Worker if no_nanny else Nanny
     nannies = [t(center_ip, center_port, ncores=nthreads, ip=host,
-                 services=services, loop=loop)
+                 services=services, loop=loop, memory_limit=memory_limit,
+                 resources=resources)
                 for i in range(nprocs)]
 
     for nanny in nannies:
@@ -76,13 +76,15 @@ _gather.__doc__ = gather.__doc__
 
 
 @gen.coroutine
-def gather_from_workers(who_has):
+def gather_from_workers(who_has, rpc=rpc):
     """ Gather data directly from peers
 
     Parameters
     ----------
     who_has: dict
         Dict mapping keys to sets of workers that may have that key
+    rpc: callable
+        Function to create rpc objects from ``ip=`` and ``port=`` keywords
 
     Returns dict mapping key to value
 
@@ -111,7 +113,7 @@ def gather_from_workers(who_has):
         if bad_keys:
             raise KeyError(*bad_keys)
 
-        coroutines = [rpc(ip=ip, port=port).get_data(keys=keys, close=True)
+        coroutines = [rpc(ip=ip, port=port).get_data(keys=keys)
                             for (ip, port), keys in d.items()]
         response = yield ignore_exceptions(coroutines, socket.error,
                                                        StreamClosedError)
@@ -181,7 +183,7 @@ _round_robin_counter = [0]
 
 
 @gen.coroutine
-def scatter_to_workers(ncores, data, report=True):
+def scatter_to_workers(ncores, data, report=True, rpc=rpc):
     """ Scatter data directly to workers
 
     This distributes data in a round-robin fashion to a set of workers based on
@@ -215,7 +217,7 @@ def scatter_to_workers(ncores, data, report=True):
           for k, v in d.items()}
 
     out = yield All([rpc(ip=w_ip, port=w_port).update_data(data=v,
-                                             close=True, report=report)
+                                                           report=report)
                  for (w_ip, w_port), v in d.items()])
     nbytes = merge([o[1]['nbytes'] for o in out])
 
@@ -8,6 +8,7 @@ if sys.version_info[0] == 2:
     from thread import get_ident as get_thread_identity
     reload = reload
     unicode = unicode
+    long = long
 
     import gzip
     def gzip_decompress(b):
@@ -27,6 +28,7 @@ if sys.version_info[0] == 3:
     from importlib import reload
     from threading import get_ident as get_thread_identity
     unicode = str
+    long = int
     from gzip import decompress as gzip_decompress
 
     def isqueue(o):
@@ -1,40 +1,38 @@
 from __future__ import print_function, division, absolute_import
 
+from collections import defaultdict, OrderedDict
 from datetime import timedelta
+from functools import partial
 from hashlib import md5
+import itertools
 import logging
+import os
 import signal
 import socket
 import struct
 from time import sleep, time
 import uuid
+import weakref
 
 from toolz import assoc, first
 import tornado
-import pickle
-import cloudpickle
 from tornado import ioloop, gen
 from tornado.gen import Return
+from tornado.concurrent import Future
 from tornado.tcpserver import TCPServer
 from tornado.tcpclient import TCPClient
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream, StreamClosedError
+from tornado.locks import Condition, Lock, Semaphore
 
-
-def dumps(x):
-    try:
-        return cloudpickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
-    except Exception as e:
-        logger.info("Failed to serialize %s", x, exc_info=True)
-        raise
-
-
-def loads(x):
-    try:
-        return cloudpickle.loads(x)
-    except Exception as e:
-        logger.info("Failed to deserialize %s", x, exc_info=True)
-        raise
+from .loop_monitor import LoopMonitor
+from .metrics import Metrics
+from .protocol import (dumps, loads, dumps_msg, loads_msg, compressions,
+        choose_compression)
+from .transport import (TRANSPORTS, DEFAULT_TRANSPORTS, InProcStream,
+        inproc_servers, choose_transport, listen_unix, connect_unix,
+        connect_inproc)
+from .utils import get_traceback, truncate_exception, ignoring
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +49,30 @@ def get_total_physical_memory():
 MAX_BUFFER_SIZE = get_total_physical_memory()
 
 
+def get_fd_limit():
+    try:
+        import resource
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError):
+        return 1024
+
+
+# Default limits on open streams in a ConnectionPool, in total and per peer
+POOL_LIMIT = max(256, get_fd_limit() // 2)
+POOL_LIMIT_PER_PEER = 256
+
+# Wire protocols that we know how to speak, in order of preference.
+# Streams default to the legacy sentinel-delimited protocol until both ends
+# agree on something better during the handshake.  See ``connect``.
+PROTOCOLS = ('frames',)
+
+# Messages with fewer bytes than this are read and written in one piece
+SMALL_MESSAGE = 2**16
+
+# Out-of-band buffers are handed to Tornado in chunks of this many bytes
+WRITE_CHUNK = 2**17
+
+
 def handle_signal(sig, frame):
     IOLoop.instance().add_callback(IOLoop.instance().stop)
 
@@ -88,9 +110,79 @@ class Server(TCPServer):
 
     *  ``{'op': 'ping'}``
     *  ``{'op': 'add': 'x': 10, 'y': 20}``
+
+    **Wire Protocol**
+
+    A client may open a connection with a ``{'op': 'handshake'}`` message
+    listing the wire protocols it speaks.  The server replies with its
+    preferred common protocol (or ``None``) and both ends switch to it for the
+    remainder of the connection.  Connections that never handshake use the
+    original sentinel-delimited protocol so that older peers keep working.
+
+    Both ends also tell each other which compressions they can decompress.
+    The server compresses large frames that it sends with ``compression``,
+    either the name of a compression like ``'lz4'`` or ``'zlib'``, ``'auto'``
+    to use the best one available on both ends, or None to never compress.
+
+    **Multiplexing**
+
+    Normally the server handles the messages on a connection one after the
+    other.  A message that carries a request id under the ``'rid'`` key is
+    instead handled concurrently with everything else on the connection.
+    The server replies with ``{'rid': rid, 'status': 'OK', 'result': ...}``,
+    or with ``'status': 'error'`` and the exception if the handler fails, as
+    soon as the handler finishes, so replies may arrive out of order.  Tagged
+    requests must not read from or write to the stream themselves.  See
+    ``Multiplexer``.
+
+    **Metrics**
+
+    We keep histograms of message sizes and of the time that we spend
+    deserializing, handling and replying to each operation in ``metrics``,
+    see ``distributed.metrics.Metrics``.  The ``'metrics'`` operation returns
+    their summaries.
+
+    With a ``loop_interval`` given, a ``LoopMonitor`` in ``loop_monitor``
+    measures every ``loop_interval`` milliseconds once we listen how late the
+    event loop runs and takes the stack of the event loop thread when it
+    stalls for longer than ``stall_threshold`` seconds.  The
+    ``'loop_monitor'`` operation returns its lag histogram and recent stalls.
+    The monitor costs a periodic callback and a thread, so it is off by
+    default.  The Scheduler turns it on.
+
+    At most ``concurrency`` tagged requests run at once on each connection,
+    further requests wait for a free slot.  We count the requests that had to
+    wait in ``queued_handlers`` and the seconds that they waited in total and
+    at most in ``queue_time`` and ``max_queue_time``.
+
+    **Transports**
+
+    Servers always listen on TCP.  With ``'unix'`` in ``transports`` they also
+    listen on a Unix domain socket and with ``'inproc'`` they accept
+    in-process streams that skip serialization.  ``connect`` uses these for
+    clients on the same host or in the same process, see ``transport``.
     """
-    def __init__(self, handlers, max_buffer_size=MAX_BUFFER_SIZE, **kwargs):
+    def __init__(self, handlers, max_buffer_size=MAX_BUFFER_SIZE,
+                 protocols=PROTOCOLS, compression='auto', concurrency=100,
+                 transports=DEFAULT_TRANSPORTS, loop_interval=None,
+                 stall_threshold=0.25, **kwargs):
         self.handlers = assoc(handlers, 'identity', self.identity)
+        self.handlers.setdefault('metrics', self.get_metrics)
+        self.handlers.setdefault('loop_monitor', self.get_loop_monitor)
+        self.metrics = Metrics()
+        if loop_interval:
+            self.loop_monitor = LoopMonitor(loop_interval, stall_threshold)
+        else:
+            self.loop_monitor = None
+        self.protocols = protocols
+        self.transports = transports
+        self._unix_path = None
+        self.concurrency = concurrency
+        self.queued_handlers = 0
+        self.queue_time = 0
+        self.max_queue_time = 0
+        choose_compression(compression, ())  # validate
+        self.compression = compression
         self.id = uuid.uuid1()
         self._port = None
         super(Server, self).__init__(max_buffer_size=max_buffer_size, **kwargs)
@@ -99,7 +191,10 @@ class Server(TCPServer):
     def port(self):
         if not self._port:
             try:
-                self._port = first(self._sockets.values()).getsockname()[1]
+                self._port = first(sock.getsockname()[1]
+                                   for sock in self._sockets.values()
+                                   if sock.family != getattr(socket,
+                                                             'AF_UNIX', None))
             except StopIteration:
                 raise OSError("Server has no port.  Please call .listen first")
         return self._port
@@ -107,6 +202,27 @@ class Server(TCPServer):
     def identity(self, stream):
         return {'type': type(self).__name__, 'id': self.id}
 
+    def get_metrics(self, stream=None):
+        """ Summaries of our metrics, both as server and as client
+
+        See Also
+        --------
+        distributed.metrics.Metrics
+        """
+        return {'server': self.metrics.to_dict(),
+                'rpc': default_pool().metrics.to_dict()}
+
+    def get_loop_monitor(self, stream=None):
+        """ Lag of our event loop and its recent stalls
+
+        See Also
+        --------
+        distributed.loop_monitor.LoopMonitor
+        """
+        if self.loop_monitor is None:
+            return None
+        return self.loop_monitor.to_dict()
+
     def listen(self, port):
         while True:
             try:
@@ -118,6 +234,23 @@ class Server(TCPServer):
                 else:
                     logger.info('Randomly assigned port taken for %s. Retrying',
                                 type(self).__name__)
+        if 'unix' in self.transports and hasattr(socket, 'AF_UNIX'):
+            self._unix_path = listen_unix(self, self.port)
+        if 'inproc' in self.transports:
+            inproc_servers[self.port] = self
+        if self.loop_monitor is not None:
+            self.loop_monitor.start(getattr(self, 'loop', None))
+
+    def stop(self):
+        super(Server, self).stop()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+        if self._unix_path:
+            with ignoring(OSError):
+                os.remove(self._unix_path)
+            self._unix_path = None
+        if self._port and inproc_servers.get(self._port) is self:
+            del inproc_servers[self._port]
 
     @gen.coroutine
     def handle_stream(self, stream, address):
@@ -131,9 +264,14 @@ class Server(TCPServer):
 
         Coroutines should expect a single IOStream object.
         """
-        ip, port = address
+        if not isinstance(address, tuple):  # Unix domain or in-process
+            address = (address or 'unix', 0)
+        ip, port = address[:2]
         logger.info("Connection from %s:%d to %s", ip, port,
                     type(self).__name__)
+        slots = Semaphore(self.concurrency)
+        lock = Lock()  # one writer at a time, see handle_tagged
+        metrics = self.metrics
         try:
             while True:
                 try:
@@ -147,7 +285,8 @@ class Server(TCPServer):
                     msg = {'op': 'server-error',
                            'exception': truncate_exception(e),
                            'traceback': get_traceback()}
-                    yield write(stream, (b'error', msg))
+                    with (yield lock.acquire()):
+                        yield write(stream, (b'error', msg))
                     continue
                 if not isinstance(msg, dict):
                     raise TypeError("Bad message type.  Expected dict, got\n  "
@@ -157,8 +296,28 @@ class Server(TCPServer):
                 reply = msg.pop('reply', True)
                 if op == 'close':
                     if reply:
-                        yield write(stream, b'OK')
+                        with (yield lock.acquire()):
+                            yield write(stream, b'OK')
                     break
+                if op == 'handshake':
+                    protocols = msg.get('protocols', ())
+                    protocol = first([p for p in self.protocols
+                                        if p in protocols] or [None])
+                    yield write(stream, {'protocol': protocol,
+                                         'compression': list(compressions),
+                                         'multiplex': True})
+                    stream.protocol = protocol
+                    stream.compression = choose_compression(self.compression,
+                            msg.get('compression', ()))
+                    continue
+                nbytes, duration = stream.last_read
+                metrics.add(op, 'bytes-in', nbytes)
+                metrics.add(op, 'deserialize', duration)
+                rid = msg.pop('rid', None)
+                if rid is not None:
+                    self.handle_tagged(stream, address, op, rid, reply, msg,
+                                       slots, lock)
+                    continue
                 try:
                     handler = self.handlers[op]
                 except KeyError:
@@ -166,14 +325,20 @@ class Server(TCPServer):
                     logger.warn(result)
                 else:
                     logger.debug("Calling into handler %s", handler.__name__)
+                    start = time()
                     try:
                         result = yield gen.maybe_future(handler(stream, **msg))
                     except Exception as e:
                         logger.exception(e)
                         raise
+                    metrics.add(op, 'handler', time() - start)
                 if reply:
                     try:
-                        yield write(stream, result)
+                        with (yield lock.acquire()):
+                            yield write(stream, result)
+                            nbytes, duration = stream.last_write
+                        metrics.add(op, 'bytes-out', nbytes)
+                        metrics.add(op, 'serialize', duration)
                     except StreamClosedError:
                         logger.info("Lost connection: %s" % str(address))
                         break
@@ -187,23 +352,217 @@ class Server(TCPServer):
         logger.info("Close connection from %s:%d to %s", address[0], address[1],
                     type(self).__name__)
 
+    @gen.coroutine
+    def handle_tagged(self, stream, address, op, rid, reply, msg, slots,
+                      lock):
+        """ Handle a single request tagged with a request id
+
+        This runs alongside ``handle_stream``, which carries on reading
+        further requests from the stream in the meantime.  We wait for one of
+        the connection's ``slots`` before we call the handler.
+
+        Tornado only keeps the future of the most recent write to a stream,
+        so concurrent writers take turns with the connection's ``lock``.
+        """
+        acquired = slots.acquire()
+        if not acquired.done():  # all slots taken, wait in line
+            start = time()
+            yield acquired
+            duration = time() - start
+            self.queued_handlers += 1
+            self.queue_time += duration
+            self.max_queue_time = max(self.max_queue_time, duration)
+        try:
+            handler = self.handlers[op]
+        except KeyError:
+            result = {'rid': rid, 'status': 'OK',
+                      'result': b'No handler found: ' + op.encode()}
+            logger.warn(result['result'])
+        else:
+            logger.debug("Calling into handler %s", handler.__name__)
+            start = time()
+            try:
+                value = yield gen.maybe_future(handler(stream, **msg))
+                result = {'rid': rid, 'status': 'OK', 'result': value}
+                self.metrics.add(op, 'handler', time() - start)
+            except Exception as e:
+                logger.exception(e)
+                result = {'rid': rid, 'status': 'error',
+                          'exception': truncate_exception(e),
+                          'traceback': get_traceback()}
+        finally:
+            slots.release()
+        if reply:
+            with (yield lock.acquire()):
+                try:
+                    yield write(stream, result)
+                    nbytes, duration = stream.last_write
+                    self.metrics.add(op, 'bytes-out', nbytes)
+                    self.metrics.add(op, 'serialize', duration)
+                except StreamClosedError:
+                    logger.info("Lost connection: %s" % str(address))
+                except Exception as e:
+                    logger.exception(e)
+                    result = {'rid': rid, 'status': 'error',
+                              'exception': truncate_exception(e),
+                              'traceback': get_traceback()}
+                    with ignoring(StreamClosedError):
+                        yield write(stream, result)
+
 
 sentinel = md5(b'7f57da0f9202f6b4df78e251058be6f0').hexdigest().encode()
 
+
 @gen.coroutine
 def read(stream):
-    """ Read a message from a stream """
-    msg = yield stream.read_until(sentinel)
-    msg = msg[:-len(sentinel)]
-    msg = loads(msg)
+    """ Read a message from a stream
+
+    Uses length-prefixed frames if the stream negotiated the ``'frames'``
+    protocol during ``connect`` and falls back to scanning for the sentinel
+    otherwise.  In-process streams pass the message itself.
+
+    Afterwards ``stream.last_read`` holds the number of bytes that we read and
+    the seconds that we spent deserializing them.
+    """
+    protocol = getattr(stream, 'protocol', None)
+    if protocol == 'frames':
+        frames = yield read_frames(stream)
+        start = time()
+        msg = loads_msg(frames)
+        stream.last_read = (sum(map(len, frames)), time() - start)
+    elif protocol == 'inproc':
+        msg = yield stream.recv()
+        stream.last_read = (0, 0)
+    else:
+        msg = yield stream.read_until(sentinel)
+        start = time()
+        nbytes = len(msg)
+        msg = msg[:-len(sentinel)]
+        msg = loads(msg)
+        stream.last_read = (nbytes, time() - start)
     raise Return(msg)
 
 
 @gen.coroutine
 def write(stream, msg):
-    """ Write a message to a stream """
-    msg = dumps(msg)
-    yield stream.write(msg + sentinel)
+    """ Write a message to a stream
+
+    Afterwards ``stream.last_write`` holds the number of bytes that we wrote
+    and the seconds that we spent serializing and writing them.
+    """
+    protocol = getattr(stream, 'protocol', None)
+    start = time()
+    if protocol == 'frames':
+        frames = dumps_msg(msg, getattr(stream, 'compression', None))
+        yield write_frames(stream, frames)
+        nbytes = sum(map(len, frames))
+    elif protocol == 'inproc':
+        stream.send(msg)
+        nbytes = 0
+    else:
+        msg = dumps(msg) + sentinel
+        yield stream.write(msg)
+        nbytes = len(msg)
+    stream.last_write = (nbytes, time() - start)
+
+
+@gen.coroutine
+def read_frames(stream):
+    """ Read a list of length-prefixed frames from a stream
+
+    The wire format starts with a fixed header of two 8-byte big-endian
+    unsigned integers, the number of frames and their total length.  Then
+    comes the length of each frame followed by the frames themselves::
+
+        [nframes][total][len(frame-0)][len(frame-1)]...[frame-0][frame-1]...
+
+    Small messages arrive in a single ``read_bytes`` call.  Large frames are
+    each read on their own so that Tornado never has to scan the payload for
+    a delimiter.  We read all but the first of them into a new ``bytearray``
+    that NumPy arrays can then use as their writable memory, see
+    ``protocol.loads_msg``.
+
+    See Also
+    --------
+    write_frames
+    """
+    header = yield stream.read_bytes(16)
+    nframes, total = struct.unpack('!QQ', header)
+    if total < SMALL_MESSAGE:
+        data = yield stream.read_bytes(8 * nframes + total)
+        lengths = struct.unpack_from('!%dQ' % nframes, data)
+        frames = []
+        i = 8 * nframes
+        for length in lengths:
+            frames.append(data[i: i + length])
+            i += length
+    else:
+        lengths = yield stream.read_bytes(8 * nframes)
+        lengths = struct.unpack('!%dQ' % nframes, lengths)
+        frames = []
+        for i, length in enumerate(lengths):
+            if not length:
+                frame = b''
+            elif i:
+                frame = yield read_into(stream, bytearray(length))
+            else:
+                frame = yield stream.read_bytes(length)
+            frames.append(frame)
+    raise Return(frames)
+
+
+@gen.coroutine
+def read_into(stream, buffer):
+    """ Fill a writable buffer with the next bytes of a stream
+
+    Tornado 5 reads into the buffer itself, older versions hand us chunks
+    that we copy in as they arrive.  Either way we never hold the whole
+    payload twice.
+    """
+    if hasattr(stream, 'read_into'):
+        yield stream.read_into(buffer)
+    else:
+        view = memoryview(buffer)
+        filled = [0]
+
+        def fill(chunk):
+            i = filled[0]
+            view[i: i + len(chunk)] = chunk
+            filled[0] = i + len(chunk)
+
+        yield stream.read_bytes(len(buffer), streaming_callback=fill)
+    raise Return(buffer)
+
+
+def write_frames(stream, frames):
+    """ Write a list of bytestrings to a stream as length-prefixed frames
+
+    Frames may also be memoryviews onto large buffers, as produced by
+    ``protocol.dumps_msg``.  We hand these to the stream in chunks so that
+    we never build a bytestring of the whole buffer.
+
+    Returns a future that completes once all frames have been flushed.
+
+    See Also
+    --------
+    read_frames
+    """
+    lengths = [len(frame) for frame in frames]
+    total = sum(lengths)
+    header = struct.pack('!%dQ' % (len(frames) + 2), len(frames), total,
+                         *lengths)
+    if total < SMALL_MESSAGE:  # one write, avoids Nagle's delay
+        return stream.write(b''.join([header] + list(frames)))
+    else:
+        future = stream.write(header)
+        for frame in frames:
+            if isinstance(frame, bytes):
+                if frame:
+                    future = stream.write(frame)
+            else:
+                for i in range(0, len(frame), WRITE_CHUNK):
+                    future = stream.write(frame[i: i + WRITE_CHUNK].tobytes())
+        return future
 
 
 def pingpong(stream):
@@ -211,14 +570,46 @@ def pingpong(stream):
 
 
 @gen.coroutine
-def connect(ip, port, timeout=3):
+def connect(ip, port, timeout=3, protocols=PROTOCOLS, compression='auto',
+            transports=TRANSPORTS):
+    """ Open a stream to a server and negotiate the wire protocol
+
+    Large frames that we write to the stream are compressed with
+    ``compression`` if the server can decompress them, see ``Server``.
+
+    We reach servers on this host through the best of ``transports`` that
+    they offer and use TCP otherwise, see ``transport.choose_transport``.
+    Streams over Unix domain sockets are never compressed.  In-process
+    streams need no handshake and pass messages without serialization.
+
+    See Also
+    --------
+    handshake
+    """
+    transport = choose_transport(ip, port, transports)
+    if transport == 'inproc' and protocols:
+        raise Return(connect_inproc(port))
+    if transport == 'unix':
+        try:
+            stream = yield connect_unix(port, timeout=timeout,
+                                        max_buffer_size=MAX_BUFFER_SIZE)
+        except StreamClosedError:
+            logger.debug("Could not connect to %s:%d over Unix domain socket",
+                         ip, port)
+        else:
+            if protocols:
+                yield handshake(stream, protocols, compression=None,
+                                decompress=False)
+                stream.peer_compression = ()  # so that nobody compresses
+            raise Return(stream)
+
     client = TCPClient()
     start = time()
     while True:
         try:
             future = client.connect(ip, port, max_buffer_size=MAX_BUFFER_SIZE)
             stream = yield gen.with_timeout(timedelta(seconds=timeout), future)
-            raise Return(stream)
+            break
         except StreamClosedError:
             if time() - start < timeout:
                 yield gen.sleep(0.01)
@@ -227,6 +618,40 @@ def connect(ip, port, timeout=3):
                 raise
         except gen.TimeoutError:
             raise IOError("Timed out while connecting to %s:%d" % (ip, port))
+    if protocols:
+        yield handshake(stream, protocols, compression)
+    raise Return(stream)
+
+
+@gen.coroutine
+def handshake(stream, protocols=PROTOCOLS, compression='auto',
+              decompress=True):
+    """ Agree on a wire protocol with the server on the other end of stream
+
+    The handshake itself travels in the legacy sentinel-delimited format.
+    Servers that predate the handshake reply with a "No handler found" error,
+    in which case we keep using the legacy format on this stream.
+
+    With ``decompress=False`` we ask the server not to compress what it sends.
+    """
+    yield write(stream, {'op': 'handshake', 'protocols': list(protocols),
+                         'compression': list(compressions) if decompress
+                                        else [],
+                         'reply': True})
+    response = yield read(stream)
+    if isinstance(response, dict) and response.get('protocol') in protocols:
+        stream.protocol = response['protocol']
+        stream.peer_compression = response.get('compression', ())
+        stream.compression = choose_compression(compression,
+                                                stream.peer_compression)
+        stream.peer_multiplex = response.get('multiplex', False)
+    else:
+        logger.debug("Peer does not support framed protocols: %s", response)
+        stream.protocol = None
+        stream.peer_compression = ()
+        stream.compression = None
+        stream.peer_multiplex = False
+    raise Return(stream)
 
 
 @gen.coroutine
@@ -260,6 +685,328 @@ def send_recv_sync(stream=None, ip=None, port=None, reply=True, **kwargs):
                               **kwargs))
 
 
+class Multiplexer(object):
+    """ Many concurrent requests over a single stream
+
+    Each request carries a fresh request id.  The server handles tagged
+    requests concurrently and tags its replies with the same id, so that
+    replies can come back in any order.  A background coroutine reads
+    replies and hands each one to the request waiting for it.
+
+    >>> stream = yield connect(ip, port)  # doctest: +SKIP
+    >>> mux = Multiplexer(stream)  # doctest: +SKIP
+    >>> a, b = yield [mux.send_recv(op='ping'),
+    ...               mux.send_recv(op='identity')]  # doctest: +SKIP
+
+    Requests that fail on the server raise the remote exception.  All pending
+    requests fail with ``StreamClosedError`` if the stream closes.
+
+    We record statistics of each request in ``metrics`` if given, see
+    ``rpc``.
+
+    Only use this for handlers that neither read from nor write to the
+    stream themselves.  See ``Server``.
+    """
+    def __init__(self, stream, metrics=None):
+        self.stream = stream
+        self.metrics = metrics
+        self.counter = itertools.count()
+        self.pending = dict()  # request id -> (op, Future)
+        self.lock = Lock()  # one writer at a time, see Server.handle_tagged
+        self._reader = self._read_replies()
+
+    def __str__(self):
+        return '<Multiplexer: %d pending>' % len(self.pending)
+
+    __repr__ = __str__
+
+    def closed(self):
+        return self.stream.closed()
+
+    @gen.coroutine
+    def send_recv(self, reply=True, **kwargs):
+        """ Send a request and wait for its reply
+
+        Keyword arguments turn into the message, like ``send_recv``
+        """
+        if self.stream.closed():
+            raise StreamClosedError()
+        rid = next(self.counter)
+        msg = kwargs
+        msg['rid'] = rid
+        msg['reply'] = reply
+        op = msg.get('op')
+        metrics = self.metrics
+        if reply:
+            future = Future()
+            self.pending[rid] = (op, future)
+        start = time()
+        try:
+            with (yield self.lock.acquire()):
+                yield write(self.stream, msg)
+                nbytes, duration = self.stream.last_write
+        except Exception:
+            self.pending.pop(rid, None)
+            raise
+        if metrics is not None:
+            metrics.add(op, 'bytes-out', nbytes)
+            metrics.add(op, 'serialize', duration)
+        if not reply:
+            raise Return(None)
+        response = yield future
+        if metrics is not None:
+            metrics.add(op, 'latency', time() - start)
+        raise Return(response)
+
+    @gen.coroutine
+    def _read_replies(self):
+        try:
+            while True:
+                msg = yield read(self.stream)
+                try:
+                    op, future = self.pending.pop(msg['rid'])
+                except KeyError:
+                    logger.warn("Reply to unknown request: %s", msg['rid'])
+                    continue
+                if self.metrics is not None:
+                    nbytes, duration = self.stream.last_read
+                    self.metrics.add(op, 'bytes-in', nbytes)
+                    self.metrics.add(op, 'deserialize', duration)
+                if msg['status'] == 'OK':
+                    future.set_result(msg['result'])
+                else:
+                    future.set_exception(msg['exception'])
+        except StreamClosedError:
+            pass
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.stream.close()
+            pending, self.pending = self.pending, dict()
+            for op, future in pending.values():
+                future.set_exception(StreamClosedError())
+
+    def close(self):
+        self.stream.close()
+
+
+class ConnectionPool(object):
+    """ A pool of open streams to remote servers
+
+    Opening a stream costs a TCP connection and a handshake.  The pool keeps
+    streams open after use so that later requests to the same peer can reuse
+    them.
+
+    >>> pool = ConnectionPool()
+    >>> stream = yield pool.connect('127.0.0.1', 8787)  # doctest: +SKIP
+    >>> yield write(stream, {'op': 'ping'})  # doctest: +SKIP
+    >>> response = yield read(stream)  # doctest: +SKIP
+    >>> pool.reuse(stream)  # doctest: +SKIP
+
+    Streams that a caller does not give back with ``reuse``, perhaps because
+    an error left them in an unknown state, should be closed.
+
+    The pool opens at most ``limit`` streams in total and ``limit_per_peer``
+    streams to any one peer.  When we reach the total limit we close the
+    least recently used idle stream.  When all streams are busy we wait for
+    one to come back.  Streams that close while idle leave the pool right
+    away; we check again that a stream is open before we reuse it.
+
+    Most code uses the pool of the current IOLoop, see ``default_pool``.
+
+    **State**
+
+    * **available:** ``{(ip, port): [IOStream]}``
+        Idle streams per peer, the most recently used last
+    * **occupied:** ``{(ip, port): {IOStream}}``
+        Streams currently in use per peer
+    * **idle:** ``OrderedDict({IOStream: (ip, port)})``
+        All idle streams, the least recently used first
+    * **multiplexers:** ``{(ip, port): Future}``
+        Future of the ``Multiplexer`` shared by all multiplexed requests to a
+        peer, or of None if the peer can't multiplex, see ``multiplexed``
+    * **hits**, **misses**, **connections**, **evictions:** ``int``
+        Counts of reused streams, requests that found no idle stream, newly
+        opened streams and idle streams closed to make room
+    * **metrics:** ``Metrics``
+        Statistics of the requests of all rpc objects that use this pool
+    """
+    def __init__(self, limit=POOL_LIMIT, limit_per_peer=POOL_LIMIT_PER_PEER):
+        self.limit = limit
+        self.limit_per_peer = limit_per_peer
+        self.available = defaultdict(list)
+        self.occupied = defaultdict(set)
+        self.idle = OrderedDict()
+        self.streams = dict()  # every open stream -> address
+        self.connecting = defaultdict(int)
+        self.multiplexers = dict()
+        self.metrics = Metrics()
+        self.hits = 0
+        self.misses = 0
+        self.connections = 0
+        self.evictions = 0
+        self.released = Condition()
+
+    def __str__(self):
+        return '<ConnectionPool: open=%d, idle=%d, hits=%d, misses=%d>' % (
+                self.open, len(self.idle), self.hits, self.misses)
+
+    __repr__ = __str__
+
+    @property
+    def open(self):
+        """ Number of open streams, counting those that are connecting """
+        return len(self.streams) + sum(self.connecting.values())
+
+    def _count(self, addr):
+        return (len(self.available[addr]) + len(self.occupied[addr]) +
+                self.connecting[addr])
+
+    @gen.coroutine
+    def connect(self, ip, port, timeout=3, compression='auto'):
+        """ Get an open stream to ip:port, reusing an idle one if we can """
+        addr = (ip, port)
+        missed = False
+        while True:
+            available = self.available[addr]
+            while available:
+                stream = available.pop()
+                del self.idle[stream]
+                if stream.closed():  # health check
+                    self._remove(stream)
+                    continue
+                if not missed:
+                    self.hits += 1
+                self.occupied[addr].add(stream)
+                stream.compression = choose_compression(compression,
+                                        getattr(stream, 'peer_compression', ()))
+                raise Return(stream)
+
+            if not missed:
+                self.misses += 1
+                missed = True
+            if self._count(addr) < self.limit_per_peer:
+                if self.open < self.limit:
+                    break
+                if self.idle:
+                    self.evict()
+                    continue
+            yield self.released.wait()
+
+        self.connecting[addr] += 1
+        try:
+            stream = yield connect(ip, port, timeout=timeout,
+                                   compression=compression)
+        finally:
+            self.connecting[addr] -= 1
+            if not self.connecting[addr]:
+                del self.connecting[addr]
+            self.released.notify_all()
+        self.connections += 1
+        self.occupied[addr].add(stream)
+        self.streams[stream] = addr
+        stream.set_close_callback(partial(self._on_close, stream))
+        raise Return(stream)
+
+    def multiplexed(self, ip, port, timeout=3, compression='auto'):
+        """ Get the Multiplexer shared by all multiplexed requests to ip:port
+
+        This returns a Future.  Its result is None if the peer doesn't
+        support multiplexing, in which case use ``connect`` instead.  The
+        multiplexed stream doesn't count towards the limits of the pool.
+        """
+        addr = (ip, port)
+        future = self.multiplexers.get(addr)
+        if future is not None and future.done():
+            if (future.exception() is not None or
+                future.result() is not None and future.result().closed()):
+                future = None
+        if future is None:
+            future = self._open_multiplexer(ip, port, timeout, compression)
+            self.multiplexers[addr] = future
+        return future
+
+    @gen.coroutine
+    def _open_multiplexer(self, ip, port, timeout, compression):
+        stream = yield connect(ip, port, timeout=timeout,
+                               compression=compression)
+        if not getattr(stream, 'peer_multiplex', False):
+            stream.close()
+            raise Return(None)
+        raise Return(Multiplexer(stream, metrics=self.metrics))
+
+    def reuse(self, stream):
+        """ Give a stream back to the pool once we're done with it """
+        addr = self.streams.get(stream)
+        if addr is None:
+            return
+        self.occupied[addr].discard(stream)
+        if stream.closed():
+            self._remove(stream)
+        else:
+            self.available[addr].append(stream)
+            self.idle[stream] = addr
+        self.released.notify_all()
+
+    def evict(self):
+        """ Close the least recently used idle stream """
+        stream, addr = self.idle.popitem(last=False)
+        self.available[addr].remove(stream)
+        self._remove(stream)
+        self.evictions += 1
+        stream.close()
+
+    def close(self, ip=None, port=None):
+        """ Close idle streams, either all of them or those to ip:port """
+        for stream, addr in list(self.idle.items()):
+            if ip is None or addr == (ip, port):
+                del self.idle[stream]
+                self.available[addr].remove(stream)
+                self._remove(stream)
+                stream.close()
+        for addr, future in list(self.multiplexers.items()):
+            if ip is None or addr == (ip, port):
+                if not future.done() or future.exception() is not None:
+                    continue
+                mux = future.result()
+                if mux is not None and not mux.pending:
+                    mux.close()
+                    del self.multiplexers[addr]
+
+    def _remove(self, stream):
+        addr = self.streams.pop(stream, None)
+        if addr is not None:
+            self.occupied[addr].discard(stream)
+            if not self._count(addr):
+                del self.available[addr]
+                del self.occupied[addr]
+                self.connecting.pop(addr, None)
+            self.released.notify_all()
+
+    def _on_close(self, stream):
+        if stream in self.idle:
+            addr = self.idle.pop(stream)
+            self.available[addr].remove(stream)
+        self._remove(stream)
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def default_pool():
+    """ The ConnectionPool shared by everything on the current IOLoop
+
+    Streams belong to the IOLoop that created them so each IOLoop gets its
+    own pool.
+    """
+    loop = IOLoop.current()
+    try:
+        return _pools[loop]
+    except KeyError:
+        pool = _pools[loop] = ConnectionPool()
+        return pool
+
+
 class rpc(object):
     """ Conveniently interact with a remote server
 
@@ -276,20 +1023,39 @@ class rpc(object):
     >>> response = yield remote.add(x=10, y=20)  # doctest: +SKIP
 
     One rpc object can be reused for several interactions.
-    Additionally, this object creates and destroys many streams as necessary
-    and so is safe to use in multiple overlapping communications.
+    Additionally, this object draws streams from a ``ConnectionPool`` as
+    necessary and so is safe to use in multiple overlapping communications.
+    Streams go back to the pool after each interaction.  By default we use
+    the pool shared by everything on the current IOLoop.
 
-    When done, close streams explicitly.
+    With ``multiplex=True`` all requests to the same peer share a single
+    stream and run concurrently on the other end, see ``Multiplexer``.  This
+    saves a connection for every concurrent request.  Only use it for simple
+    request-reply handlers.  Requests with ``close=True`` and peers that
+    don't support multiplexing use the pool as usual.
+
+    Statistics of every call go into the ``metrics`` of the pool, see
+    ``distributed.metrics.Metrics``.
+
+    When done, close idle streams explicitly.
 
     >>> remote.close_streams()  # doctest: +SKIP
     """
-    def __init__(self, stream=None, ip=None, port=None, timeout=3):
+    def __init__(self, stream=None, ip=None, port=None, timeout=3,
+                 compression='auto', pool=None, multiplex=False):
         self.streams = dict()
         if stream:
             self.streams[stream] = True
         self.ip = ip
         self.port = port
         self.timeout = timeout
+        self.compression = compression
+        self.multiplex = multiplex
+        self._pool = pool
+
+    @property
+    def pool(self):
+        return self._pool or default_pool()
 
     @gen.coroutine
     def live_stream(self):
@@ -318,7 +1084,8 @@ class rpc(object):
             if open:
                 break
         if not open or stream.closed():
-            stream = yield connect(self.ip, self.port, timeout=self.timeout)
+            stream = yield connect(self.ip, self.port, timeout=self.timeout,
+                                   compression=self.compression)
             self.streams[stream] = True
         for s in to_clear:
             del self.streams[s]
@@ -329,24 +1096,68 @@ class rpc(object):
     def close_streams(self):
         for stream in self.streams:
             stream.close()
+        if self.ip is not None:
+            self.pool.close(self.ip, self.port)
 
     def __getattr__(self, key):
-        @gen.coroutine
-        def _(**kwargs):
-            stream = yield self.live_stream()
-            result = yield send_recv(stream=stream, op=key, **kwargs)
-            self.streams[stream] = True  # mark as open
-            raise Return(result)
+        if self.ip is None:
+            @gen.coroutine
+            def _(**kwargs):
+                stream = yield self.live_stream()
+                start = time()
+                result = yield send_recv(stream=stream, op=key, **kwargs)
+                record_call(default_pool().metrics, key, stream,
+                            time() - start, kwargs.get('reply', True))
+                self.streams[stream] = True  # mark as open
+                raise Return(result)
+        else:
+            @gen.coroutine
+            def _(**kwargs):
+                pool = self.pool
+                if self.multiplex and not kwargs.get('close'):
+                    mux = yield pool.multiplexed(self.ip, self.port,
+                                                 timeout=self.timeout,
+                                                 compression=self.compression)
+                    if mux is not None:
+                        result = yield mux.send_recv(op=key, **kwargs)
+                        raise Return(result)
+                stream = yield pool.connect(self.ip, self.port,
+                                            timeout=self.timeout,
+                                            compression=self.compression)
+                start = time()
+                try:
+                    result = yield send_recv(stream=stream, op=key, **kwargs)
+                    record_call(pool.metrics, key, stream, time() - start,
+                                kwargs.get('reply', True))
+                except Exception:
+                    stream.close()
+                    raise
+                finally:
+                    pool.reuse(stream)
+                raise Return(result)
         return _
 
 
+def record_call(metrics, op, stream, latency, reply=True):
+    """ Record the statistics of a request-reply call on stream in metrics
+    """
+    metrics.add(op, 'latency', latency)
+    nbytes, duration = stream.last_write
+    metrics.add(op, 'bytes-out', nbytes)
+    metrics.add(op, 'serialize', duration)
+    if reply:
+        nbytes, duration = stream.last_read
+        metrics.add(op, 'bytes-in', nbytes)
+        metrics.add(op, 'deserialize', duration)
+
+
 def coerce_to_rpc(o, **kwargs):
     if isinstance(o, tuple):
         return rpc(ip=o[0], port=o[1], **kwargs)
     if isinstance(o, str):
         ip, port = o.split(':')
         return rpc(ip=ip, port=int(port), **kwargs)
-    elif isinstance(o, IOStream):
+    elif isinstance(o, (IOStream, InProcStream)):
         return rpc(stream=o, **kwargs)
     elif isinstance(o, rpc):
         return o
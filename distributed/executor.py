@@ -28,8 +28,10 @@ from tornado.iostream import StreamClosedError, IOStream
 from tornado.queues import Queue
 
 from .client import (WrappedKey, unpack_remotedata, pack_data)
-from .core import read, write, connect, rpc, coerce_to_rpc, dumps
+from .core import (read, write, connect, rpc, coerce_to_rpc, dumps,
+        loads)
 from .scheduler import Scheduler, dumps_function, dumps_task
+from .transport import InProcStream
 from .utils import All, sync, funcname, ignoring, queue_to_iterator, _deps
 from .compatibility import Queue as pyQueue, Empty, isqueue
 
@@ -218,6 +220,9 @@ class Executor(object):
         This can be the address of a ``Center`` or ``Scheduler`` servers, either
         as a string ``'127.0.0.1:8787'`` or tuple ``('127.0.0.1', 8787)``
         or it can be a local ``Scheduler`` object.
+    compression: string or None
+        Compression for large frames that we send to the scheduler, one of
+        ``'auto'`` (default), ``'lz4'``, ``'blosc'``, ``'zlib'`` or None
 
     Examples
     --------
@@ -243,13 +248,15 @@ class Executor(object):
     --------
     distributed.scheduler.Scheduler: Internal scheduler
     """
-    def __init__(self, address, start=True, loop=None, timeout=3):
+    def __init__(self, address, start=True, loop=None, timeout=3,
+                 compression='auto'):
         self.futures = dict()
         self.refcount = defaultdict(lambda: 0)
         self.loop = loop or IOLoop() if start else IOLoop.current()
         self.coroutines = []
         self.id = str(uuid.uuid1())
         self._start_arg = address
+        self.compression = compression
 
         if start:
             self.start(timeout=timeout)
@@ -284,7 +291,7 @@ class Executor(object):
     def _send_to_scheduler(self, msg):
         if isinstance(self.scheduler, Scheduler):
             self.loop.add_callback(self.scheduler_queue.put_nowait, msg)
-        elif isinstance(self.scheduler_stream, IOStream):
+        elif isinstance(self.scheduler_stream, (IOStream, InProcStream)):
             self.loop.add_callback(write, self.scheduler_stream, msg)
         else:
             raise NotImplementedError()
@@ -298,7 +305,8 @@ class Executor(object):
             ip, port = tuple(self._start_arg.split(':'))
             self._start_arg = (ip, int(port))
         if isinstance(self._start_arg, tuple):
-            r = coerce_to_rpc(self._start_arg, timeout=timeout)
+            r = coerce_to_rpc(self._start_arg, timeout=timeout,
+                              compression=self.compression)
             try:
                 ident = yield r.identity()
             except (StreamClosedError, OSError):
@@ -306,16 +314,19 @@ class Executor(object):
             if ident['type'] == 'Center':
                 self.center = r
                 self.scheduler = Scheduler(self.center, loop=self.loop,
+                                           compression=self.compression,
                                            **kwargs)
                 self.scheduler.listen(0)
             elif ident['type'] == 'Scheduler':
                 self.scheduler = r
-                self.scheduler_stream = yield connect(*self._start_arg)
+                self.scheduler_stream = yield connect(*self._start_arg,
+                                            compression=self.compression)
                 yield write(self.scheduler_stream, {'op': 'register-client',
                                                     'client': self.id})
                 if 'center' in ident:
                     cip, cport = ident['center']
-                    self.center = rpc(ip=cip, port=cport)
+                    self.center = rpc(ip=cip, port=cport,
+                                      compression=self.compression)
                 else:
                     self.center = self.scheduler
             else:
@@ -365,58 +376,76 @@ class Executor(object):
 
     @gen.coroutine
     def _handle_report(self, start_event):
-        """ Listen to scheduler """
+        """ Listen to scheduler
+
+        The scheduler batches the messages on our stream into lists, see
+        ``Scheduler.report``.
+        """
         if isinstance(self.scheduler, Scheduler):
             next_message = self.report_queue.get
-        elif isinstance(self.scheduler_stream, IOStream):
+        elif isinstance(self.scheduler_stream, (IOStream, InProcStream)):
             next_message = lambda: read(self.scheduler_stream)
         else:
             raise NotImplemented()
 
         while True:
             try:
-                msg = yield next_message()
+                msgs = yield next_message()
             except StreamClosedError:
                 break
+            if not isinstance(msgs, list):
+                msgs = [msgs]
 
-            logger.debug("Executor receives message %s", msg)
+            for msg in msgs:
+                logger.debug("Executor receives message %s", msg)
 
-            if msg['op'] == 'stream-start':
-                start_event.set()
-            if msg['op'] == 'close':
-                break
-            if msg['op'] == 'key-in-memory':
-                if msg['key'] in self.futures:
-                    self.futures[msg['key']]['status'] = 'finished'
-                    self.futures[msg['key']]['event'].set()
-                    if (msg.get('type') and
-                        not self.futures[msg['key']].get('type')):
-                        self.futures[msg['key']]['type'] = msg['type']
-            if msg['op'] == 'lost-data':
-                if msg['key'] in self.futures:
-                    self.futures[msg['key']]['status'] = 'lost'
-                    self.futures[msg['key']]['event'].clear()
-            if msg['op'] == 'cancelled-key':
-                if msg['key'] in self.futures:
-                    self.futures[msg['key']]['event'].set()
-                    del self.futures[msg['key']]
-            if msg['op'] == 'task-erred':
-                if msg['key'] in self.futures:
-                    self.futures[msg['key']]['status'] = 'error'
-                    self.futures[msg['key']]['exception'] = msg['exception']
-                    self.futures[msg['key']]['traceback'] = msg['traceback']
-                    self.futures[msg['key']]['event'].set()
-            if msg['op'] == 'restart':
-                logger.info("Receive restart signal from scheduler")
-                events = [d['event'] for d in self.futures.values()]
-                self.futures.clear()
-                for e in events:
-                    e.set()
-                with ignoring(AttributeError):
-                    self._restart_event.set()
-            if msg['op'] == 'scheduler-error':
-                logger.warn("Scheduler exception:")
-                logger.exception(msg['exception'])
+                if msg['op'] == 'stream-start':
+                    start_event.set()
+                if msg['op'] == 'close':
+                    break
+                self._handle_report_message(msg)
+            else:
+                continue
+            break  # close
+
+    def _handle_report_message(self, msg):
+        """ Update our futures from a single message of the scheduler """
+        if msg['op'] == 'key-in-memory':
+            if msg['key'] in self.futures:
+                self.futures[msg['key']]['status'] = 'finished'
+                self.futures[msg['key']]['event'].set()
+                if (msg.get('type') and
+                    not self.futures[msg['key']].get('type')):
+                    typ = msg['type']
+                    if isinstance(typ, bytes):
+                        typ = loads(typ)
+                    self.futures[msg['key']]['type'] = typ
+        if msg['op'] == 'lost-data':
+            if msg['key'] in self.futures:
+                self.futures[msg['key']]['status'] = 'lost'
+                self.futures[msg['key']]['event'].clear()
+        if msg['op'] == 'cancelled-key':
+            if msg['key'] in self.futures:
+                self.futures[msg['key']]['event'].set()
+                del self.futures[msg['key']]
+        if msg['op'] == 'task-erred':
+            for key in msg['keys']:
+                if key in self.futures:
+                    self.futures[key]['status'] = 'error'
+                    self.futures[key]['exception'] = msg['exception']
+                    self.futures[key]['traceback'] = msg['traceback']
+                    self.futures[key]['event'].set()
+        if msg['op'] == 'restart':
+            logger.info("Receive restart signal from scheduler")
+            events = [d['event'] for d in self.futures.values()]
+            self.futures.clear()
+            for e in events:
+                e.set()
+            with ignoring(AttributeError):
+                self._restart_event.set()
+        if msg['op'] == 'scheduler-error':
+            logger.warn("Scheduler exception:")
+            logger.exception(msg['exception'])
 
     @gen.coroutine
     def _shutdown(self, fast=False):
@@ -451,6 +480,12 @@ class Executor(object):
         workers: set, iterable of sets
             A set of worker hostnames on which computations may be performed.
             Leave empty to default to all workers (common case)
+        resources: dict (optional)
+            Amounts of abstract resources like ``{'GPU': 1}`` that each task
+            holds while it runs.  Tasks only run on workers that offer these
+            resources and only while enough of them are free there.
+        priority: int (defaults to 0)
+            Tasks of a higher priority run before those of a lower one
 
         Examples
         --------
@@ -470,6 +505,8 @@ class Executor(object):
         key = kwargs.pop('key', None)
         pure = kwargs.pop('pure', True)
         workers = kwargs.pop('workers', None)
+        resources = kwargs.pop('resources', None)
+        priority = kwargs.pop('priority', 0)
         allow_other_workers = kwargs.pop('allow_other_workers', False)
 
         if allow_other_workers not in (True, False, None):
@@ -513,6 +550,9 @@ class Executor(object):
                                  'dependencies': {key: dependencies},
                                  'restrictions': restrictions,
                                  'loose_restrictions': loose_restrictions,
+                                 'resources': {key: resources} if resources
+                                              else {},
+                                 'priority': priority,
                                  'client': self.id})
 
         return Future(key, self)
@@ -546,6 +586,12 @@ class Executor(object):
         workers: set, iterable of sets
             A set of worker hostnames on which computations may be performed.
             Leave empty to default to all workers (common case)
+        resources: dict (optional)
+            Amounts of abstract resources like ``{'GPU': 1}`` that each task
+            holds while it runs.  Tasks only run on workers that offer these
+            resources and only while enough of them are free there.
+        priority: int (defaults to 0)
+            Tasks of a higher priority run before those of a lower one
 
         Examples
         --------
@@ -577,6 +623,8 @@ class Executor(object):
 
         pure = kwargs.pop('pure', True)
         workers = kwargs.pop('workers', None)
+        resources = kwargs.pop('resources', None)
+        priority = kwargs.pop('priority', 0)
         allow_other_workers = kwargs.pop('allow_other_workers', False)
 
         if allow_other_workers and workers is None:
@@ -631,6 +679,9 @@ class Executor(object):
                                  'keys': keys,
                                  'restrictions': restrictions,
                                  'loose_restrictions': loose_restrictions,
+                                 'resources': {key: resources for key in keys}
+                                              if resources else {},
+                                 'priority': priority,
                                  'client': self.id})
 
         return [Future(key, self) for key in keys]
@@ -903,7 +954,7 @@ class Executor(object):
         else:
             return result
 
-    def compute(self, args, sync=False):
+    def compute(self, args, sync=False, resources=None, priority=0):
         """ Compute dask collections on cluster
 
         Parameters
@@ -912,6 +963,11 @@ class Executor(object):
             Collections like dask.array or dataframe or dask.value objects
         sync: bool (optional)
             Returns Futures if False (default) or concrete values if True
+        resources: dict (optional)
+            Amounts of abstract resources like ``{'GPU': 1}`` that each task
+            of the collections holds while it runs, see ``Executor.submit``
+        priority: int (defaults to 0)
+            Tasks of a higher priority run before those of a lower one
 
         Returns
         -------
@@ -965,6 +1021,9 @@ class Executor(object):
                                  'tasks': valmap(dumps_task, dsk3),
                                  'dependencies': dependencies,
                                  'keys': names,
+                                 'resources': {key: resources for key in dsk3}
+                                              if resources else {},
+                                 'priority': priority,
                                  'client': self.id})
 
         i = 0
@@ -986,7 +1045,7 @@ class Executor(object):
         else:
             return result
 
-    def persist(self, collections):
+    def persist(self, collections, priority=0):
         """ Persist dask collections on cluster
 
         Starts computation of the collection on the cluster in the background.
@@ -997,6 +1056,8 @@ class Executor(object):
         ----------
         collections: sequence or single dask object
             Collections like dask.array or dataframe or dask.value objects
+        priority: int (defaults to 0)
+            Tasks of a higher priority run before those of a lower one
 
         Returns
         -------
@@ -1037,6 +1098,7 @@ class Executor(object):
                                  'tasks': valmap(dumps_task, dsk2),
                                  'dependencies': dependencies,
                                  'keys': names,
+                                 'priority': priority,
                                  'client': self.id})
         result = [redict_collection(c, {k: Future(k, self)
                                         for k in flatten(c._keys())})
@@ -52,6 +52,18 @@ class Resources(RequestHandler):
         self.write(resource_collect())
 
 
+class Metrics(RequestHandler):
+    """Histograms of message sizes and times per operation"""
+    def get(self):
+        self.write(self.server.get_metrics())
+
+
+class LoopMonitor(RequestHandler):
+    """Lag of the event loop and stacks of its recent stalls"""
+    def get(self):
+        self.write(self.server.get_loop_monitor() or {})
+
+
 class Proxy(RequestHandler):
     """Send REST call to specific worker return its response"""
     @gen.coroutine
@@ -7,7 +7,7 @@ import logging
 from tornado import web, gen
 from tornado.httpclient import AsyncHTTPClient
 
-from .core import RequestHandler, MyApp, Resources, Proxy
+from .core import RequestHandler, MyApp, Resources, Metrics, LoopMonitor, Proxy
 from ..utils import key_split
 
 
@@ -23,10 +23,21 @@ class Info(RequestHandler):
 
 
 class Processing(RequestHandler):
-    """ Active tasks on each worker """
+    """ Active tasks on each worker
+
+    With ``?durations=1`` this also includes the scheduler's estimates of how
+    long tasks take by key prefix and of how many seconds of work per core
+    each worker has in flight and queued up.
+    """
     def get(self):
         resp = {'%s:%d' % addr: list(map(key_split, tasks))
                 for addr, tasks in self.server.processing.items()}
+        if self.get_argument('durations', None):
+            s = self.server
+            resp = {'processing': resp,
+                    'durations': s.task_duration,
+                    'load': {'%s:%d' % addr: s.worker_load(addr)
+                             for addr in s.processing}}
         self.write(resp)
 
 
@@ -72,6 +83,8 @@ def HTTPScheduler(scheduler):
     application = MyApp(web.Application([
         (r'/info.json', Info, {'server': scheduler}),
         (r'/resources.json', Resources, {'server': scheduler}),
+        (r'/metrics.json', Metrics, {'server': scheduler}),
+        (r'/loop.json', LoopMonitor, {'server': scheduler}),
         (r'/processing.json', Processing, {'server': scheduler}),
         (r'/proxy/([\w.-]+):(\d+)/(.+)', Proxy),
         (r'/broadcast/(.+)', Broadcast, {'server': scheduler}),
@@ -10,6 +10,7 @@ from distributed import Scheduler, Executor
 from distributed.executor import _wait
 from distributed.utils_test import gen_cluster, gen_test, inc
 from distributed.http.scheduler import HTTPScheduler
+from distributed.scheduler import TaskState
 from distributed.http.worker import HTTPWorker
 
 
@@ -33,12 +34,61 @@ def test_processing(s, a, b):
     server.listen(0)
     client = AsyncHTTPClient()
 
-    s.processing[a.address].add(('foo-1', 1))
+    s.worker_states[a.address].processing.add(TaskState(('foo-1', 1)))
 
     response = yield client.fetch('http://localhost:%d/processing.json' % server.port)
     response = json.loads(response.body.decode())
     assert response == {a.address_string: ['foo'], b.address_string: []}
 
+    s.task_duration['foo'] = 2.0
+    s.worker_states[a.address].processing_duration = 2.0
+    response = yield client.fetch('http://localhost:%d/processing.json'
+                                  '?durations=1' % server.port)
+    response = json.loads(response.body.decode())
+    assert response['processing'] == {a.address_string: ['foo'],
+                                      b.address_string: []}
+    assert response['durations'] == {'foo': 2.0}
+    assert response['load'] == {a.address_string: 2.0 / a.ncores,
+                                b.address_string: 0}
+
+    server.stop()
+
+
+@gen_cluster()
+def test_metrics(s, a, b):
+    server = HTTPScheduler(s)
+    server.listen(0)
+    client = AsyncHTTPClient()
+
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+    futures = e.map(inc, range(10))
+    yield e._gather(futures)
+
+    response = yield client.fetch('http://localhost:%d/metrics.json' %
+                                  server.port)
+    response = json.loads(response.body.decode())
+    assert response['server']['register']['handler']['count'] == 2
+    assert response['rpc']['gather']['latency']['count'] >= 1
+
+    yield e._shutdown()
+    server.stop()
+
+
+@gen_cluster()
+def test_loop_monitor(s, a, b):
+    server = HTTPScheduler(s)
+    server.listen(0)
+    client = AsyncHTTPClient()
+    while not s.loop_monitor.lag.count:  # wait for the first tick
+        yield gen.sleep(0.01)
+
+    response = yield client.fetch('http://localhost:%d/loop.json' %
+                                  server.port)
+    response = json.loads(response.body.decode())
+    assert response['lag']['count'] >= 1
+    assert isinstance(response['stalls'], list)
+
     server.stop()
 
 
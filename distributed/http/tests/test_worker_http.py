@@ -33,7 +33,7 @@ def test_simple(s, a, b):
     except ImportError:
         assert response == {}
 
-    endpoints = ['/files.json']
+    endpoints = ['/files.json', '/metrics.json']
     for endpoint in endpoints:
         response = yield client.fetch(('http://localhost:%d' % server.port)
                                       + endpoint)
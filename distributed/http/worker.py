@@ -5,7 +5,7 @@ import os
 
 from tornado import web
 
-from .core import RequestHandler, MyApp, Resources
+from .core import RequestHandler, MyApp, Resources, Metrics, LoopMonitor
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +30,8 @@ def HTTPWorker(worker):
     application = MyApp(web.Application([
         (r'/info.json', Info, {'server': worker}),
         (r'/resources.json', Resources, {'server': worker}),
+        (r'/metrics.json', Metrics, {'server': worker}),
+        (r'/loop.json', LoopMonitor, {'server': worker}),
         (r'/files.json', LocalFiles, {'server': worker})
         ]))
     return application
@@ -0,0 +1,118 @@
+""" Watch the event loop for callbacks that block it
+
+A handler that runs for hundreds of milliseconds without yielding holds up
+every other connection of its server.  ``LoopMonitor`` finds these stalls.
+A periodic callback measures how late the event loop runs it and a watchdog
+thread grabs the Python stack of the event loop thread when it hasn't come
+around for longer than a threshold, so that we see which code held it up.
+"""
+from __future__ import print_function, division, absolute_import
+
+from collections import deque
+import logging
+import sys
+import threading
+from time import time
+import traceback
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .compatibility import get_thread_identity
+from .metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor(object):
+    """ Measure how late the event loop runs and catch long stalls
+
+    Every ``interval`` milliseconds we record in ``lag`` the seconds by which
+    the event loop missed the tick.  When it misses by more than
+    ``stall_threshold`` seconds the watchdog thread takes the stack of the
+    event loop thread and we add ``{'time': ..., 'duration': ..., 'stack':
+    ...}`` to ``stalls``, which holds the most recent ``log_size`` stalls.
+
+    >>> monitor = LoopMonitor(interval=20, stall_threshold=0.25)
+    >>> monitor.start(IOLoop.current())  # doctest: +SKIP
+    >>> monitor.to_dict()  # doctest: +SKIP
+    {'lag': {'count': 500, 'max': 0.31, ...},
+     'stalls': [{'time': 1470000000.0, 'duration': 0.31, 'stack': '...'}]}
+    """
+    def __init__(self, interval=20, stall_threshold=0.25, log_size=100):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.lag = Histogram()
+        self.stalls = deque(maxlen=log_size)
+        self.loop = None
+        self._last = None
+        self._ident = None
+        self._stack = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._callback = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._callback is not None
+
+    def start(self, loop=None):
+        """ Start to tick on loop and to watch it from another thread """
+        if self.running:
+            return
+        self.loop = loop or IOLoop.current()
+        self._last = time()
+        self._ident = None
+        self._stopped = threading.Event()  # one per watchdog thread
+        self._callback = PeriodicCallback(callback=self._tick,
+                                          callback_time=self.interval,
+                                          io_loop=self.loop)
+        self._callback.start()
+        if self.stall_threshold:
+            self._thread = threading.Thread(target=self._watch,
+                                            args=(self._stopped,),
+                                            name='LoopMonitor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._callback.stop()
+        self._callback = None
+        self._stopped.set()
+        self._thread = None
+
+    def _tick(self):
+        now = time()
+        with self._lock:
+            if self._ident is None:
+                self._ident = get_thread_identity()
+            lag = max(now - self._last - self.interval / 1000, 0)
+            stack, self._stack = self._stack, None
+            self._last = now
+        self.lag.add(lag)
+        if self.stall_threshold and lag > self.stall_threshold:
+            logger.warn("Event loop stalled for %.2fs", lag)
+            self.stalls.append({'time': now - lag, 'duration': lag,
+                                'stack': stack})
+
+    def _watch(self, stopped):
+        """ Take the stack of the event loop thread once per stall """
+        taken = None  # the tick after which we took a stack
+        while not stopped.wait(self.stall_threshold / 2):
+            with self._lock:
+                last = self._last
+                if (self._ident is None or taken == last or
+                    time() - last - self.interval / 1000 <
+                    self.stall_threshold):
+                    continue
+                frame = sys._current_frames().get(self._ident)
+                if frame is not None:
+                    self._stack = ''.join(traceback.format_stack(frame))
+                    taken = last
+
+    def to_dict(self):
+        """ Summary of lag and recent stalls, suitable for JSON """
+        return {'lag': self.lag.to_dict(), 'stalls': list(self.stalls)}
@@ -0,0 +1,143 @@
+""" Cheap histograms of per-operation statistics
+
+Servers and rpc objects record how many bytes each message takes and how long
+we spend deserializing it, handling it and serializing and writing the reply.
+Recording must be cheap enough to leave on all the time, so we keep counts in
+fixed-size histograms with logarithmic buckets, in the style of HdrHistogram,
+rather than keeping every value.
+"""
+from __future__ import print_function, division, absolute_import
+
+from math import frexp, ldexp
+
+
+class Histogram(object):
+    """ Histogram of non-negative values with bounded relative error
+
+    Every power of two between ``2 ** min_exponent`` and ``2 ** max_exponent``
+    gets ``sub_buckets`` buckets of equal width.  Quantiles are then accurate
+    to within ``1 / sub_buckets`` of their value, whatever the magnitude.
+    Values outside of this range go into the first or last bucket.  The
+    defaults cover microseconds to hours and bytes to terabytes.
+
+    >>> h = Histogram()
+    >>> for x in [1, 2, 3, 4, 100]:
+    ...     h.add(x)
+    >>> h.count, h.total, h.max
+    (5, 110, 100)
+    >>> h.quantile(0.5)  # doctest: +SKIP
+    3.0625
+    """
+    def __init__(self, sub_buckets=16, min_exponent=-20, max_exponent=44):
+        self.sub_buckets = sub_buckets
+        self.min_exponent = min_exponent
+        self.counts = [0] * ((max_exponent - min_exponent) * sub_buckets + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __str__(self):
+        return '<Histogram: count=%d, mean=%s, max=%s>' % (
+                self.count, self.mean, self.max)
+
+    __repr__ = __str__
+
+    def index(self, value):
+        """ Index of the bucket of value, bucket 0 holds zero """
+        if value <= 0:
+            return 0
+        mantissa, exponent = frexp(value)  # 0.5 <= mantissa < 1
+        i = ((exponent - self.min_exponent) * self.sub_buckets +
+             int((mantissa - 0.5) * 2 * self.sub_buckets) + 1)
+        if i < 1:
+            return 1
+        if i >= len(self.counts):
+            return len(self.counts) - 1
+        return i
+
+    def bounds(self, i):
+        """ Lower and upper bound of bucket i """
+        if i == 0:
+            return 0, 0
+        exponent, k = divmod(i - 1, self.sub_buckets)
+        exponent += self.min_exponent
+        step = 0.5 / self.sub_buckets
+        return (ldexp(0.5 + k * step, exponent),
+                ldexp(0.5 + (k + 1) * step, exponent))
+
+    def add(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        """ Approximate q-quantile, the middle of its bucket """
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                lower, upper = self.bounds(i)
+                return min(max((lower + upper) / 2, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """ Summary statistics, suitable for JSON """
+        return {'count': self.count, 'total': self.total, 'mean': self.mean,
+                'min': self.min, 'max': self.max,
+                '50%': self.quantile(0.5), '90%': self.quantile(0.9),
+                '99%': self.quantile(0.99)}
+
+
+class Metrics(object):
+    """ Histograms of statistics per operation
+
+    >>> m = Metrics()
+    >>> m.add('get_data', 'handler', 0.002)
+    >>> m.add('get_data', 'bytes-out', 10000)
+    >>> m.ops['get_data']['handler'].count
+    1
+
+    Servers record the following statistics per operation:
+
+    *  **bytes-in**, **bytes-out**: Size of request and reply on the wire
+    *  **deserialize**: Seconds to turn the request into Python objects
+    *  **handler**: Seconds in the handler
+    *  **serialize**: Seconds to serialize the reply and write it out
+
+    rpc objects record **latency**, the seconds from sending a request to
+    getting the reply, instead of **handler**.  Their **bytes-out** and
+    **serialize** are about the request and their **bytes-in** and
+    **deserialize** about the reply.
+
+    The scheduler records **stall** for ``update-graph``, the seconds that it
+    holds on to the event loop at a time while it takes in a new graph.
+    """
+    def __init__(self):
+        self.ops = dict()
+
+    def add(self, op, name, value):
+        try:
+            hist = self.ops[op][name]
+        except KeyError:
+            hist = self.ops.setdefault(op, dict())[name] = Histogram()
+        hist.add(value)
+
+    def to_dict(self):
+        return {op: {name: hist.to_dict() for name, hist in hists.items()}
+                for op, hists in self.ops.items()}
@@ -23,7 +23,8 @@ class Nanny(Server):
     them as necessary.
     """
     def __init__(self, center_ip, center_port, ip=None,
-                ncores=None, loop=None, local_dir=None, services=None, **kwargs):
+                ncores=None, loop=None, local_dir=None, services=None,
+                memory_limit=None, resources=None, **kwargs):
         self.ip = ip or get_ip()
         self.worker_port = None
         self.ncores = ncores
@@ -34,6 +35,8 @@ class Nanny(Server):
         self.loop = loop or IOLoop.current()
         self.center = rpc(ip=center_ip, port=center_port)
         self.services = services
+        self.memory_limit = memory_limit
+        self.resources = resources
 
         handlers = {'instantiate': self.instantiate,
                     'kill': self._kill,
@@ -99,7 +102,8 @@ class Nanny(Server):
         self.process = Process(target=run_worker,
                                args=(q, self.ip, self.center.ip,
                                      self.center.port, self.ncores,
-                                     self.port, self.local_dir, self.services))
+                                     self.port, self.local_dir, self.services,
+                                     self.memory_limit, self.resources))
         self.process.daemon = True
         self.process.start()
         while True:
@@ -178,7 +182,7 @@ class Nanny(Server):
 
 
 def run_worker(q, ip, center_ip, center_port, ncores, nanny_port,
-        local_dir, services):
+        local_dir, services, memory_limit, resources):
     """ Function run by the Nanny when creating the worker """
     from distributed import Worker  # pragma: no cover
     from tornado.ioloop import IOLoop  # pragma: no cover
@@ -187,7 +191,9 @@ def run_worker(q, ip, center_ip, center_port, ncores, nanny_port,
     loop.make_current()  # pragma: no cover
     worker = Worker(center_ip, center_port, ncores=ncores, ip=ip,
                     service_ports={'nanny': nanny_port}, local_dir=local_dir,
-                    services=services)  # pragma: no cover
+                    services=services,
+                    memory_limit=memory_limit,
+                    resources=resources)  # pragma: no cover
 
     @gen.coroutine  # pragma: no cover
     def start():
@@ -0,0 +1,417 @@
+""" Serialization of messages for the wire
+
+Messages are normally pickled into a single bytestring.  When a stream speaks
+a framed protocol (see ``core.connect``) we serialize messages into a list of
+frames instead.
+
+The first frame holds the message itself.  Its first byte names the
+serializer that produced the rest of it:
+
+*  ``b'M'``: ``marshal``, used for plain control messages made only of dicts,
+   lists, tuples, strings and numbers, like ``{'op': 'compute', 'key': ...}``
+*  ``b'P'``: ``cloudpickle``, used for everything else
+
+Large buffers found within pickled messages, like the data of NumPy arrays or
+of the blocks of a Pandas DataFrame, are left out of the pickle and travel as
+frames of their own.  This avoids copying those buffers into the pickle on the
+sending side and copying them out of it again on the receiving side.  The
+reference left in the pickle names the serializer that produced those frames.
+Users can add serializers for their own types with ``register_serializer``.
+
+Finally large frames that compress well may be compressed with lz4, blosc or
+zlib, see ``compress_frames``.  Messages with compressed frames start with an
+extra frame whose first byte is ``b'C'`` and that lists the compression used
+for each of the other frames.
+"""
+from __future__ import print_function, division, absolute_import
+
+from functools import partial
+from io import BytesIO
+import logging
+import marshal
+import pickle
+import zlib
+
+import cloudpickle
+
+from .compatibility import unicode, long
+from .utils import ignoring
+
+
+logger = logging.getLogger(__name__)
+
+
+# Buffers with at least this many bytes travel out-of-band as separate frames
+BIG_BUFFER = 2**17
+
+
+def dumps(x):
+    """ Serialize object into a single bytestring """
+    try:
+        return cloudpickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        logger.info("Failed to serialize %s", x, exc_info=True)
+        raise
+
+
+def loads(x):
+    """ Deserialize a single bytestring """
+    try:
+        return cloudpickle.loads(x)
+    except Exception:
+        logger.info("Failed to deserialize %s", x, exc_info=True)
+        raise
+
+
+def dumps_msg(msg, compression=None):
+    """ Serialize message into a list of frames
+
+    Plain control messages are marshalled into a single frame.  Other
+    messages are pickled.  Large NumPy arrays, bytestrings and objects of
+    types registered with ``register_serializer`` are replaced in that pickle
+    by references to subsequent frames which hold their data.
+
+    Large frames are compressed with ``compression`` if given and if they
+    compress well.  See ``compress_frames``.
+
+    >>> dumps_msg({'op': 'ping'})  # doctest: +SKIP
+    [b'M...']
+    >>> frames = dumps_msg({'x': b'0' * 1000000})
+    >>> len(frames)
+    2
+
+    See Also
+    --------
+    loads_msg
+    """
+    try:
+        plain = _is_plain(msg)
+    except RuntimeError:  # deeply nested
+        plain = False
+    if plain:
+        frames = [b'M' + marshal.dumps(msg)]
+        if compression and len(frames[0]) >= COMPRESSION_MIN:
+            frames = compress_frames(frames, compression)
+        return frames
+
+    frames = [None]
+    f = BytesIO()
+    f.write(b'P')
+    pickler = cloudpickle.CloudPickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = partial(_persistent_id, frames, {})
+    try:
+        pickler.dump(msg)
+    except Exception:
+        logger.info("Failed to serialize %s", msg, exc_info=True)
+        raise
+    frames[0] = f.getvalue()
+    if compression:
+        frames = compress_frames(frames, compression)
+    return frames
+
+
+def loads_msg(frames):
+    """ Deserialize a list of frames produced by ``dumps_msg``
+
+    NumPy arrays are rebuilt directly on top of the received frames.
+    ``core.read_frames`` reads their frames into writable buffers, so tasks
+    may change the arrays in place.  We only copy frames that are read-only,
+    like those that we decompress here.
+
+    See Also
+    --------
+    dumps_msg
+    """
+    header = frames[0][:1]
+    try:
+        if header == b'M':
+            return marshal.loads(frames[0][1:])
+        elif header == b'P':
+            f = BytesIO(frames[0])
+            f.seek(1)
+            unpickler = pickle.Unpickler(f)
+            unpickler.persistent_load = partial(_persistent_load, frames, {})
+            return unpickler.load()
+        elif header == b'C':
+            names = marshal.loads(frames[0][1:])
+            # not all decompressors take the bytearrays of read_frames
+            frames = [compressions[name]['decompress'](bytes(frame)) if name
+                      else frame for name, frame in zip(names, frames[1:])]
+            frames[0] = bytes(frames[0])  # the header of the inner message
+        else:
+            raise ValueError("Unknown serializer %r" % header)
+    except Exception:
+        logger.info("Failed to deserialize %s", frames[0][:1000],
+                    exc_info=True)
+        raise
+    return loads_msg(frames)
+
+
+_atom_types = {int, long, float, complex, bool, type(None), unicode}
+
+
+def _is_plain(o):
+    """ Can we marshal this object without losing anything?
+
+    Marshal quietly turns subclasses of builtins and buffers like NumPy
+    scalars or memoryviews into their base types, so we only accept the exact
+    builtin types here.  Large bytestrings are left to the pickle path where
+    they travel out-of-band.
+    """
+    typ = type(o)
+    if typ in _atom_types:
+        return True
+    if typ is bytes:
+        return len(o) < BIG_BUFFER
+    if typ is dict:
+        return all(map(_is_plain, o)) and all(map(_is_plain, o.values()))
+    if typ is list or typ is tuple or typ is set or typ is frozenset:
+        return all(map(_is_plain, o))
+    return False
+
+
+# Map from serializer name to a (dumps, loads) pair.  See register_serializer.
+serializers = dict()
+
+# Map from type to serializer name, see register_serializer
+serializer_types = dict()
+
+# Cache of serializer lookups for types and their subclasses
+_dispatch_cache = dict()
+
+
+def register_serializer(cls, name, dumps, loads):
+    """ Register out-of-band serialization for a type
+
+    Objects of type ``cls`` (or of a subclass) found within a message are
+    serialized with ``dumps(obj)``.  This returns a tuple of a small picklable
+    header and a list of frames (bytes or memoryviews), or None to fall back
+    to pickle for this particular object.  On the receiving end
+    ``loads(header, frames)`` rebuilds the object.
+
+    >>> def dumps_mytype(obj):  # doctest: +SKIP
+    ...     return {'shape': obj.shape}, [obj.data]
+    >>> def loads_mytype(header, frames):  # doctest: +SKIP
+    ...     return MyType(header['shape'], frames[0])
+    >>> register_serializer(MyType, 'mytype', dumps_mytype, loads_mytype)  # doctest: +SKIP
+
+    The serializer must be registered under the same name on all processes.
+    """
+    serializers[name] = (dumps, loads)
+    serializer_types[cls] = name
+    _dispatch_cache.clear()
+
+
+def _dispatch(typ):
+    """ Find the serializer name for a type, walking its method resolution """
+    try:
+        return _dispatch_cache[typ]
+    except KeyError:
+        pass
+    name = None
+    for base in getattr(typ, '__mro__', ()):
+        if base in serializer_types:
+            name = serializer_types[base]
+            break
+    _dispatch_cache[typ] = name
+    return name
+
+
+def _persistent_id(frames, seen, obj):
+    """ Pull objects with registered serializers out of the pickle stream
+
+    Used as the ``persistent_id`` of the pickler within ``dumps_msg``.
+    Appends the frames of the object to ``frames`` and returns a reference
+    ``(name, header, start, stop)`` to them.  Returns None for all other
+    objects which are then pickled as usual.
+    """
+    try:
+        name = _dispatch_cache[type(obj)]
+    except KeyError:
+        name = _dispatch(type(obj))
+    if name is None:
+        return None
+    key = id(obj)
+    if key in seen:
+        return seen[key][0]
+    result = serializers[name][0](obj)
+    if result is None:
+        return None
+    header, obj_frames = result
+    start = len(frames)
+    frames.extend(obj_frames)
+    pid = (name, header, start, len(frames))
+    seen[key] = (pid, obj)  # keep obj alive for its id
+    return pid
+
+
+def _persistent_load(frames, cache, pid):
+    """ Rebuild an object from the frames that a persistent id references
+
+    Used as the ``persistent_load`` of the unpickler within ``loads_msg``.
+    """
+    name, header, start, stop = pid
+    if start not in cache:
+        loads = serializers[name][1]
+        cache[start] = loads(header, frames[start:stop])
+    return cache[start]
+
+
+def _serialize_bytes(b):
+    if len(b) < BIG_BUFFER or type(b) is not bytes:
+        return None
+    return None, [b]
+
+
+def _deserialize_bytes(header, frames):
+    return bytes(frames[0])  # read_frames gives us a bytearray
+
+
+register_serializer(bytes, 'bytes', _serialize_bytes, _deserialize_bytes)
+
+
+with ignoring(ImportError):
+    import numpy as np
+
+    def _serialize_numpy_ndarray(x):
+        if (x.nbytes < BIG_BUFFER or x.dtype.hasobject or
+                x.dtype.fields is not None or type(x) is not np.ndarray):
+            return None
+        if x.flags.c_contiguous:
+            order = 'C'
+        elif x.flags.f_contiguous:
+            order = 'F'
+        else:
+            return None
+        data = memoryview(x.ravel(order=order).view(np.uint8))
+        return (x.dtype.str, x.shape, order), [data]
+
+    def _deserialize_numpy_ndarray(header, frames):
+        dtype, shape, order = header
+        frame = frames[0]
+        if memoryview(frame).readonly:  # decompressed, but tasks may write
+            frame = bytearray(frame)    # to their inputs
+        x = np.frombuffer(frame, dtype=dtype)
+        return x.reshape(shape, order=order)
+
+    register_serializer(np.ndarray, 'numpy.ndarray',
+                        _serialize_numpy_ndarray, _deserialize_numpy_ndarray)
+
+
+# Frames with fewer bytes than this are never compressed
+COMPRESSION_MIN = 10000
+
+# Only keep the compressed frame if it is at most this fraction of the original
+COMPRESSION_RATIO = 0.9
+
+# Bytes taken from large frames to check whether they compress well
+COMPRESSION_SAMPLE = 10000
+
+# Map from compression name to compress and decompress functions
+compressions = {'zlib': {'compress': lambda b: zlib.compress(b, 1),
+                         'decompress': zlib.decompress}}
+
+# Order in which ``compression='auto'`` picks from the available compressions
+default_compressions = ['lz4', 'blosc', 'zlib']
+
+
+with ignoring(ImportError):
+    try:
+        from lz4.block import (compress as lz4_compress,
+                               decompress as lz4_decompress)
+    except ImportError:  # older lz4
+        from lz4 import (LZ4_compress as lz4_compress,
+                         LZ4_uncompress as lz4_decompress)
+
+    compressions['lz4'] = {'compress': lz4_compress,
+                           'decompress': lz4_decompress}
+
+
+with ignoring(ImportError):
+    import blosc
+
+    def _blosc_compress(b):
+        if len(b) > blosc.MAX_BUFFERSIZE:
+            return b
+        return blosc.compress(b, typesize=8, clevel=5, cname='lz4')
+
+    compressions['blosc'] = {'compress': _blosc_compress,
+                             'decompress': blosc.decompress}
+
+
+def choose_compression(setting, available):
+    """ Choose the compression with which to write to a peer
+
+    Parameters
+    ----------
+    setting: str or None
+        Name of a compression, ``'auto'`` for the best available compression
+        or None to never compress
+    available: sequence of str
+        The compressions that the peer can decompress
+
+    >>> choose_compression('auto', ['zlib'])
+    'zlib'
+    >>> choose_compression('zlib', ['lz4'])  # returns None
+    """
+    if setting == 'auto':
+        candidates = default_compressions
+    elif setting is None:
+        return None
+    elif setting not in compressions:
+        raise ValueError("Unknown compression %r, choose one of %s"
+                         % (setting, sorted(compressions)))
+    else:
+        candidates = [setting]
+    for name in candidates:
+        if name in compressions and name in available:
+            return name
+    return None
+
+
+def maybe_compress(frame, compression):
+    """ Compress frame if it is large and compresses well
+
+    We first compress a few samples from large frames and only compress the
+    entire frame if the samples shrink.
+
+    Returns the name of the compression used, or None, and the frame.
+    """
+    n = len(frame)
+    if n < COMPRESSION_MIN:
+        return None, frame
+    compress = compressions[compression]['compress']
+    if n > 10 * COMPRESSION_SAMPLE:
+        view = memoryview(frame)
+        k = COMPRESSION_SAMPLE // 5
+        step = (n - k) // 4
+        sample = b''.join([view[i: i + k].tobytes()
+                           for i in range(0, 5 * step, step)])
+        if len(compress(sample)) > COMPRESSION_RATIO * len(sample):
+            return None, frame
+    compressed = compress(frame)
+    if len(compressed) > COMPRESSION_RATIO * n:
+        return None, frame
+    return compression, compressed
+
+
+def compress_frames(frames, compression):
+    """ Compress the large frames of a message that compress well
+
+    Returns the frames unchanged if we compress none of them.  Otherwise
+    returns a header frame, listing the compression used for each frame,
+    followed by the frames.
+
+    See Also
+    --------
+    maybe_compress
+    loads_msg
+    """
+    names, out = [], []
+    for frame in frames:
+        name, frame = maybe_compress(frame, compression)
+        names.append(name)
+        out.append(frame)
+    if not any(names):
+        return frames
+    return [b'C' + marshal.dumps(names)] + out
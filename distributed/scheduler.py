@@ -1,15 +1,18 @@
 from __future__ import print_function, division, absolute_import
 
-from collections import defaultdict, deque
+from collections import defaultdict, deque, Mapping, Set
 from datetime import datetime
 from functools import partial
+from itertools import chain, islice
+import heapq
 import logging
 from math import ceil
+from operator import attrgetter
 import socket
 from time import time
 import uuid
 
-from toolz import frequencies, memoize, concat, identity, valmap
+from toolz import frequencies, memoize, concat, valmap, assoc
 from tornado import gen
 from tornado.gen import Return
 from tornado.queues import Queue
@@ -18,19 +21,279 @@ from tornado.iostream import StreamClosedError, IOStream
 
 from dask.compatibility import apply
 from dask.core import get_deps, reverse_dict, istask
-from dask.order import order
 
+from .batched import BatchedSend
 from .core import (rpc, coerce_to_rpc, connect, read, write, MAX_BUFFER_SIZE,
         Server, send_recv, dumps)
 from .client import (unpack_remotedata, scatter_to_workers,
         gather_from_workers, broadcast_to_workers)
+from .transport import InProcStream
 from .utils import (All, ignoring, clear_queue, _deps, get_ip,
-        ignore_exceptions, ensure_ip, get_traceback, truncate_exception)
+        ignore_exceptions, ensure_ip, get_traceback, truncate_exception,
+        key_split, gc_paused)
 
 
 logger = logging.getLogger(__name__)
 
 
+_no_states = frozenset()  # shared by all empty sets of states, see TaskState
+
+
+class TaskState(object):
+    """ Everything that the scheduler knows about one key
+
+    Tasks refer directly to the states of their dependencies, dependents and
+    workers, so the scheduler follows references rather than looking keys up
+    in many dictionaries.  We have millions of these so we use ``__slots__``.
+    Sets of states that are often empty, like the dependencies of leaves,
+    start out as the shared ``_no_states``.  Replace it with a new set before
+    adding to it.
+
+    * **key:** The key of the task
+    * **run_spec:** The task as in ``Scheduler.tasks``, None for keys that we
+      only know as data or as dependencies of other tasks
+    * **dependencies:** ``{TaskState}``
+    * **dependents:** ``{TaskState}``
+    * **waiting_on:** ``{TaskState}``:
+        Dependencies that are not in memory yet, None unless we wait for them
+    * **waiters:** ``{TaskState}``:
+        Dependents that still need our data, None unless we track them.  See
+        ``Scheduler.waiting_data``
+    * **who_has:** ``{WorkerState}``
+    * **who_wants:** ``{client}``
+    * **nbytes:** ``int``
+    * **priority:** ``tuple``: See ``Scheduler.prioritize``
+    * **client:** The client that submitted the task, for fair share
+    * **restrictions:** ``{hostname}`` or None
+    * **loose_restrictions:** ``bool``
+    * **resources:** ``{str: float}`` or None:
+        Amounts of abstract resources that the task holds while it runs, see
+        ``WorkerState.resources``
+    * **exception**, **traceback:** What went wrong if the task failed
+    * **exception_blame:** ``TaskState``: The failed task that we blame
+    * **in_play:** ``bool``: Whether the key will eventually be in memory
+    * **processing_on:** ``WorkerState``: The worker computing the task
+    * **duration:** ``float``:
+        Expected seconds of the task while in a stack or processing
+    """
+    __slots__ = ('key', 'run_spec', 'dependencies', 'dependents', 'waiting_on',
+                 'waiters', 'who_has', 'who_wants', 'nbytes', 'priority',
+                 'client',
+                 'restrictions', 'loose_restrictions', 'resources',
+                 'exception', 'traceback', 'exception_blame', 'in_play',
+                 'processing_on', 'duration')
+
+    def __init__(self, key, run_spec=None):
+        self.key = key
+        self.run_spec = run_spec
+        self.dependencies = _no_states
+        self.dependents = _no_states
+        self.waiting_on = None
+        self.waiters = None
+        self.who_has = _no_states
+        self.who_wants = _no_states
+        self.nbytes = None
+        self.priority = None
+        self.client = None
+        self.restrictions = None
+        self.loose_restrictions = False
+        self.resources = None
+        self.exception = None
+        self.traceback = None
+        self.exception_blame = None
+        self.in_play = False
+        self.processing_on = None
+        self.duration = None
+
+    def __str__(self):
+        return '<TaskState: %s>' % str(self.key)
+
+    __repr__ = __str__
+
+
+class WorkerState(object):
+    """ Everything that the scheduler knows about one worker
+
+    * **address:** ``(ip, port)``
+    * **ncores:** ``int``
+    * **services:** ``{str: port}``
+    * **has_what:** ``{TaskState}``: Keys in the memory of the worker
+    * **processing:** ``{TaskState}``: Tasks that the worker computes
+    * **stack:** ``[TaskState]``:
+        Tasks that we will send to the worker, the last one first
+    * **stack_duration:** ``float``: Expected seconds of work in the stack
+    * **processing_duration:** ``float``:
+        Expected seconds of work in processing
+    * **nbytes:** ``int``: Bytes of the data in ``has_what``
+    * **memory_limit:** ``int``:
+        Bytes of data that the worker may hold, None for no limit
+    * **resources:** ``{str: float}``:
+        Amounts of abstract resources like ``{'GPU': 2}`` that the worker
+        has.  Tasks that need them only run while enough are free.
+    * **clients:** ``{client: int}``:
+        Number of tasks of each client in ``stack``, see
+        ``Scheduler.client_stacked``
+    """
+    __slots__ = ('address', 'ncores', 'services', 'has_what', 'processing',
+                 'stack', 'stack_duration', 'processing_duration', 'nbytes',
+                 'memory_limit', 'resources', 'clients')
+
+    def __init__(self, address, ncores=None, services=None,
+                 memory_limit=None, resources=None):
+        self.address = address
+        self.ncores = ncores
+        self.services = services or {}
+        self.memory_limit = memory_limit
+        self.resources = resources or {}
+        self.nbytes = 0
+        self.has_what = set()
+        self.processing = set()
+        self.stack = []
+        self.stack_duration = 0
+        self.processing_duration = 0
+        self.clients = dict()
+
+    def __str__(self):
+        return '<WorkerState: %s>' % str(self.address)
+
+    __repr__ = __str__
+
+
+class StateView(Mapping):
+    """ Read-only ``{key: value}`` view on an attribute of many states
+
+    ``get`` computes the value for a state, on every access.  The view only
+    holds the states for which ``has`` is true, all of them by default.  Like
+    a ``defaultdict`` we return ``missing()`` for other keys if given, but
+    we don't add them.
+
+    Lookups cost as much as one access to ``states``.  With ``has`` given,
+    ``len`` walks over all states, so code that runs often should count
+    what it needs on the states themselves.  Views pickle as plain dicts so
+    that ``feed`` functions and diagnostics may send them.
+
+    >>> states = {'x': TaskState('x', 1), 'y': TaskState('y')}
+    >>> tasks = StateView(states, attrgetter('run_spec'),
+    ...                   lambda ts: ts.run_spec is not None)
+    >>> dict(tasks)
+    {'x': 1}
+    """
+    def __init__(self, states, get, has=None, missing=None):
+        self.states = states
+        self.get_value = get
+        self.filtered = has is not None
+        self.has = has or (lambda state: True)
+        self.missing = missing
+
+    def __getitem__(self, key):
+        state = self.states.get(key)
+        if state is None or not self.has(state):
+            if self.missing is not None:
+                return self.missing()
+            raise KeyError(key)
+        return self.get_value(state)
+
+    def get(self, key, default=None):
+        state = self.states.get(key)
+        if state is None or not self.has(state):
+            return default
+        return self.get_value(state)
+
+    def __contains__(self, key):
+        state = self.states.get(key)
+        return state is not None and bool(self.has(state))
+
+    def __iter__(self):
+        has = self.has
+        return (key for key, state in self.states.items() if has(state))
+
+    def __len__(self):
+        if not self.filtered:
+            return len(self.states)
+        return sum(1 for key in self)
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __str__(self):
+        return str(dict(self))
+
+    __repr__ = __str__
+
+
+class StateSetView(Set):
+    """ Read-only set of the keys of the states for which ``has`` is true
+
+    Like ``StateView`` its ``len`` walks over all states and it pickles as a
+    plain set.
+    """
+    def __init__(self, states, has):
+        self.states = states
+        self.has = has
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, key):
+        state = self.states.get(key)
+        return state is not None and bool(self.has(state))
+
+    def __iter__(self):
+        has = self.has
+        return (key for key, state in self.states.items() if has(state))
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __reduce__(self):
+        return (set, (list(self),))
+
+    def __str__(self):
+        return str(set(self))
+
+    __repr__ = __str__
+
+
+def _view(states, get, has=None, missing=None):
+    """ Property with a ``StateView`` on the ``states`` attribute """
+    return property(lambda self: StateView(getattr(self, states), get, has,
+                                           missing))
+
+
+def _set_view(states, has):
+    """ Property with a ``StateSetView`` on the ``states`` attribute """
+    return property(lambda self: StateSetView(getattr(self, states), has))
+
+
+def _not_none(attr):
+    get = attrgetter(attr)
+    return lambda state: get(state) is not None
+
+
+def _priority(ts):
+    """ Priority as a sort key, () for tasks that don't have one yet """
+    return ts.priority or ()
+
+
+def _level(ts):
+    """ Negated user priority of a task, lower runs first """
+    return ts.priority[0] if ts.priority else 0
+
+
+def _exhaust(steps):
+    """ Run the steps of a chunked operation without pausing """
+    for _ in steps:
+        pass
+
+
+def _keys(states):
+    return {state.key for state in states}
+
+
 class Scheduler(Server):
     """ Dynamic distributed task scheduler
 
@@ -65,6 +328,15 @@ class Scheduler(Server):
 
     **State**
 
+    The scheduler keeps a ``TaskState`` per key in ``task_states``, a
+    ``WorkerState`` per worker in ``worker_states`` and the states of the keys
+    that each client wants in ``client_wants``.  These refer to each other
+    directly, see the ``TaskState`` and ``WorkerState`` docstrings.
+
+    The following read-only properties view this state as dictionaries and
+    sets of keys and worker addresses, for plugins, diagnostics and tests.
+    They compute their values on access.
+
     * **tasks:** ``{key: task}``:
         Dictionary mapping key to task, either dask task, or serialized dict
         like: ``{'function': b'xxx', 'args': b'xxx'}`` or ``{'task': b'xxx'}``
@@ -78,8 +350,6 @@ class Scheduler(Server):
         Dictionary like dependents but excludes keys already computed
     * **ncores:** ``{worker: int}``:
         Number of cores owned by each worker
-    * **services:** ``{str: port}``:
-        Other services running on this scheduler, like HTTP
     * **worker_services:** ``{worker: {str: port}}``:
         Ports of other running services on each worker.
         E.g. ``{('192.168.1.100', 8000): {'http': 9001, 'nanny': 9002}}``
@@ -97,6 +367,13 @@ class Scheduler(Server):
         Set of keys currently in execution on each worker
     * **stacks:** ``{worker: [keys]}``:
         List of keys waiting to be sent to each worker
+    * **assigned_duration:** ``{key: float}``:
+        Expected seconds of each key in a stack or processing, as estimated
+        when we assigned it to a worker
+    * **stack_duration:** ``{worker: float}``:
+        Expected seconds of work in each worker's stack
+    * **processing_duration:** ``{worker: float}``:
+        Expected seconds of work currently processing on each worker
     * **retrictions:** ``{key: {hostnames}}``:
         A set of hostnames per key of where that key can be run.  Usually this
         is empty unless a key has been specifically restricted to only run on
@@ -105,35 +382,110 @@ class Scheduler(Server):
     * **loose_retrictions:** ``{key}``:
         Set of keys for which we are allow to violate restrictions (see above)
         if not valid workers are present.
+    * **resources:** ``{key: {resource: float}}``:
+        Amounts of abstract resources that each key holds while it runs.  Such
+        keys only run on workers that have these resources and only while
+        enough of them are free, see ``Scheduler.ensure_occupied``.
     * **in_play:** ``{key}``:
         All keys in one of who_has, waiting, stacks, processing.  This is any
         key that will eventually be in memory.
     * **keyorder:** ``{key: tuple}``:
-        A score per key that determines its priority
-    * **scheduler_queues:** ``[Queues]``:
-        A list of Tornado Queues from which we accept stimuli
-    * **report_queues:** ``[Queues]``:
-        A list of Tornado Queues on which we report results
-    * **streams:** ``[IOStreams]``:
-        A list of Tornado IOStreams from which we both accept stimuli and
-        report results
-    * **coroutines:** ``[Futures]``:
-        A list of active futures that control operation
+        A score per key that determines its priority, lower runs first.  See
+        ``Scheduler.prioritize``.
+    * **clients:** ``{key: client}``:
+        The client that submitted each task
     *  **exceptions:** ``{key: Exception}``:
         A dict mapping keys to remote exceptions
     *  **tracebacks:** ``{key: list}``:
         A dict mapping keys to remote tracebacks stored as a list of strings
     *  **exceptions_blame:** ``{key: key}``:
         A dict mapping a key to another key on which it depends that has failed
+
+    The scheduler also has the following state of its own:
+
+    * **task_duration:** ``{key-prefix: float}``:
+        Exponentially weighted average of how many seconds tasks took, by the
+        ``key_split`` prefix of their keys.  Tasks with unknown prefixes count
+        as ``default_duration`` seconds.
+    * **occupancy:** ``OccupancyIndex``:
+        Heap of workers by expected seconds of work per core, see
+        ``Scheduler.worker_cost``, for picking the least busy worker
+    * **full_workers:** ``{worker}``:
+        Workers that hold ``memory_threshold`` of their memory limit or more.
+        We don't give them new tasks while other workers have room.
+    * **services:** ``{str: port}``:
+        Other services running on this scheduler, like HTTP
+    * **generation:** ``int``:
+        Number of the next submission, older submissions take precedence
+    * **epoch:** ``int``:
+        Number of times that we lost workers or healed our state.  Chunked
+        operations check it after every pause, see ``Scheduler.update_graph``.
+    * **client_processing:** ``{client: int}``:
+        Number of tasks that each client has processing on workers, one core
+        each.  Clients with fewer of them go first, see
+        ``Scheduler.ensure_occupied``.
+    * **client_stacked:** ``{client: int}``:
+        Number of tasks that each client has in the stacks of workers.  Only
+        clients with tasks stacked or processing count for fair share.
+    * **scheduler_queues:** ``[Queues]``:
+        A list of Tornado Queues from which we accept stimuli
+    * **report_queues:** ``[Queues]``:
+        A list of Tornado Queues on which we report results
+    * **streams:** ``{client: BatchedSend}``:
+        Batched streams over which we report results to clients, whose
+        requests come in on the same IOStreams.  See ``Scheduler.report``.
+    * **coroutines:** ``[Futures]``:
+        A list of active futures that control operation
     *  **deleted_keys:** ``{key: {workers}}``
         Locations of workers that have keys that should be deleted
     *  **loop:** ``IOLoop``:
         The running Torando IOLoop
+    *  **compression:** ``str``:
+        Compression for large frames sent to workers and clients, one of
+        ``'auto'``, ``'lz4'``, ``'blosc'``, ``'zlib'`` or None
+    *  **worker_streams:** ``{worker: BatchedSend}``:
+        Batched streams over which we send ``compute-task`` messages
+    *  **batch_interval:** ``float``:
+        Milliseconds over which we batch messages to workers and clients
+    *  **memory_threshold:** ``float``:
+        Fraction of its memory limit at which a worker counts as full
+    *  **memory_interval:** ``float``:
+        Milliseconds between attempts to move data off full workers, see
+        ``Scheduler.rebalance_memory``.  Zero or None turns this off.
+    *  **loop_interval:** ``float``:
+        Milliseconds between ticks of the ``LoopMonitor`` that watches our
+        event loop for stalls, see ``Server``.  None turns it off.
+    *  **fair_window:** ``int``:
+        Number of tasks at the top of a stack among which we look for those
+        of clients that get less than their share of cores
+    *  **report_limit:** ``int``:
+        Reports waiting to go to a client at which we stop reading requests
+        from that client until it catches up
+    *  **saturation:** ``int``:
+        Number of tasks to queue up on each worker beyond its number of cores
+    *  **queue_duration:** ``float``:
+        Seconds of work per core to queue up on each worker, at most
+        ``saturation`` tasks beyond its number of cores
+    *  **steal_interval:** ``float``:
+        Milliseconds between attempts to move tasks from the stacks of busy
+        workers to idle workers, see ``Scheduler.steal_work``.  Zero or None
+        turns off work stealing.
+    *  **steal_log:** ``deque``:
+        Recently stolen tasks as ``(time, key, victim, thief)`` tuples
+    *  **bandwidth:** ``float``:
+        Bytes per second that we expect to move between workers
+    *  **graph_chunk_size:** ``int``:
+        Steps of work on a new graph between which ``update_graph`` yields to
+        the event loop, see ``Scheduler.update_graph``
     """
     def __init__(self, center=None, loop=None,
             resource_interval=1, resource_log_size=1000,
             max_buffer_size=MAX_BUFFER_SIZE, delete_interval=500,
-            ip=None, services=None, **kwargs):
+            ip=None, services=None, compression='auto', batch_interval=2,
+            saturation=16, queue_duration=1.0, steal_interval=100,
+            graph_chunk_size=10000, report_limit=10000,
+            memory_threshold=0.8, memory_interval=1000, fair_window=1000,
+            loop_interval=20, **kwargs):
         self.scheduler_queues = [Queue()]
         self.report_queues = []
         self.streams = dict()
@@ -141,36 +493,37 @@ class Scheduler(Server):
         self.coroutines = []
         self.ip = ip or get_ip()
         self.delete_interval = delete_interval
+        self.batch_interval = batch_interval
+        self.saturation = saturation
+        self.queue_duration = queue_duration
+        self.steal_interval = steal_interval
+        self.graph_chunk_size = graph_chunk_size
+        self.report_limit = report_limit
+        self.memory_threshold = memory_threshold
+        self.memory_interval = memory_interval
+        self.fair_window = fair_window
+        self.full_workers = set()
+        self._rebalancing = False
+        self.steal_log = deque(maxlen=10000)
+        self.bandwidth = 100e6
+        self.worker_streams = dict()
 
         if center:
             self.center = coerce_to_rpc(center)
         else:
             self.center = None
 
-        self.tasks = dict()
-        self.dependencies = dict()
-        self.dependents = dict()
+        self.task_states = dict()
+        self.worker_states = dict()
+        self.client_wants = defaultdict(set)
+        self.client_processing = defaultdict(int)
+        self.client_stacked = dict()
         self.generation = 0
-        self.has_what = defaultdict(set)
-        self.in_play = set()
-        self.keyorder = dict()
-        self.nbytes = dict()
-        self.ncores = dict()
-        self.worker_services = defaultdict(dict)
-        self.processing = dict()
-        self.restrictions = dict()
-        self.loose_restrictions = set()
-        self.stacks = dict()
-        self.waiting = dict()
-        self.waiting_data = dict()
-        self.who_has = defaultdict(set)
+        self.epoch = 0
+        self.task_duration = dict()
+        self.default_duration = 0.5
+        self.occupancy = OccupancyIndex(self.worker_states, self.worker_cost)
         self.deleted_keys = defaultdict(set)
-        self.who_wants = defaultdict(set)
-        self.wants_what = defaultdict(set)
-
-        self.exceptions = dict()
-        self.tracebacks = dict()
-        self.exceptions_blame = dict()
 
         self.loop = loop or IOLoop.current()
         self.io_loop = self.loop
@@ -199,7 +552,8 @@ class Scheduler(Server):
                          'broadcast': self.broadcast,
                          'ncores': self.get_ncores,
                          'has_what': self.get_has_what,
-                         'who_has': self.get_who_has}
+                         'who_has': self.get_who_has,
+                         'client_occupancy': self.get_client_occupancy}
 
         services = services or {}
         self.services = {k: v(self) for k, v in services.items()}
@@ -207,12 +561,134 @@ class Scheduler(Server):
             v.listen(0)
 
         super(Scheduler, self).__init__(handlers=self.handlers,
-                max_buffer_size=max_buffer_size, **kwargs)
+                max_buffer_size=max_buffer_size, compression=compression,
+                loop_interval=loop_interval, **kwargs)
+
+    tasks = _view('task_states', attrgetter('run_spec'), _not_none('run_spec'))
+    dependencies = _view('task_states', lambda ts: _keys(ts.dependencies),
+                         _not_none('run_spec'))
+    dependents = _view('task_states', lambda ts: _keys(ts.dependents),
+                       lambda ts: ts.run_spec is not None or ts.dependents)
+    waiting = _view('task_states', lambda ts: _keys(ts.waiting_on),
+                    _not_none('waiting_on'))
+    waiting_data = _view('task_states', lambda ts: _keys(ts.waiters),
+                         _not_none('waiters'))
+    who_has = _view('task_states',
+                    lambda ts: {ws.address for ws in ts.who_has},
+                    attrgetter('who_has'), set)
+    who_wants = _view('task_states', lambda ts: set(ts.who_wants),
+                      attrgetter('who_wants'), set)
+    nbytes = _view('task_states', attrgetter('nbytes'), _not_none('nbytes'))
+    keyorder = _view('task_states', attrgetter('priority'),
+                     _not_none('priority'))
+    clients = _view('task_states', attrgetter('client'), _not_none('client'))
+    restrictions = _view('task_states', lambda ts: set(ts.restrictions),
+                         _not_none('restrictions'))
+    loose_restrictions = _set_view('task_states',
+                                   attrgetter('loose_restrictions'))
+    resources = _view('task_states', attrgetter('resources'),
+                      _not_none('resources'))
+    in_play = _set_view('task_states', attrgetter('in_play'))
+    exceptions = _view('task_states', attrgetter('exception'),
+                       _not_none('exception'))
+    tracebacks = _view('task_states', attrgetter('traceback'),
+                       _not_none('traceback'))
+    exceptions_blame = _view('task_states', lambda ts: ts.exception_blame.key,
+                             _not_none('exception_blame'))
+    assigned_duration = _view('task_states', attrgetter('duration'),
+                              _not_none('duration'))
+    wants_what = _view('client_wants', _keys, missing=set)
+    ncores = _view('worker_states', attrgetter('ncores'))
+    worker_services = _view('worker_states', attrgetter('services'))
+    has_what = _view('worker_states', lambda ws: _keys(ws.has_what),
+                     missing=set)
+    processing = _view('worker_states', lambda ws: _keys(ws.processing))
+    stacks = _view('worker_states', lambda ws: [ts.key for ts in ws.stack])
+    stack_duration = _view('worker_states', attrgetter('stack_duration'))
+    processing_duration = _view('worker_states',
+                                attrgetter('processing_duration'))
+
+    def task_state(self, key):
+        """ The state of key, new if we don't know key yet """
+        try:
+            return self.task_states[key]
+        except KeyError:
+            ts = self.task_states[key] = TaskState(key)
+            return ts
+
+    def release_state(self, ts):
+        """ Forget the state of a key once nothing refers to it any more """
+        if (ts.run_spec is None and not ts.who_has and not ts.who_wants and
+            not ts.dependents and ts.processing_on is None and
+            self.task_states.get(ts.key) is ts):
+            del self.task_states[ts.key]
+
+    def _add_replica(self, ts, ws):
+        """ Record that worker ws holds the data of task ts """
+        if ws in ts.who_has:
+            return
+        if not ts.who_has:
+            ts.who_has = set()
+        ts.who_has.add(ws)
+        ws.has_what.add(ts)
+        ws.nbytes += ts.nbytes or 0
+        self._check_memory(ws)
+
+    def _remove_replica(self, ts, ws):
+        """ Record that worker ws no longer holds the data of task ts """
+        ts.who_has.remove(ws)
+        if not ts.who_has:
+            ts.who_has = _no_states
+        ws.has_what.remove(ts)
+        ws.nbytes -= ts.nbytes or 0
+        self._check_memory(ws)
+
+    def set_nbytes(self, ts, nbytes):
+        """ Set the size of the data of a task, also on its holders """
+        diff = (nbytes or 0) - (ts.nbytes or 0)
+        ts.nbytes = nbytes
+        for ws in ts.who_has:
+            ws.nbytes += diff
+            self._check_memory(ws)
+
+    def memory_full(self, ws):
+        """ Whether a worker holds ``memory_threshold`` of its memory limit """
+        return (ws.memory_limit is not None and
+                ws.nbytes >= self.memory_threshold * ws.memory_limit)
+
+    def _check_memory(self, ws):
+        """ Keep ``full_workers`` up to date after ws.nbytes changed """
+        if ws.memory_limit is None:
+            return
+        address = ws.address
+        if self.memory_full(ws):
+            self.full_workers.add(address)
+        elif address in self.full_workers:
+            self.full_workers.remove(address)
+            if address in self.worker_states:
+                self.occupancy.update(address)  # it is cheaper now
+
+    def roomy_workers(self):
+        """ Workers that are not full, all of them if all are full """
+        if not self.full_workers:
+            return self.worker_states
+        roomy = {address: ws for address, ws in self.worker_states.items()
+                 if address not in self.full_workers}
+        return roomy or self.worker_states
+
+    def worker_cost(self, worker):
+        """ How much we want to avoid a worker, see ``occupancy``
+
+        Full workers come after all others, then the least busy ones first.
+        """
+        return (worker in self.full_workers, self.worker_load(worker))
 
     def rpc(self, ip, port):
         """ Cached rpc objects """
         if (ip, port) not in self._rpcs:
-            self._rpcs[(ip, port)] = rpc(ip=ip, port=port)
+            self._rpcs[(ip, port)] = rpc(ip=ip, port=port,
+                                         compression=self.compression,
+                                         multiplex=True)
         return self._rpcs[(ip, port)]
 
     @property
@@ -222,7 +698,7 @@ class Scheduler(Server):
     def identity(self, stream):
         """ Basic information about ourselves and our cluster """
         d = {'type': type(self).__name__, 'id': self.id,
-             'workers': list(self.ncores),
+             'workers': list(self.worker_states),
              'services': {key: v.port for (key, v) in self.services.items()}}
         if self.center:
             d['center'] = (self.center.ip, self.center.port)
@@ -234,38 +710,98 @@ class Scheduler(Server):
 
     @gen.coroutine
     def sync_center(self):
-        """ Connect to center, determine available workers """
-        self.ncores, self.has_what, self.who_has, self.worker_services = yield [
-                self.center.ncores(),
-                self.center.has_what(),
-                self.center.who_has(),
-                self.center.worker_services()]
+        """ Connect to center, determine available workers
+
+        We keep the sizes of the keys that we know, so workers hold as many
+        bytes as before and those over their memory limit are full again.
+        """
+        (ncores, who_has, worker_services, memory_limit,
+         resources) = yield [self.center.ncores(), self.center.who_has(),
+                             self.center.worker_services(),
+                             self.center.memory_limit(),
+                             self.center.resources()]
+        for ts in self.task_states.values():
+            ts.who_has = _no_states
+        self.worker_states.clear()
+        self.full_workers.clear()
+        for address, n in ncores.items():
+            self.worker_states[address] = WorkerState(address, n,
+                    worker_services.get(address),
+                    memory_limit=memory_limit.get(address),
+                    resources=resources.get(address))
+        for key, workers in who_has.items():
+            # a worker that the center just dropped may still report keys
+            workers = [self.worker_states[address] for address in workers
+                       if address in self.worker_states]
+            if workers:
+                ts = self.task_state(key)
+                for ws in workers:
+                    self._add_replica(ts, ws)
 
     def start(self, port=8786, start_queues=True):
         """ Clear out old state and restart all running coroutines """
-        collections = [self.tasks, self.dependencies, self.dependents,
-                self.waiting, self.waiting_data, self.in_play, self.keyorder,
-                self.nbytes, self.processing, self.restrictions,
-                self.loose_restrictions]
-        for collection in collections:
-            collection.clear()
-
-        self.processing = {addr: set() for addr in self.ncores}
-        self.stacks = {addr: list() for addr in self.ncores}
-
-        self.worker_queues = {addr: Queue() for addr in self.ncores}
+        # forget all computations, keep data in memory and what clients want
+        old, self.task_states = self.task_states, dict()
+        for key, old_ts in old.items():
+            if old_ts.who_has or old_ts.who_wants:
+                ts = self.task_states[key] = TaskState(key)
+                ts.who_has = old_ts.who_has
+                ts.who_wants = old_ts.who_wants
+                ts.nbytes = old_ts.nbytes
+                ts.exception = old_ts.exception
+                ts.traceback = old_ts.traceback
+                ts.exception_blame = old_ts.exception_blame
+        for client, states in self.client_wants.items():
+            self.client_wants[client] = {self.task_states[ts.key]
+                                         for ts in states}
+        for ws in self.worker_states.values():
+            ws.has_what = {self.task_states[ts.key] for ts in ws.has_what}
+            ws.nbytes = sum(ts.nbytes or 0 for ts in ws.has_what)
+            ws.processing = set()
+            ws.stack = []
+            ws.stack_duration = 0
+            ws.processing_duration = 0
+        self.client_processing.clear()
+        self._recount_stacked()
+        self.full_workers = {address for address, ws
+                             in self.worker_states.items()
+                             if self.memory_full(ws)}
+        self.occupancy = OccupancyIndex(self.worker_states, self.worker_cost)
 
         with ignoring(AttributeError):
-            for c in self._worker_coroutines:
-                c.cancel()
+            for q in self.worker_queues.values():  # stop old coroutines
+                q.put_nowait({'op': 'close', 'report': False})
+
+        self.worker_queues = {addr: Queue() for addr in self.worker_states}
+        self.worker_streams = {addr: BatchedSend(self.batch_interval,
+                                                 loop=self.loop)
+                               for addr in self.worker_states}
 
-        self._worker_coroutines = [self.worker(w) for w in self.ncores]
+        self._worker_coroutines = [self.worker(w) for w in self.worker_states]
         self._delete_periodic_callback = \
                 PeriodicCallback(callback=self.clear_data_from_workers,
                                  callback_time=self.delete_interval,
                                  io_loop=self.loop)
         self._delete_periodic_callback.start()
 
+        with ignoring(AttributeError):
+            self._steal_periodic_callback.stop()
+        if self.steal_interval:
+            self._steal_periodic_callback = \
+                    PeriodicCallback(callback=self.steal_work,
+                                     callback_time=self.steal_interval,
+                                     io_loop=self.loop)
+            self._steal_periodic_callback.start()
+
+        with ignoring(AttributeError):
+            self._memory_periodic_callback.stop()
+        if self.memory_interval:
+            self._memory_periodic_callback = \
+                    PeriodicCallback(callback=self.rebalance_memory,
+                                     callback_time=self.memory_interval,
+                                     io_loop=self.loop)
+            self._memory_periodic_callback.start()
+
         self.heal_state()
 
 
@@ -307,6 +843,8 @@ class Scheduler(Server):
         if self.center:
             yield self.center.close(close=True)
             self.center.close_streams()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
         self.status = 'closed'
 
     @gen.coroutine
@@ -316,11 +854,14 @@ class Scheduler(Server):
             raise gen.Return()
 
         self.status = 'closing'
+        with ignoring(AttributeError):
+            self._steal_periodic_callback.stop()
+        with ignoring(AttributeError):
+            self._memory_periodic_callback.stop()
         logger.debug("Cleaning up coroutines")
         n = 0
-        for w, nc in self.ncores.items():
-            for i in range(nc):
-                self.worker_queues[w].put_nowait({'op': 'close'}); n += 1
+        for w in self.worker_states:
+            self.worker_queues[w].put_nowait({'op': 'close'}); n += 1
 
         for s in self.scheduler_queues[1:]:
             s.put_nowait({'op': 'close-stream'})
@@ -331,99 +872,599 @@ class Scheduler(Server):
         for q in self.report_queues:
             q.put_nowait({'op': 'close'})
 
-    def mark_ready_to_run(self, key):
+    def mark_ready_to_run(self, ts):
         """ Send task to an appropriate worker.  Trigger that worker.
 
         See Also
         --------
-        decide_worker
+        Scheduler.choose_worker
         Scheduler.ensure_occupied
         """
-        logger.debug("Mark %s ready to run", key)
-        if key in self.waiting:
-            assert not self.waiting[key]
-            del self.waiting[key]
-
-        new_worker = decide_worker(self.dependencies, self.stacks,
-                self.who_has, self.restrictions, self.loose_restrictions,
-                self.nbytes, key)
+        logger.debug("Mark %s ready to run", ts.key)
+        if ts.waiting_on is not None:
+            assert not ts.waiting_on
+            ts.waiting_on = None
+
+        ws = self.worker_states[self.choose_worker(ts)]
+        ws.stack.insert(self.stack_position(ws, ts), ts)
+        self._stacked(ws, ts)
+        self.assign_duration(ws, ts)
+        self.ensure_occupied(ws)
+
+    def stack_position(self, ws, ts):
+        """ Where task ts goes on the stack of worker ws
+
+        On top, but underneath tasks of higher user priority, which we keep
+        above those of lower user priority, see ``prioritize``.  This costs
+        in proportion to the tasks that stay above.
+        """
+        stack = ws.stack
+        level = _level(ts)
+        i = len(stack)
+        while i and _level(stack[i - 1]) < level:
+            i -= 1
+        return i
 
-        self.stacks[new_worker].append(key)
-        self.ensure_occupied(new_worker)
+    def choose_worker(self, ts):
+        """ Address of the worker that should run a task, see decide_worker
 
-    def mark_key_in_memory(self, key, workers=None, type=None):
-        """ Mark that a key now lives in distributed memory """
-        logger.debug("Mark %s in memory", key)
+        Tasks that need resources only go to workers that have them.
+        """
+        deps = ts.dependencies
+        key = ts.key
+        if ts.resources:
+            stacks = {address: ws.stack
+                      for address, ws in self.worker_states.items()
+                      if self.has_resources(ws, ts.resources)}
+            if not stacks:
+                raise ValueError("No worker has the resources of task", key,
+                                 ts.resources)
+            occupancy = None
+        else:
+            if not deps and ts.restrictions is None and self.worker_states:
+                return self.occupancy.best()
+            stacks = self.worker_states
+            occupancy = self.occupancy
+        return decide_worker({key: _keys(deps)}, stacks,
+                {dep.key: {ws.address for ws in dep.who_has} for dep in deps},
+                {key: ts.restrictions} if ts.restrictions is not None else {},
+                {key} if ts.loose_restrictions else set(),
+                {dep.key: dep.nbytes or 0 for dep in deps}, key,
+                occupancy=occupancy, full=self.full_workers)
+
+    def has_resources(self, ws, resources):
+        """ Whether a worker has these resources at all, free or not """
+        return all(ws.resources.get(name, 0) >= amount
+                   for name, amount in resources.items())
+
+    def used_resources(self, ws):
+        """ Amounts of resources that the tasks processing on ws hold """
+        used = dict()
+        for ts in ws.processing:
+            if ts.resources:
+                for name, amount in ts.resources.items():
+                    used[name] = used.get(name, 0) + amount
+        return used
+
+    def mark_key_in_memory(self, ts, workers=None, type=None):
+        """ Mark that a key now lives in distributed memory
+
+        ``workers`` are ``WorkerState`` objects, by default those that we
+        already know to hold the key.
+        """
+        logger.debug("Mark %s in memory", ts.key)
         if workers is None:
-            workers = self.who_has[key]
-        for worker in workers:
-            self.who_has[key].add(worker)
-            self.has_what[worker].add(key)
-            with ignoring(KeyError):
-                self.processing[worker].remove(key)
-
-        for dep in sorted(self.dependents.get(key, []), key=self.keyorder.get,
-                          reverse=True):
-            if dep in self.waiting:
-                s = self.waiting[dep]
-                with ignoring(KeyError):
-                    s.remove(key)
-                if not s:  # new task ready to run
+            workers = ts.who_has
+        for ws in workers:
+            self._add_replica(ts, ws)
+            if ts in ws.processing:
+                self._remove_from_processing(ws, ts)
+
+        for dep in sorted(ts.dependents, key=_priority, reverse=True):
+            if dep.waiting_on is not None:
+                if ts in dep.waiting_on:
+                    dep.waiting_on.remove(ts)
+                if not dep.waiting_on:  # new task ready to run
                     self.mark_ready_to_run(dep)
 
-        for dep in self.dependencies.get(key, []):
-            if dep in self.waiting_data:
-                s = self.waiting_data[dep]
-                with ignoring(KeyError):
-                    s.remove(key)
-                if not s and dep and dep not in self.who_wants:
-                    self.delete_data(keys=[dep])
+        for dep in ts.dependencies:
+            if dep.waiters is not None:
+                if ts in dep.waiters:
+                    dep.waiters.remove(ts)
+                if not dep.waiters and not dep.who_wants:
+                    self._delete_data([dep])
 
         msg = {'op': 'key-in-memory',
-               'key': key,
-               'workers': workers}
+               'key': ts.key,
+               'workers': [ws.address for ws in workers]}
         if type:
             msg['type'] = type
         self.report(msg)
 
-    def ensure_occupied(self, worker):
-        """ Send tasks to worker while it has tasks and free cores """
-        logger.debug('Ensure worker is occupied: %s', worker)
-        while (self.stacks[worker] and
-               self.ncores[worker] > len(self.processing[worker])):
-            key = self.stacks[worker].pop()
-            if key not in self.tasks:
+    def ensure_occupied(self, ws):
+        """ Send tasks to worker while it has tasks and free cores
+
+        We keep up to ``queue_duration`` expected seconds of work per core in
+        flight, at least one task per core but no more than ``saturation``
+        tasks beyond the worker's number of cores.  This way the worker always
+        has work queued up while our messages make their round trip, but we
+        don't commit hours of work to one worker up front.
+
+        Tasks that need resources only go while enough of them are free on
+        the worker, see ``WorkerState.resources``.  Until then they stay in
+        their place on the stack and we look past a few of them for other
+        tasks.
+
+        When several clients have work and the client of the top task
+        already has more than its share of tasks processing, we may take a
+        task of a client with fewer from further down the stack, so that a
+        large job doesn't starve the others.  See ``Scheduler.next_task``.
+        """
+        logger.debug('Ensure worker is occupied: %s', ws.address)
+        stack = ws.stack
+        processing = ws.processing
+        ncores = ws.ncores or 1
+        bstream = self.worker_streams[ws.address]
+        used = None   # resources in use, once we need to know
+        held = set()  # tasks that wait for resources
+        nclients = len(set(self.client_processing) | set(self.client_stacked))
+        while (ncores + self.saturation > len(processing) and
+               (len(processing) < ncores or ws.processing_duration <
+                ncores * self.queue_duration)):
+            i = self.next_task(ws, held, nclients)
+            if i < 0:
+                break
+            ts = stack[i]
+            if ts.resources and ts.run_spec is not None:
+                if used is None:
+                    used = self.used_resources(ws)
+                if any(ws.resources.get(name, 0) - used.get(name, 0) < amount
+                       for name, amount in ts.resources.items()):
+                    held.add(ts)
+                    if len(held) > self.saturation:
+                        break
+                    continue
+            del stack[i]
+            self._stacked(ws, ts, -1)
+            ws.stack_duration -= ts.duration or 0
+            if ts.run_spec is None:  # forgotten meanwhile
+                ts.duration = None
+                continue
+            if ts.resources:
+                for name, amount in ts.resources.items():
+                    used[name] = used.get(name, 0) + amount
+            duration = ts.duration = self.expected_duration(ts.key)  # we may
+            processing.add(ts)                                 # know better
+            ts.processing_on = ws
+            self._client_starts(ts)
+            ws.processing_duration += duration
+            logger.debug("Send job to worker: %s, %s", ws.address, ts.key)
+            msg = {'op': 'compute-task',
+                   'key': ts.key,
+                   'who_has': {dep.key: {w.address for w in dep.who_has}
+                               for dep in ts.dependencies},
+                   'report': self.center is not None}
+            task = ts.run_spec
+            if istask(task):
+                msg['task'] = task
+            else:
+                msg.update(task)
+                msg['serialized'] = True
+            bstream.send(msg)
+
+        if not stack:
+            ws.stack_duration = 0  # don't accumulate rounding
+        self.occupancy.update(ws.address)
+
+    def next_task(self, ws, held=(), nclients=1):
+        """ Index of the task on the stack of ws that we send next, or -1
+
+        We take the topmost task that isn't ``held``, unless ``nclients``
+        clients have work and its client has more than its share of the
+        tasks processing.  Then we take the topmost task of the client with
+        the fewest tasks processing among the top ``fair_window`` tasks of the
+        same user priority.  We only look if the stack holds tasks of a
+        client with fewer tasks processing at all, see
+        ``WorkerState.clients``, so this costs little while one client keeps
+        the cluster to itself.
+        """
+        stack = ws.stack
+        top = len(stack) - 1
+        while top >= 0 and stack[top] in held:
+            top -= 1
+        if top < 0 or nclients < 2:
+            return top
+        counts = self.client_processing
+        fewest = counts.get(stack[top].client, 0)
+        if not fewest or fewest * nclients <= sum(counts.values()):
+            return top
+        if all(counts.get(client, 0) >= fewest for client in ws.clients):
+            return top
+        level = _level(stack[top])
+        best = top
+        for i in range(top - 1, max(top - self.fair_window, -1), -1):
+            ts = stack[i]
+            if _level(ts) != level:
+                break
+            if ts in held:
                 continue
-            self.processing[worker].add(key)
-            logger.debug("Send job to worker: %s, %s, %s", worker, key)
-            self.worker_queues[worker].put_nowait(
-                    {'op': 'compute-task',
-                     'key': key,
-                     'task': self.tasks[key],
-                     'who_has': {dep: self.who_has[dep] for dep in
-                                 self.dependencies[key]}})
+            n = counts.get(ts.client, 0)
+            if n < fewest:
+                best, fewest = i, n
+                if not n:
+                    break
+        return best
+
+    def _stacked(self, ws, ts, n=1):
+        """ Count n more tasks of the client of ts on the stack of ws """
+        client = ts.client
+        if client is None:
+            return
+        for counts in (ws.clients, self.client_stacked):
+            total = counts.get(client, 0) + n
+            if total:
+                counts[client] = total
+            else:
+                del counts[client]
+
+    def _recount_stacked(self):
+        """ Count the tasks of every client on the stacks from scratch """
+        self.client_stacked = dict()
+        for ws in self.worker_states.values():
+            ws.clients = dict()
+            for ts in ws.stack:
+                self._stacked(ws, ts)
+
+    def _client_starts(self, ts):
+        if ts.client is not None:
+            self.client_processing[ts.client] += 1
+
+    def _client_stops(self, ts):
+        client = ts.client
+        if client is not None and client in self.client_processing:
+            self.client_processing[client] -= 1
+            if not self.client_processing[client]:
+                del self.client_processing[client]
+
+    def record_duration(self, key, duration):
+        """ Update the average duration of tasks like key
+
+        >>> s = Scheduler()  # doctest: +SKIP
+        >>> s.record_duration(('x-1', 0), 2.0)  # doctest: +SKIP
+        >>> s.record_duration(('x-1', 1), 1.0)  # doctest: +SKIP
+        >>> s.task_duration  # doctest: +SKIP
+        {'x': 1.5}
+        """
+        prefix = key_split(key)
+        old = self.task_duration.get(prefix)
+        if old is None:
+            self.task_duration[prefix] = duration
+        else:
+            self.task_duration[prefix] = 0.5 * old + 0.5 * duration
+
+    def steal_work(self):
+        """ Move tasks from the stacks of busy workers to idle workers
+
+        Workers with an empty stack and idle cores steal from the bottom of
+        the stack of the busiest worker, the tasks that it would run last.
+        We only steal tasks for which moving their dependencies to the thief
+        takes less time than the task itself, see ``bandwidth``, and stop
+        once the thief is as busy as its victim.  Full workers don't steal,
+        see ``full_workers``.
+
+        The ``self._steal_periodic_callback`` attribute runs this every
+        ``steal_interval`` milliseconds.
+
+        See Also
+        --------
+        Scheduler.steal_from
+        """
+        idle = [ws for w, ws in self.worker_states.items()
+                if not ws.stack and len(ws.processing) < (ws.ncores or 1)
+                and w not in self.full_workers]
+        if not idle:
+            return
+        victims = [(-self.worker_load(w), w)
+                   for w, ws in self.worker_states.items() if len(ws.stack) > 1]
+        heapq.heapify(victims)
+        for thief in idle:
+            if not victims:
+                break
+            _, address = heapq.heappop(victims)
+            victim = self.worker_states[address]
+            if self.steal_from(victim, thief):
+                self.ensure_occupied(thief)
+            if len(victim.stack) > 1:
+                heapq.heappush(victims, (-self.worker_load(address), address))
+
+    def steal_from(self, victim, thief):
+        """ Move tasks from the bottom of victim's stack onto thief's stack
+
+        Returns the stolen tasks.  We take at most half of the stack.
+        """
+        stack = victim.stack
+        kept = []
+        stolen = []
+        i = 0
+        n = len(stack) // 2
+        while (i < len(stack) and len(stolen) < n and
+               self.worker_load(thief.address) <
+               self.worker_load(victim.address)):
+            ts = stack[i]
+            i += 1
+            if (ts.run_spec is None or
+                ts.restrictions is not None and
+                thief.address[0] not in ts.restrictions or
+                ts.resources and
+                not self.has_resources(thief, ts.resources)):
+                kept.append(ts)
+                continue
+            duration = ts.duration or self.default_duration
+            extra_bytes = 0
+            for dep in ts.dependencies:
+                if thief not in dep.who_has:
+                    extra_bytes += dep.nbytes or 0
+                if victim not in dep.who_has:
+                    extra_bytes -= dep.nbytes or 0
+            if extra_bytes > duration * self.bandwidth:
+                kept.append(ts)
+                continue
+            stolen.append(ts)
+            victim.stack_duration -= duration
+            thief.stack_duration += duration
+
+        if stolen:
+            stack[:i] = kept
+            j = self.stack_position(thief, stolen[-1])
+            thief.stack[j:j] = stolen
+            for ts in stolen:
+                self._stacked(victim, ts, -1)
+                self._stacked(thief, ts)
+            self.occupancy.update(victim.address)
+            now = time()
+            for ts in stolen:
+                self.steal_log.append((now, ts.key, victim.address,
+                                       thief.address))
+            logger.debug("%s steals %d tasks from %s", thief.address,
+                         len(stolen), victim.address)
+        return stolen
+
+    def plan_memory_moves(self):
+        """ Which data to move off full workers and where to put it
+
+        We take the largest keys of each full worker until it would drop below
+        ``memory_threshold`` and give each to the roomiest worker that isn't
+        full.  Keys that other workers also hold we just forget on the full
+        worker, these have no target.  We leave alone keys that tasks
+        processing on the full worker need.
+
+        Returns a list of ``(TaskState, source, target)`` triples of
+        ``WorkerState`` objects.
+        """
+        room = []
+        for address, ws in self.worker_states.items():
+            if address in self.full_workers:
+                continue
+            if ws.memory_limit is None:
+                free = float('inf')
+            else:
+                free = self.memory_threshold * ws.memory_limit - ws.nbytes
+            room.append((-free, address))
+        heapq.heapify(room)
+
+        moves = []
+        for address in self.full_workers:
+            source = self.worker_states[address]
+            excess = source.nbytes - self.memory_threshold * source.memory_limit
+            for ts in sorted(source.has_what, key=lambda ts: ts.nbytes or 0,
+                             reverse=True):
+                if excess < 0:
+                    break
+                nbytes = ts.nbytes or 0
+                if not nbytes or ts.waiters and any(
+                        w.processing_on is source for w in ts.waiters):
+                    continue
+                if len(ts.who_has) > 1:
+                    moves.append((ts, source, None))
+                    excess -= nbytes
+                    continue
+                if not room or -room[0][0] < nbytes:
+                    continue
+                free, target = heapq.heappop(room)
+                moves.append((ts, source, self.worker_states[target]))
+                excess -= nbytes
+                heapq.heappush(room, (free + nbytes, target))
+        return moves
+
+    @gen.coroutine
+    def rebalance_memory(self):
+        """ Move data from full workers to workers with room
+
+        Targets copy the data from their sources, then we forget it on the
+        sources, see ``plan_memory_moves``.  Tasks that later need the data
+        find it on the targets.
+
+        The ``self._memory_periodic_callback`` attribute runs this every
+        ``memory_interval`` milliseconds.
+        """
+        if self._rebalancing or not self.full_workers:
+            return
+        self._rebalancing = True
+        try:
+            moves = self.plan_memory_moves()
+            gathers = defaultdict(dict)
+            for ts, source, target in moves:
+                if target is not None:
+                    gathers[target.address][ts.key] = {source.address}
+
+            addresses = list(gathers)
+            responses = yield All([self._copy_to(address, gathers[address])
+                                   for address in addresses])
+            copied = {address for address, ok in zip(addresses, responses)
+                      if ok}
+
+            for ts, source, target in moves:
+                if self.task_states.get(ts.key) is not ts:
+                    if target is not None and target.address in copied:
+                        self.deleted_keys[target.address].add(ts.key)
+                    continue
+                if target is not None:
+                    if (target.address not in copied or
+                        self.worker_states.get(target.address) is not target):
+                        continue
+                    self._add_replica(ts, target)
+                if source in ts.who_has and len(ts.who_has) > 1:
+                    self._remove_replica(ts, source)
+                    self.deleted_keys[source.address].add(ts.key)
+            if moves:
+                logger.debug("Moved %d keys off full workers", len(moves))
+        finally:
+            self._rebalancing = False
+
+    @gen.coroutine
+    def _copy_to(self, address, who_has):
+        """ Have a worker copy data from its peers, whether that worked """
+        try:
+            response = yield self.rpc(ip=address[0],
+                                      port=address[1]).gather(who_has=who_has)
+        except (socket.error, StreamClosedError):
+            raise Return(False)
+        raise Return(response == b'OK')
+
+    def expected_duration(self, key):
+        """ Expected seconds to compute key, by the prefix of its name """
+        return self.task_duration.get(key_split(key), self.default_duration)
 
-    def seed_ready_tasks(self, keys=None):
-        """ Distribute many leaf tasks among workers
+    def assign_duration(self, ws, ts):
+        """ Count the expected duration of a task, new in the stack of ws
 
-        Takes an iterable of keys to consider for execution
+        We remember the estimate so that we take away the same amount when
+        the task leaves the worker, even if our estimates changed meanwhile.
+        """
+        duration = ts.duration = self.expected_duration(ts.key)
+        ws.stack_duration += duration
+
+    def worker_load(self, worker):
+        """ Expected seconds of work per core on worker and in its stack """
+        ws = self.worker_states[worker]
+        return (ws.stack_duration + ws.processing_duration) / (ws.ncores or 1)
+
+    def update_durations(self):
+        """ Recompute expected work on every worker from scratch """
+        for ts in self.task_states.values():
+            ts.duration = None
+        for ws in self.worker_states.values():
+            ws.stack_duration = 0
+            for ts in ws.stack:
+                ts.duration = self.expected_duration(ts.key)
+                ws.stack_duration += ts.duration
+            ws.processing_duration = 0
+            for ts in ws.processing:
+                ts.duration = self.expected_duration(ts.key)
+                ws.processing_duration += ts.duration
+        self.occupancy.rebuild()
+
+    def _remove_from_processing(self, ws, ts):
+        """ Take a task from the tasks in flight on a worker """
+        ws.processing.remove(ts)
+        ts.processing_on = None
+        self._client_stops(ts)
+        duration = ts.duration or 0
+        ts.duration = None
+        if ws.processing:
+            ws.processing_duration -= duration
+        else:
+            ws.processing_duration = 0
+
+    def seed_ready_tasks(self, states=None):
+        """ Distribute many ready tasks among workers
+
+        Takes an iterable of ``TaskState`` objects to consider for execution,
+        by default all of them.  This does what ``assign_many_tasks`` does on
+        dictionaries.  Leaves go to workers in runs of neighbors and of leaves
+        that feed the same tasks, see ``split_leaves``.
 
         See Also
         --------
         assign_many_tasks
         Scheduler.ensure_occupied
         """
-        if keys is None:
-            keys = self.tasks
-        new_stacks = assign_many_tasks(
-                self.dependencies, self.waiting, self.keyorder, self.who_has,
-                self.stacks, self.restrictions, self.loose_restrictions,
-                self.nbytes,
-                [k for k in keys if k in self.waiting and not self.waiting[k]])
-        logger.debug("Seed ready tasks: %s", new_stacks)
-        for worker, stack in new_stacks.items():
-            if stack:
-                self.ensure_occupied(worker)
+        _exhaust(self._seed_ready_tasks_steps(states))
+
+    def _seed_ready_tasks_steps(self, states=None):
+        """ Steps of ``seed_ready_tasks``, we yield after every chunk
+
+        We hand out leaves in order of priority, a chunk at a time.  Later
+        chunks go underneath the earlier ones in the stacks so that workers
+        start on the first chunk while we hand out the rest.  Tasks that
+        became ready or got handed out meanwhile are not ours to hand out
+        any more.
+        """
+        if states is None:
+            states = list(self.task_states.values())
+        if not self.worker_states:
+            raise ValueError("No workers found")
+        chunk = self.graph_chunk_size
+        leaves = []  # ready tasks without data dependencies
+        ready = []   # ready tasks with data dependencies
+        for i, ts in enumerate(states):
+            if i and not i % chunk:
+                yield
+            if ts.waiting_on is not None and not ts.waiting_on:
+                if (not ts.dependencies and ts.restrictions is None and
+                    not ts.resources):
+                    leaves.append(ts)
+                else:
+                    ready.append(ts)
+        logger.debug("Seed %d leaves and %d other ready tasks", len(leaves),
+                     len(ready))
+
+        touched = set()
+        bottom = dict()  # where our first leaves went in each stack
+        leaves.sort(key=attrgetter('priority'))
+        for i in range(0, len(leaves), chunk):
+            if i:
+                for ws in touched:
+                    self.ensure_occupied(ws)
+                touched.clear()
+                yield
+                if not self.worker_states:
+                    raise ValueError("No workers found")
+            new = [ts for ts in leaves[i:i + chunk]
+                   if ts.waiting_on is not None and not ts.waiting_on]
+            if not new:
+                continue
+            runs = split_leaves(new, self.roomy_workers(),
+                                attrgetter('dependents'))
+            for address, stack in runs.items():
+                ws = self.worker_states[address]
+                j = min(bottom.setdefault(address,
+                                          self.stack_position(ws, stack[0])),
+                        len(ws.stack))
+                ws.stack[j:j] = stack
+                for ts in stack:
+                    ts.waiting_on = None
+                    self._stacked(ws, ts)
+                    self.assign_duration(ws, ts)
+                touched.add(ws)
+
+        for i, ts in enumerate(ready):
+            if i and not i % chunk:
+                for ws in touched:
+                    self.ensure_occupied(ws)
+                touched.clear()
+                yield
+            if ts.waiting_on is None or ts.waiting_on:
+                continue
+            ts.waiting_on = None
+            ws = self.worker_states[self.choose_worker(ts)]
+            ws.stack.insert(self.stack_position(ws, ts), ts)
+            self._stacked(ws, ts)
+            self.assign_duration(ws, ts)
+            touched.add(ws)
+
+        for ws in touched:
+            self.ensure_occupied(ws)
 
     def update_data(self, who_has=None, nbytes=None, client=None):
         """
@@ -434,16 +1475,18 @@ class Scheduler(Server):
         Scheduler.mark_key_in_memory
         """
         logger.debug("Update data %s", who_has)
-        for key, workers in who_has.items():
-            self.mark_key_in_memory(key, workers)
+        for key, n in nbytes.items():
+            self.set_nbytes(self.task_state(key), n)
 
-        self.nbytes.update(nbytes)
+        for key, workers in who_has.items():
+            ts = self.task_state(key)
+            self.mark_key_in_memory(ts, [self.worker_states[w]
+                                         for w in workers])
+            ts.in_play = True
 
         if client:
             self.client_wants_keys(keys=list(who_has), client=client)
 
-        self.in_play.update(who_has)
-
     def mark_task_erred(self, key, worker, exception, traceback):
         """ Mark that a task has erred on a particular worker
 
@@ -451,43 +1494,85 @@ class Scheduler(Server):
         --------
         Scheduler.mark_failed
         """
-        if key in self.processing[worker]:
-            self.processing[worker].remove(key)
-            self.exceptions[key] = exception
-            self.tracebacks[key] = traceback
-            self.mark_failed(key, key)
-            self.ensure_occupied(worker)
+        ws = self.worker_states[worker]
+        ts = self.task_states.get(key)
+        if ts is not None and ts in ws.processing:
+            self._remove_from_processing(ws, ts)
+            ts.exception = exception
+            ts.traceback = traceback
+            self.mark_failed(ts, ts)
+            self.ensure_occupied(ws)
             for plugin in self.plugins[:]:
                 try:
                     plugin.task_erred(self, key, worker, exception)
                 except Exception as e:
                     logger.exception(e)
 
-    def mark_failed(self, key, failing_key=None):
-        """ When a task fails mark it and all dependent task as failed """
-        logger.debug("Mark key as failed %s", key)
-        if key in self.exceptions_blame:
-            return
-        self.exceptions_blame[key] = failing_key
-        self.report({'op': 'task-erred',
-                     'key': key,
-                     'exception': self.exceptions[failing_key],
-                     'traceback': self.tracebacks[failing_key]})
-        if key in self.waiting:
-            del self.waiting[key]
-        if key in self.waiting_data:
-            del self.waiting_data[key]
-        self.in_play.remove(key)
-        for dep in self.dependents[key]:
-            self.mark_failed(dep, failing_key)
-
-    def mark_task_finished(self, key, worker, nbytes, type=None):
-        """ Mark that a task has finished execution on a particular worker """
+    def mark_failed(self, ts, failing=None):
+        """ When a task fails mark it and all dependent task as failed
+
+        We walk the dependents with a stack rather than by recursion so that
+        long chains don't hit the recursion limit.  Every client hears about
+        all of its failed keys in one ``task-erred`` message, see
+        ``Scheduler.report_erred``.
+        """
+        logger.debug("Mark key as failed %s", ts.key)
+        failed = []
+        stack = [ts]
+        while stack:
+            ts = stack.pop()
+            if ts.exception_blame is not None:
+                continue
+            ts.exception_blame = failing
+            ts.waiting_on = None
+            ts.waiters = None
+            ts.in_play = False
+            failed.append(ts)
+            stack.extend(dep for dep in ts.dependents
+                         if dep.exception_blame is None)
+        if failed:
+            self.report_erred(failed, failing)
+
+    def report_erred(self, states, failing):
+        """ Tell clients that keys failed, in one message per client
+
+        ``{'op': 'task-erred', 'keys': [...], 'exception': ...,
+        'traceback': ...}`` goes to every client with the keys that it wants
+        and to the report queues with all of the keys.
+        """
+        msg = {'op': 'task-erred',
+               'exception': failing.exception,
+               'traceback': failing.traceback}
+        if self.report_queues:
+            queue_msg = assoc(msg, 'keys', [ts.key for ts in states])
+            for q in self.report_queues:
+                q.put_nowait(queue_msg)
+        keys = defaultdict(list)
+        for ts in states:
+            for client in ts.who_wants:
+                keys[client].append(ts.key)
+        for client, client_keys in keys.items():
+            bstream = self.streams.get(client)
+            if bstream is not None:
+                bstream.send(assoc(msg, 'keys', client_keys))
+
+    def mark_task_finished(self, key, worker, nbytes, type=None,
+                           compute_start=None, compute_stop=None):
+        """ Mark that a task has finished execution on a particular worker
+
+        Workers tell us when they started and stopped computing the task.  We
+        fold this into ``task_duration``, our estimate of how long tasks with
+        the same key prefix take.
+        """
         logger.debug("Mark task as finished %s, %s", key, worker)
-        if key in self.processing[worker]:
-            self.nbytes[key] = nbytes
-            self.mark_key_in_memory(key, [worker], type=type)
-            self.ensure_occupied(worker)
+        ws = self.worker_states[worker]
+        ts = self.task_states.get(key)
+        if ts is not None and ts in ws.processing:
+            self.set_nbytes(ts, nbytes)
+            self.mark_key_in_memory(ts, [ws], type=type)
+            if compute_start is not None and compute_stop is not None:
+                self.record_duration(key, compute_stop - compute_start)
+            self.ensure_occupied(ws)
             for plugin in self.plugins[:]:
                 try:
                     plugin.task_finished(self, key, worker, nbytes)
@@ -495,7 +1580,7 @@ class Scheduler(Server):
                     logger.exception(e)
         else:
             logger.debug("Key not found in processing, %s, %s, %s",
-                         key, worker, self.processing[worker])
+                         key, worker, ws.processing)
 
     def mark_missing_data(self, missing=None, key=None, worker=None):
         """ Mark that certain keys have gone missing.  Recover.
@@ -504,26 +1589,27 @@ class Scheduler(Server):
         --------
         heal_missing_data
         """
+        ts = self.task_states.get(key)
+        ws = self.worker_states.get(worker)
         if key and worker:
-            try:
-                self.processing[worker].remove(key)
-            except KeyError:
+            if ts is not None and ws is not None and ts in ws.processing:
+                self._remove_from_processing(ws, ts)
+            else:
                 logger.debug("Tried to remove %s from %s, but it wasn't there",
                              key, worker)
 
-        missing = set(missing)
+        missing = {self.task_states[k] for k in missing
+                   if k in self.task_states}
         logger.debug("Recovering missing data: %s", missing)
-        for k in missing:
-            with ignoring(KeyError):
-                workers = self.who_has.pop(k)
-                for worker in workers:
-                    self.has_what[worker].remove(k)
+        for mts in missing:
+            for holder in list(mts.who_has):
+                self._remove_replica(mts, holder)
         self.my_heal_missing_data(missing)
 
-        if key and worker:
-            self.waiting[key] = missing
-            logger.debug('task missing data, %s, %s', key, self.waiting)
-            self.ensure_occupied(worker)
+        if key and worker and ts is not None and ws is not None:
+            ts.waiting_on = set(missing)
+            logger.debug('task missing data, %s, %s', key, ts.waiting_on)
+            self.ensure_occupied(ws)
 
         self.seed_ready_tasks()
 
@@ -539,178 +1625,496 @@ class Scheduler(Server):
     def remove_worker(self, stream=None, address=None, heal=True):
         """ Mark that a worker no longer seems responsive
 
+        With ``heal`` we reschedule the work of the worker and recompute the
+        data that we lost with it, see ``Scheduler.heal_lost_worker``.
+
         See Also
         --------
+        Scheduler.heal_lost_worker
         Scheduler.heal_state
         """
         logger.debug("Remove worker %s", address)
-        if address not in self.processing:
+        if address not in self.worker_states:
             return
-        keys = self.has_what.pop(address)
-        for i in range(self.ncores[address]):  # send close message, in case not dead
-            self.worker_queues[address].put_nowait({'op': 'close', 'report': False})
+        ws = self.worker_states.pop(address)
+        self.epoch += 1
+        # send close message, in case not dead
+        self.worker_queues[address].put_nowait({'op': 'close', 'report': False})
         del self.worker_queues[address]
-        del self.ncores[address]
-        del self.stacks[address]
-        del self.processing[address]
-        del self.worker_services[address]
-        if not self.stacks:
+        del self.worker_streams[address]
+        self.full_workers.discard(address)
+        self.occupancy.remove(address)
+        for ts in ws.stack:
+            self._stacked(ws, ts, -1)
+        if not self.worker_states:
             logger.critical("Lost all workers")
-        missing_keys = set()
-        for key in keys:
-            self.who_has[key].remove(address)
-            if not self.who_has[key]:
-                missing_keys.add(key)
-        gone_data = {k for k, v in self.who_has.items() if not v}
-        self.in_play.difference_update(missing_keys)
-        for k in gone_data:
-            del self.who_has[k]
+        for ts in ws.processing:
+            ts.processing_on = None
+            self._client_stops(ts)
+        lost = []
+        for ts in ws.has_what:
+            ts.who_has.remove(ws)
+            if not ts.who_has:
+                ts.in_play = False
+                self.release_state(ts)
+                lost.append(ts)
 
         if heal:
-            self.heal_state()
+            self.heal_lost_worker(ws, lost)
 
         return b'OK'
 
     def add_worker(self, stream=None, address=None, keys=(), ncores=None,
-                   services=None):
-        self.ncores[address] = ncores
-        self.worker_services[address] = services
-        if address not in self.processing:
-            self.has_what[address] = set()
-            self.processing[address] = set()
-            self.stacks[address] = []
+                   services=None, memory_limit=None, resources=None):
+        ws = self.worker_states.get(address)
+        if ws is None:
+            ws = self.worker_states[address] = WorkerState(address)
+            self.occupancy.update(address)
             self.worker_queues[address] = Queue()
+            self.worker_streams[address] = BatchedSend(self.batch_interval,
+                                                       loop=self.loop)
+            self._worker_coroutines.append(self.worker(address))
+        ws.ncores = ncores
+        ws.services = services
+        ws.memory_limit = memory_limit
+        ws.resources = resources or {}
+        self._check_memory(ws)
         for key in keys:
-            self.mark_key_in_memory(key, [address])
-
-        self._worker_coroutines.append(self.worker(address))
+            self.mark_key_in_memory(self.task_state(key), [ws])
 
         logger.info("Register %s", str(address))
         return b'OK'
 
     def remove_client(self, client=None):
         logger.info("Remove client %s", client)
-        self.client_releases_keys(self.wants_what.get(client, ()), client)
+        self.client_releases_keys(_keys(self.client_wants.get(client, ())),
+                                  client)
         with ignoring(KeyError):
-            del self.wants_what[client]
+            del self.client_wants[client]
 
     def update_graph(self, client=None, tasks=None, keys=None,
                      dependencies=None, restrictions=None,
-                     loose_restrictions=None):
+                     loose_restrictions=None, resources=None, priority=0):
         """ Add new computations to the internal dask graph
 
         This happens whenever the Executor calls submit, map, get, or compute.
+        New tasks with a higher ``priority`` run before those with a lower
+        one, see ``Scheduler.prioritize``.
+
+        Groups of independent new tasks, like those from ``Executor.map``,
+        take a faster path, see ``Scheduler.add_independent_group``.
+
+        We take in graphs with more than ``graph_chunk_size`` tasks a chunk of
+        about that many steps at a time and yield to the event loop in
+        between, so that we keep serving workers and other clients.  We then
+        return a Future.  Workers start on the first ready tasks while we take
+        in the rest.  We record how long we hold on to the event loop at a
+        time as ``'stall'`` of ``'update-graph'`` in ``metrics``.
+
+        Lost workers change the state that we took in so far, so when the
+        ``epoch`` moved on during a pause we start over on the whole graph.
+        That keeps what we did already, see ``Scheduler._update_graph_steps``.
+        A restart forgets the graph, we then stop.
+        """
+        make_steps = partial(self._update_graph_steps, client, tasks, keys,
+                             dependencies, restrictions, loose_restrictions,
+                             resources, priority)
+        if len(tasks) > self.graph_chunk_size:
+            return self._update_graph_chunked(make_steps, tasks, keys,
+                                              restrictions)
+
+        steps = make_steps()
+        start = time()
+        with gc_paused():  # we may create millions of objects
+            _exhaust(steps)
+        self.metrics.add('update-graph', 'stall', time() - start)
+        self._graph_updated(tasks, keys, restrictions)
+
+    @gen.coroutine
+    def _update_graph_chunked(self, make_steps, tasks, keys, restrictions):
+        task_states, epoch = self.task_states, self.epoch
+        steps = make_steps()
+        # Collections in between chunks would walk all of our new objects
+        with gc_paused():
+            done = False
+            while not done:
+                start = time()
+                for _ in steps:
+                    break
+                else:  # no more steps
+                    done = True
+                self.metrics.add('update-graph', 'stall', time() - start)
+                if not done:
+                    yield gen.moment
+                    if self.task_states is not task_states:  # restart
+                        logger.info("Drop graph of %d tasks after restart",
+                                    len(tasks))
+                        steps.close()
+                        return
+                    if self.epoch != epoch:
+                        logger.info("Lost workers while taking in graph, "
+                                    "start over")
+                        steps.close()
+                        steps, epoch = make_steps(), self.epoch
+        self._graph_updated(tasks, keys, restrictions)
+
+    def _graph_updated(self, tasks, keys, restrictions):
+        for plugin in self.plugins[:]:
+            try:
+                plugin.update_graph(self, tasks, keys, restrictions or {})
+            except Exception as e:
+                logger.exception(e)
+
+    def _update_graph_steps(self, client, tasks, keys, dependencies,
+                            restrictions, loose_restrictions, resources=None,
+                            priority=0):
+        """ Steps of ``update_graph``, we yield after every chunk of work
+
+        Other events may happen between chunks, so we leave our state
+        consistent at every yield.  Clients want their keys before we start
+        so that nobody forgets the tasks that lead to them meanwhile.  We may
+        run these steps again on the same graph: we keep the run specs,
+        priorities and places in stacks of tasks that have them.
         """
-        for k in list(tasks):
+        chunk = self.graph_chunk_size
+        for i, k in enumerate(list(tasks)):
+            if i and not i % chunk:
+                yield
             if tasks[k] is k:
                 del tasks[k]
 
-        update_state(self.tasks, self.dependencies, self.dependents,
-                self.who_wants, self.wants_what, self.who_has, self.in_play,
-                self.waiting, self.waiting_data, tasks, keys, dependencies,
-                client)
+        group = []
+        if (not restrictions and not loose_restrictions and not resources and
+            self.worker_states):
+            for _ in _independent_group_steps(tasks, keys, dependencies,
+                                              self.task_states, self.who_has,
+                                              group, chunk):
+                yield
+        if group:
+            for _ in self._add_independent_group_steps(client, tasks, keys,
+                                                       group[0], priority):
+                yield
+            return
+
+        # This does what update_state does on dictionaries
+        wanted = []
+        for i, key in enumerate(keys):
+            if i and not i % chunk:
+                yield
+            ts = self.task_state(key)
+            if not ts.who_wants:
+                ts.who_wants = set()
+            ts.who_wants.add(client)
+            wanted.append(ts)
+        self.client_wants[client].update(wanted)
+
+        states = []
+        for i, (key, task) in enumerate(tasks.items()):
+            if i and not i % chunk:
+                yield
+            ts = self.task_state(key)
+            states.append(ts)
+            if ts.run_spec is not None:  # don't overwrite work underway
+                continue
+            ts.run_spec = task
+            if ts.client is None:
+                ts.client = client
+            deps = dependencies.get(key, ())
+            if deps:
+                ts.dependencies = set(map(self.task_state, deps))
+                for dep in ts.dependencies:
+                    if not dep.dependents:
+                        dep.dependents = set()
+                    dep.dependents.add(ts)
+
+        stack = [ts for ts in wanted if not ts.in_play]
+        i = 0
+        while stack:  # bring everything that we need into play
+            i += 1
+            if not i % chunk:
+                yield
+            ts = stack.pop()
+            if ts.in_play:
+                continue
+            ts.in_play = True
+            ts.waiting_on = {dep for dep in ts.dependencies
+                             if not dep.who_has}
+            for dep in ts.dependencies:
+                if dep.waiters is None:
+                    dep.waiters = set()
+                dep.waiters.add(ts)
+                if not dep.in_play:
+                    stack.append(dep)
+            if ts.waiters is None:
+                ts.waiters = set()
 
         if restrictions:
-            restrictions = {k: set(map(ensure_ip, v))
-                            for k, v in restrictions.items()}
-            self.restrictions.update(restrictions)
+            for k, v in restrictions.items():
+                self.task_state(k).restrictions = set(map(ensure_ip, v))
         if loose_restrictions:
-            self.loose_restrictions |= loose_restrictions
-
-        new_keyorder = order(tasks)  # TODO: define order wrt old graph
-        for key in new_keyorder:
-            if key not in self.keyorder:
-                # TODO: add test for this
-                self.keyorder[key] = (self.generation, new_keyorder[key]) # prefer old
-        if len(tasks) > 1:
-            self.generation += 1  # older graph generations take precedence
-
-        for key in tasks:
-            for dep in self.dependencies[key]:
-                if dep in self.exceptions_blame:
-                    self.mark_failed(key, self.exceptions_blame[dep])
-
-        self.seed_ready_tasks(tasks)
-        for key in keys:
-            if self.who_has[key]:
-                self.mark_key_in_memory(key)
+            for k in loose_restrictions:
+                self.task_state(k).loose_restrictions = True
+        if resources:
+            for k, v in resources.items():
+                if k in tasks:
+                    self.task_state(k).resources = dict(v) or None
+
+        new = [ts for ts in states if ts.priority is None]  # prefer old
+        if new:
+            for _ in self._prioritize_steps(new, keys, priority):
+                yield
+
+        for i, ts in enumerate(states):
+            if i and not i % chunk:
+                yield
+            for dep in ts.dependencies:
+                if dep.exception_blame is not None:
+                    self.mark_failed(ts, dep.exception_blame)
+
+        for _ in self._seed_ready_tasks_steps(states):
+            yield
+        for i, ts in enumerate(wanted):
+            if i and not i % chunk:
+                yield
+            if ts.who_has:
+                self.mark_key_in_memory(ts)
+
+    def add_independent_group(self, client, tasks, keys, shared=(),
+                              priority=0):
+        """ Add many new tasks that depend on nothing but data in memory
+
+        This does the work of ``update_state``, ``prioritize`` and
+        ``seed_ready_tasks`` in one pass over the keys rather than by walking
+        the graph.  The caller checks that the group qualifies, see
+        ``independent_group``.  All keys are new, wanted by the client and
+        ready to run.  They all depend on ``shared``, which is in memory.  We
+        keep them in the order of ``keys``, split them with ``split_leaves``
+        among the workers that hold all of ``shared`` and expect all of them
+        to take as long as the first one.
+
+        We still create a ``TaskState`` and its sets for every key, because
+        forget, cancel, heal and validate work key by key.  So this saves the
+        walks over the graph, not the cost per key.
+        """
+        _exhaust(self._add_independent_group_steps(client, tasks, keys,
+                                                   shared, priority))
 
-        for plugin in self.plugins[:]:
-            try:
-                plugin.update_graph(self, tasks, keys, restrictions or {})
-            except Exception as e:
-                logger.exception(e)
+    def _add_independent_group_steps(self, client, tasks, keys, shared=(),
+                                     priority=0):
+        """ Steps of ``add_independent_group``, one per chunk of keys
+
+        We hand out every chunk as soon as we have it, underneath the earlier
+        chunks in the stacks, see ``Scheduler._seed_ready_tasks_steps``.
+        """
+        keys = list(keys)
+        shared = set(map(self.task_state, shared))
+        generation = self.generation
+        self.generation += 1
+        duration = self.expected_duration(keys[0])
+        chunk = self.graph_chunk_size
+        bottom = dict()  # where our first tasks went in each stack
+
+        for start in range(0, len(keys), chunk):
+            if start:
+                yield
+            states = []
+            for i, key in enumerate(keys[start:start + chunk], start):
+                ts = self.task_states.get(key)
+                if ts is not None:  # another client submitted it meanwhile
+                    self.client_wants_keys(keys=[key], client=client)
+                    if ts.who_has:
+                        self.mark_key_in_memory(ts)
+                    continue
+                ts = TaskState(key, tasks[key])
+                ts.priority = (-priority, generation, i, 0)
+                ts.client = client
+                ts.who_wants = {client}
+                ts.waiters = set()
+                ts.in_play = True
+                ts.duration = duration
+                if shared:
+                    ts.dependencies = set(shared)
+                states.append(ts)
+            self.task_states.update((ts.key, ts) for ts in states)
+            self.client_wants[client].update(states)
+            for dep in shared:
+                if not dep.dependents:
+                    dep.dependents = set()
+                dep.dependents.update(states)
+                if dep.waiters is None:
+                    dep.waiters = set()
+                dep.waiters.update(states)
+
+            workers = self.roomy_workers()
+            if shared:  # stay with the data, stealing moves work if it pays
+                holders = set.intersection(*[set(dep.who_has)
+                                             for dep in shared])
+                holders = {ws.address: ws for ws in holders
+                           if ws.address not in self.full_workers}
+                if holders:
+                    workers = holders
+            if not workers:
+                raise ValueError("No workers found")
+
+            for address, stack in split_leaves(states, workers).items():
+                ws = self.worker_states[address]
+                j = min(bottom.setdefault(address,
+                                          self.stack_position(ws, stack[0])),
+                        len(ws.stack))
+                ws.stack[j:j] = stack
+                self._stacked(ws, stack[0], len(stack))  # all of our client
+                ws.stack_duration += duration * len(stack)
+                self.ensure_occupied(ws)
+
+    def prioritize(self, states, outputs=(), priority=0):
+        """ Give new tasks their place in ``keyorder``
+
+        Priorities are ``(-priority, generation, order, after)`` tuples,
+        lower ones run first.  Users may give a submission a higher ``priority`` so
+        that it runs ahead of others.  Workers keep such tasks on top of
+        their stacks, see ``Scheduler.stack_position``.  Every submission
+        gets a new generation so that older work takes precedence.  Within a
+        submission we number keys depth first from its outputs with
+        ``order_keys``.
+
+        New tasks that depend on keys that are still in flight continue that
+        older work.  They join the generation of the oldest such key, just
+        behind it.  ``after`` counts how many such keys we continue through
+        and breaks the tie with the key we continue.  It is zero for fresh
+        work.
+
+        See Also
+        --------
+        order_keys
+        """
+        _exhaust(self._prioritize_steps(states, outputs, priority))
+
+    def _prioritize_steps(self, states, outputs=(), priority=0):
+        """ Steps of ``prioritize``, we yield after every chunk of tasks """
+        chunk = self.graph_chunk_size
+        in_flight = []
+        dependencies = dict()
+        for i, ts in enumerate(states):
+            if i and not i % chunk:
+                yield
+            dependencies[ts] = ts.dependencies
+            for dep in ts.dependencies:
+                if dep.priority is not None and not dep.who_has:
+                    in_flight.append(dep.priority[1:])
+        if in_flight:
+            generation, base, after = min(in_flight)
+            after += 1
+        else:
+            generation, base, after = self.generation, 0, 0
+            self.generation += 1
+
+        if len(states) == 1:  # submit
+            states[0].priority = (-priority, generation, base, after)
+        else:
+            output_states = []
+            for i, k in enumerate(outputs):
+                if i and not i % chunk:
+                    yield
+                if k in self.task_states:
+                    output_states.append(self.task_states[k])
+            new_order = dict()
+            for _ in _order_keys_steps(states, dependencies, output_states,
+                                       new_order, chunk):
+                yield
+            n = len(new_order)
+            for i, (ts, j) in enumerate(new_order.items()):
+                if i and not i % chunk:
+                    yield
+                ts.priority = (-priority, generation,
+                               base + j / n if in_flight else j, after)
 
     def client_releases_keys(self, keys=None, client=None):
+        wants = self.client_wants.get(client, ())
         for k in list(keys):
-            with ignoring(KeyError):
-                self.wants_what[client].remove(k)
-            with ignoring(KeyError):
-                self.who_wants[k].remove(client)
-            if not self.who_wants[k]:
-                del self.who_wants[k]
-                self.release_held_data([k])
+            ts = self.task_states.get(k)
+            if ts is None:
+                continue
+            if ts in wants:
+                wants.remove(ts)
+            if client in ts.who_wants:
+                ts.who_wants.remove(client)
+            if not ts.who_wants:
+                ts.who_wants = _no_states
+                self.release_held_data([ts])
                 logger.debug("Delete who_wants[%s]", k)
 
     def client_wants_keys(self, keys=None, client=None):
         for k in keys:
-            self.who_wants[k].add(client)
-            self.wants_what[client].add(k)
-
-    def release_held_data(self, keys=None):
-        """ Mark that a key is no longer externally required to be in memory """
-        keys = set(keys)
-        if keys:
-            logger.debug("Release keys: %s", keys)
-            keys2 = {k for k in keys if not self.waiting_data.get(k)}
-            if keys2:
-                self.delete_data(keys=keys2)  # async
-
-        changed = True
-        while changed:
-            changed = False
-            for key in keys:
-                if key in self.tasks and not self.dependents.get(key):
-                    self.forget(key)
-                    changed = True
-
-    def forget(self, key):
+            ts = self.task_state(k)
+            if not ts.who_wants:
+                ts.who_wants = set()
+            ts.who_wants.add(client)
+            self.client_wants[client].add(ts)
+
+    def release_held_data(self, states=None):
+        """ Mark that keys are no longer externally required to be in memory
+        """
+        states = set(states)
+        if states:
+            logger.debug("Release keys: %s", states)
+            gone = [ts for ts in states if not ts.waiters]
+            if gone:
+                self._delete_data(gone)  # async
+
+        for ts in states:  # forget cascades to the rest of states
+            if ts.run_spec is not None and not ts.dependents:
+                self.forget(ts)
+        for ts in states:
+            self.release_state(ts)
+
+    def forget(self, ts):
         """ Forget a key if no one cares about it
 
         This removes all knowledge of how to produce a key from the scheduler.
-        This is almost exclusively called by release_held_data
+        We go on to forget the dependencies that nobody cares about any more,
+        with a stack rather than by recursion so that long chains don't hit
+        the recursion limit.  This is almost exclusively called by
+        release_held_data
         """
-        assert not self.dependents[key] and key not in self.who_wants
-        if key in self.tasks:
-            del self.tasks[key]
-            del self.dependents[key]
-            for dep in self.dependencies[key]:
-                s = self.dependents[dep]
-                s.remove(key)
-                if not s and dep not in self.who_wants:
-                    self.forget(dep)
-            del self.dependencies[key]
-            if key in self.restrictions:
-                del self.restrictions[key]
-            if key in self.loose_restrictions:
-                self.loose_restrictions.remove(key)
-            del self.keyorder[key]
-            if key in self.exceptions:
-                del self.exceptions[key]
-            if key in self.exceptions_blame:
-                del self.exceptions_blame[key]
-        if key in self.who_has:
-            self.delete_data(keys=[key])
+        assert not ts.dependents and not ts.who_wants
+        stack = [ts]
+        while stack:
+            ts = stack.pop()
+            if ts.run_spec is not None:
+                ts.run_spec = None
+                for dep in ts.dependencies:
+                    dep.dependents.remove(ts)
+                    if dep.waiters and ts in dep.waiters:
+                        dep.waiters.remove(ts)
+                    if not dep.dependents and not dep.who_wants:
+                        stack.append(dep)
+                    else:
+                        self.release_state(dep)
+                ts.dependencies = _no_states
+                if ts.waiting_on is not None:  # else it may be in a stack or
+                    ts.client = None           # processing, we still count it
+                ts.waiting_on = None
+                ts.restrictions = None
+                ts.loose_restrictions = False
+                ts.resources = None
+                ts.priority = None
+                ts.exception = None
+                ts.traceback = None
+                ts.exception_blame = None
+            if ts.who_has:
+                self._delete_data([ts])
+            self.release_state(ts)
 
     def cancel_key(self, key, client, retries=5):
-        if key not in self.who_wants:  # no key yet, lets try again in 500ms
+        ts = self.task_states.get(key)
+        if ts is None or not ts.who_wants:  # no key yet, try again in 200ms
             if retries:
                 self.loop.add_future(gen.sleep(0.2),
                         lambda _: self.cancel_key(key, client, retries - 1))
             return
-        if self.who_wants[key] == {client}:  # no one else wants this key
-            for dep in list(self.dependents[key]):
-                self.cancel_key(dep, client)
+        if ts.who_wants == {client}:  # no one else wants this key
+            for dep in list(ts.dependents):
+                self.cancel_key(dep.key, client)
         logger.debug("Scheduler cancels key %s", key)
         self.report({'op': 'cancelled-key', 'key': key})
         self.client_releases_keys(keys=[key], client=client)
@@ -722,45 +2126,214 @@ class Scheduler(Server):
             self.cancel_key(key, client)
 
     def heal_state(self):
-        """ Recover from catastrophic change """
+        """ Recover from catastrophic change
+
+        We run ``heal`` on dictionaries of our state and update our states
+        from what it returns.
+        """
         logger.debug("Heal state")
         self.log_state("Before Heal")
-        state = heal(self.dependencies, self.dependents, self.who_has,
-                self.stacks, self.processing, self.waiting, self.waiting_data)
+        self.epoch += 1
+        states = self.task_states
+        dependencies = dict(self.dependencies)
+        dependents = dict(self.dependents)
+        who_has = dict(self.who_has)
+        stacks = {w: [ts.key for ts in ws.stack if ts.run_spec is not None]
+                  for w, ws in self.worker_states.items()}
+        processing = dict(self.processing)
+        waiting = dict(self.waiting)
+        waiting_data = dict(self.waiting_data)
+        state = heal(dependencies, dependents, who_has, stacks, processing,
+                     waiting, waiting_data)
         released = state['released']
-        self.in_play.clear(); self.in_play.update(state['in_play'])
-        add_keys = {k for k, v in self.waiting.items() if not v}
+
+        for ts in states.values():
+            ts.waiting_on = None
+            ts.waiters = None
+            ts.in_play = False
+            ts.processing_on = None
+        for key, deps in waiting.items():
+            states[key].waiting_on = {states[dep] for dep in deps}
+        for key, deps in waiting_data.items():
+            states[key].waiters = {states[dep] for dep in deps}
+        for key in state['in_play']:
+            states[key].in_play = True
+        self.client_processing.clear()
+        for w, ws in self.worker_states.items():
+            ws.stack = [states[key] for key in stacks[w]]
+            ws.processing = {states[key] for key in processing[w]}
+            for ts in ws.processing:
+                ts.processing_on = ws
+                self._client_starts(ts)
+        self._recount_stacked()
+        self.update_durations()  # heal removes keys from stacks
+
+        add_keys = [ts for ts in states.values()
+                    if ts.waiting_on is not None and not ts.waiting_on]
         for key in set(self.who_wants) & released:
             self.report({'op': 'lost-key', 'key': key})
-        if self.stacks:
-            for key in add_keys:
-                self.mark_ready_to_run(key)
-
-        self.delete_data(keys=set(self.who_has) & released - set(self.who_wants))
-        self.in_play.update(self.who_has)
+        if self.worker_states:
+            for ts in add_keys:
+                self.mark_ready_to_run(ts)
+
+        self._delete_data([states[key] for key in released
+                           if key in states and states[key].who_has and
+                           not states[key].who_wants])
+        for ts in states.values():
+            if ts.who_has:
+                ts.in_play = True
         self.log_state("After Heal")
 
+    def heal_lost_worker(self, ws, lost):
+        """ Recover from the loss of a worker, touching only what it affects
+
+        ``ws`` is the ``WorkerState`` of the lost worker and ``lost`` holds
+        the tasks whose only copy of data was on it.  We compute the tasks of
+        its stack and processing elsewhere.  We take the dependents of lost
+        data out of the stacks and processing of other workers and compute
+        lost data again where somebody still needs it.  From there we walk
+        down to dependencies that we must compute again as well.
+
+        This costs in proportion to the affected tasks and the stacks of other
+        workers, not to the whole graph like ``heal_state``, which remains for
+        when we don't trust our state any more.
+        """
+        logger.debug("Heal lost worker %s, lost %d keys", ws.address,
+                     len(lost))
+        todo = []
+        for ts in chain(ws.processing, ws.stack):
+            ts.duration = None
+            if (ts.run_spec is not None and not ts.who_has and
+                ts.exception_blame is None):
+                todo.append(ts)
+        ws.processing = set()
+        ws.stack = []
+        ws.stack_duration = ws.processing_duration = 0
+
+        pulled = set()  # dependents of lost data that were ready to run
+        for ts in lost:
+            needed = bool(ts.who_wants)
+            for dep in ts.dependents:
+                if dep.who_has or not dep.in_play:
+                    continue
+                needed = True
+                if dep.waiting_on is None:
+                    pulled.add(dep)
+                else:
+                    dep.waiting_on.add(ts)
+            ts.waiting_on = None
+            ts.waiters = None
+            if not needed:
+                continue
+            if ts.run_spec is None:  # scattered data, we can't recompute it
+                self.report({'op': 'lost-key', 'key': ts.key})
+            else:
+                todo.append(ts)
+
+        if pulled:
+            for other in self.worker_states.values():
+                if other.stack and not pulled.isdisjoint(other.stack):
+                    for ts in other.stack:
+                        if ts in pulled:
+                            other.stack_duration -= ts.duration or 0
+                            ts.duration = None
+                            self._stacked(other, ts, -1)
+                    other.stack = [ts for ts in other.stack
+                                   if ts not in pulled]
+                    self.occupancy.update(other.address)
+            for ts in pulled:
+                if ts.processing_on is not None:
+                    other = ts.processing_on
+                    self._remove_from_processing(other, ts)
+                    self.occupancy.update(other.address)
+            todo.extend(pulled)
+
+        ready = []
+        seen = set()
+        while todo:
+            ts = todo.pop()
+            if ts in seen:
+                continue
+            seen.add(ts)
+            ts.in_play = True
+            ts.waiting_on = set()
+            for dep in ts.dependencies:
+                if dep.waiters is None:
+                    dep.waiters = set()
+                dep.waiters.add(ts)
+                if dep.who_has:
+                    continue
+                ts.waiting_on.add(dep)
+                if (not dep.in_play and dep.run_spec is not None and
+                    dep.exception_blame is None):
+                    todo.append(dep)
+            ts.waiters = {dep for dep in ts.dependents
+                          if dep.in_play and not dep.who_has}
+            if not ts.waiting_on:
+                ready.append(ts)
+
+        logger.debug("Recompute %d keys, %d of them ready", len(seen),
+                     len(ready))
+        if self.worker_states:
+            for ts in sorted(ready, key=_priority, reverse=True):
+                self.mark_ready_to_run(ts)
+
     def my_heal_missing_data(self, missing):
-        """ Recover from lost data """
+        """ Recover from lost data
+
+        This does what ``heal_missing_data`` does on dictionaries.  We put
+        dependencies back into play before their dependents, with a stack
+        rather than by recursion so that long chains don't hit the recursion
+        limit.
+        """
         logger.debug("Heal from missing data")
-        return heal_missing_data(self.tasks, self.dependencies, self.dependents,
-                self.who_has, self.in_play, self.waiting,
-                self.waiting_data, missing)
+        for ts in missing:
+            ts.in_play = False
+
+        for ts in missing:
+            if ts.in_play:
+                continue
+            stack = [(ts, iter(ts.dependencies))]
+            while stack:
+                ts, deps = stack[-1]
+                for dep in deps:
+                    if not dep.in_play:
+                        stack.append((dep, iter(dep.dependencies)))
+                        break
+                    if dep.waiters is None:
+                        dep.waiters = set()
+                    dep.waiters.add(ts)
+                else:
+                    stack.pop()
+                    ts.waiting_on = {dep for dep in ts.dependencies
+                                     if not dep.who_has}
+                    logger.debug("Added key to waiting: %s", ts.key)
+                    ts.waiters = {dep for dep in ts.dependents
+                                  if dep.in_play and not dep.who_has}
+                    ts.in_play = True
+                    if stack:
+                        ts.waiters.add(stack[-1][0])
 
     def report(self, msg):
-        """ Publish updates to all listening Queues and Streams """
+        """ Publish updates to all listening Queues and Streams
+
+        Messages about a key only go to the streams of clients that want the
+        key.  Streams batch messages over ``batch_interval`` milliseconds, so
+        clients receive lists of messages.
+        """
         for q in self.report_queues:
             q.put_nowait(msg)
         if 'key' in msg:
-            streams = {self.streams.get(c, ())
-                       for c in self.who_wants.get(msg['key'], ())}
+            ts = self.task_states.get(msg['key'])
+            if ts is None or not ts.who_wants:
+                return
+            for client in ts.who_wants:
+                bstream = self.streams.get(client)
+                if bstream is not None:
+                    bstream.send(msg)
         else:
-            streams = self.streams.values()
-        for s in streams:
-            try:
-                write(s, msg)  # asynchrnous
-            except StreamClosedError:
-                logger.critical("Tried writing to closed stream: %s", msg)
+            for bstream in self.streams.values():
+                bstream.send(msg)
 
     def add_plugin(self, plugin):
         """ Add external plugin to scheduler
@@ -782,14 +2355,18 @@ class Scheduler(Server):
     def control_stream(self, stream, address=None, client=None):
         """ Listen to messages from an IOStream """
         logger.info("Connection to %s, %s", type(self).__name__, client)
-        self.streams[client] = stream
+        bstream = BatchedSend(self.batch_interval, loop=self.loop,
+                              limit=self.report_limit)
+        bstream.start(stream)
+        self.streams[client] = bstream
         try:
-            yield self.handle_messages(stream, stream, client=client)
+            yield self.handle_messages(stream, bstream, client=client)
         finally:
+            if self.streams.get(client) is bstream:
+                del self.streams[client]
             if not stream.closed():
-                yield write(stream, {'op': 'stream-closed'})
-                stream.close()
-            del self.streams[client]
+                bstream.send({'op': 'stream-closed'})
+            yield bstream.close()
             logger.info("Close connection to %s, %s", type(self).__name__,
                         client)
 
@@ -801,20 +2378,25 @@ class Scheduler(Server):
         """
         if isinstance(in_queue, Queue):
             next_message = in_queue.get
-        elif isinstance(in_queue, IOStream):
+        elif isinstance(in_queue, (IOStream, InProcStream)):
             next_message = lambda: read(in_queue)
         else:
             raise NotImplementedError()
 
         if isinstance(report, Queue):
             put = report.put_nowait
-        elif isinstance(report, IOStream):
+        elif isinstance(report, BatchedSend):
+            put = report.send
+        elif isinstance(report, (IOStream, InProcStream)):
             put = lambda msg: write(report, msg)
         else:
             put = lambda msg: None
         put({'op': 'stream-start'})
 
         while True:
+            if isinstance(report, BatchedSend) and report.full:
+                # the client reads slowly, don't take on more work for it
+                yield report.room.wait()
             try:
                 msg = yield next_message()  # in_queue.get()
             except (StreamClosedError, AssertionError):
@@ -854,82 +2436,88 @@ class Scheduler(Server):
     def worker(self, ident):
         """ Manage a single distributed worker node
 
-        This coroutine manages one remote worker.  It spins up several
-        ``worker_core`` coroutines, one for each core.  It reports a closed
-        connection to scheduler if one occurs.
-        """
-        try:
-            yield All([self.worker_core(ident, i)
-                    for i in range(self.ncores[ident])])
-        except (IOError, OSError):
-            logger.info("Worker failed from closed stream: %s", ident)
-            self.remove_worker(address=ident)
-
-    @gen.coroutine
-    def worker_core(self, ident, i):
-        """ Manage one core on one distributed worker node
+        This coroutine manages one remote worker.  It opens a single long-lived
+        stream to the worker's ``compute-stream`` handler.  ``ensure_occupied``
+        sends batches of ``compute-task`` messages over this stream and
+        ``worker_reports`` handles the batched reports that come back.
 
         This coroutine listens on worker_queue for the following operations
 
         **Incoming Messages**:
 
-        - compute-task:  call worker.compute(...) on remote node, report when done
         - close: close connection to worker node, report `worker-finished` to
           scheduler
 
+        It reports a closed connection to scheduler if one occurs.
+
         See Also
         --------
-        Scheduler.mark_task_finished
-        Scheduler.mark_task_erred
-        Scheduler.mark_missing_data
-        distributed.worker.Worker.compute
+        Scheduler.ensure_occupied
+        Scheduler.worker_reports
+        distributed.worker.Worker.compute_stream
         """
-        worker = rpc(ip=ident[0], port=ident[1])
-        logger.debug("Start worker core %s, %d", ident, i)
-
-        while True:
-            msg = yield self.worker_queues[ident].get()
-            if msg['op'] == 'close':
-                logger.debug("Worker core receives close message %s, %s",
-                        ident, msg)
-                break
-            if msg['op'] == 'compute-task':
-                key = msg['key']
-                who_has = msg['who_has']
-                task = msg['task']
-                if istask(task):
-                    task = {'task': task}
-                    serialized = False
-                else:
-                    serialized = True
-                response, content = yield worker.compute(who_has=who_has,
-                                                         key=key,
-                                                         report=self.center
-                                                                 is not None,
-                                            serialized=serialized,
-                                            **task)
-                if response == b'OK':
-                    nbytes = content['nbytes']
-                logger.debug("Compute response from worker %s, %s, %s, %s",
-                             ident, key, response, content)
-                if response == b'error':
-                    error, traceback = content
-                    self.mark_task_erred(key, ident, content['exception'],
-                                                     content['traceback'])
-
-                elif response == b'missing-data':
-                    self.mark_missing_data(content.args, key=key, worker=ident)
-
-                else:
-                    self.mark_task_finished(key, ident, nbytes,
-                                            type=content.get('type'))
-
-        yield worker.close(close=True)
-        worker.close_streams()
+        queue = self.worker_queues[ident]
+        bstream = self.worker_streams[ident]
+        try:
+            stream = yield connect(ident[0], ident[1],
+                                   compression=self.compression)
+            yield write(stream, {'op': 'compute-stream', 'reply': False})
+        except (IOError, OSError):
+            logger.info("Worker failed to connect: %s", ident)
+            self.remove_worker(address=ident)
+            stream = None
+        else:
+            logger.debug("Start worker stream %s", ident)
+            bstream.start(stream)
+            self.worker_reports(ident, stream, bstream)
+
+        msg = yield queue.get()
+        logger.debug("Worker receives close message %s, %s", ident, msg)
+        if stream is not None:
+            bstream.send({'op': 'close'})
+            yield bstream.close()
         if msg.get('report', True):
             self.put({'op': 'worker-finished',
                       'worker': ident})
-        logger.debug("Close worker core, %s, %d", ident, i)
+        logger.debug("Close worker, %s", ident)
+
+    @gen.coroutine
+    def worker_reports(self, ident, stream, bstream):
+        """ Handle batched reports from a worker
+
+        **Incoming Messages**:
+
+        - task-finished: see ``Scheduler.mark_task_finished``
+        - task-erred: see ``Scheduler.mark_task_erred``
+        - missing-data: see ``Scheduler.mark_missing_data``
+
+        See Also
+        --------
+        Scheduler.worker
+        distributed.worker.Worker.compute_stream
+        """
+        handlers = {'task-finished': self.mark_task_finished,
+                    'task-erred': self.mark_task_erred,
+                    'missing-data': self.mark_missing_data}
+        try:
+            while True:
+                msgs = yield read(stream)
+                if self.worker_streams.get(ident) is not bstream:
+                    break
+                if not isinstance(msgs, list):
+                    msgs = [msgs]
+                for msg in msgs:
+                    logger.debug("Compute response from worker %s, %s",
+                                 ident, msg)
+                    op = msg.pop('op')
+                    try:
+                        handlers[op](worker=ident, **msg)
+                    except Exception as e:
+                        logger.exception(e)
+        except (StreamClosedError, IOError, OSError):
+            if not bstream.please_stop:
+                logger.info("Worker failed from closed stream: %s", ident)
+                self.remove_worker(address=ident)
 
     @gen.coroutine
     def clear_data_from_workers(self):
@@ -943,7 +2531,8 @@ class Scheduler(Server):
             self.deleted_keys.clear()
 
             coroutines = [self.rpc(ip=worker[0], port=worker[1]).delete_data(
-                                   keys=keys - self.has_what[worker],
+                                   keys=keys - self.has_what.get(worker,
+                                                                 set()),
                                    report=False)
                           for worker, keys in d.items()]
             for worker, keys in d.items():
@@ -953,15 +2542,18 @@ class Scheduler(Server):
         raise Return(b'OK')
 
     def delete_data(self, stream=None, keys=None):
-        for key in keys:
-            for worker in self.who_has[key]:
-                self.has_what[worker].remove(key)
-                self.deleted_keys[worker].add(key)
-            del self.who_has[key]
-            if key in self.waiting_data:
-                del self.waiting_data[key]
-            if key in self.in_play:
-                self.in_play.remove(key)
+        self._delete_data([self.task_states[k] for k in keys
+                           if k in self.task_states])
+
+    def _delete_data(self, states):
+        """ Remove data from workers, see ``clear_data_from_workers`` """
+        for ts in states:
+            for ws in list(ts.who_has):
+                self._remove_replica(ts, ws)
+                self.deleted_keys[ws.address].add(ts.key)
+            ts.waiters = None
+            ts.in_play = False
+            self.release_state(ts)
 
     @gen.coroutine
     def scatter(self, stream=None, data=None, workers=None, client=None,
@@ -971,14 +2563,17 @@ class Scheduler(Server):
             raise ValueError("No workers yet found.  "
                              "Try syncing with center.\n"
                              "  e.sync_center()")
+        data_rpc = partial(rpc, compression=self.compression)
         if not broadcast:
-            ncores = workers if workers is not None else self.ncores
+            ncores = workers if workers is not None else dict(self.ncores)
             keys, who_has, nbytes = yield scatter_to_workers(ncores, data,
-                                                report=not not self.center)
+                                                report=not not self.center,
+                                                rpc=data_rpc)
         else:
             workers2 = workers if workers is not None else list(self.ncores)
             keys, nbytes = yield broadcast_to_workers(workers2, data,
-                                                      report=False)
+                                                      report=False,
+                                                      rpc=data_rpc)
             who_has = {k: set(workers2) for k in keys}
 
         self.update_data(who_has=who_has, nbytes=nbytes)
@@ -989,10 +2584,12 @@ class Scheduler(Server):
     def gather(self, stream=None, keys=None):
         """ Collect data in from workers """
         keys = list(keys)
-        who_has = {key: self.who_has[key] for key in keys}
+        who_has = {key: self.who_has.get(key, set()) for key in keys}
 
         try:
-            data = yield gather_from_workers(who_has)
+            data = yield gather_from_workers(who_has,
+                    rpc=partial(rpc, compression=self.compression,
+                                multiplex=True))
             result = (b'OK', data)
         except KeyError as e:
             logger.debug("Couldn't gather keys %s", e)
@@ -1008,7 +2605,8 @@ class Scheduler(Server):
         for q in self.scheduler_queues + self.report_queues:
             clear_queue(q)
 
-        nannies = {addr: d['nanny'] for addr, d in self.worker_services.items()}
+        nannies = {addr: ws.services['nanny']
+                   for addr, ws in self.worker_states.items()}
 
         for addr in nannies:
             self.remove_worker(address=addr, heal=False)
@@ -1019,7 +2617,7 @@ class Scheduler(Server):
         yield All([nanny.kill() for nanny in nannies])
         logger.debug("Received done signal from nannies")
 
-        while self.ncores:
+        while self.worker_states:
             yield gen.sleep(0.01)
 
         logger.debug("Workers all removed.  Sending startup signal")
@@ -1041,19 +2639,30 @@ class Scheduler(Server):
                 logger.exception(e)
 
     def validate(self, allow_overlap=False, allow_bad_stacks=False):
-        released = set(self.tasks) - self.in_play
-        validate_state(self.dependencies, self.dependents, self.waiting,
-                self.waiting_data, self.who_has, self.stacks,
-                self.processing, None, released, self.in_play, self.who_wants,
-                self.wants_what,
+        in_play = set(self.in_play)
+        released = set(self.tasks) - in_play
+        validate_state(dict(self.dependencies), dict(self.dependents),
+                dict(self.waiting), dict(self.waiting_data),
+                dict(self.who_has), dict(self.stacks), dict(self.processing),
+                None, released, in_play, dict(self.who_wants),
+                dict(self.wants_what),
                 allow_overlap=allow_overlap, allow_bad_stacks=allow_bad_stacks)
-        if not (set(self.ncores) == \
-                set(self.has_what) == \
-                set(self.stacks) == \
-                set(self.processing) == \
-                set(self.worker_services) == \
-                set(self.worker_queues)):
+        if not (set(self.worker_states) == \
+                set(self.worker_queues) == \
+                set(self.worker_streams)):
             raise ValueError("Workers not the same in all collections")
+        stacked = defaultdict(int)
+        for ws in self.worker_states.values():
+            clients = frequencies(ts.client for ts in ws.stack
+                                  if ts.client is not None)
+            if clients != ws.clients:
+                raise ValueError("Miscounted tasks per client in stack",
+                                 ws.address, clients, ws.clients)
+            for client, n in clients.items():
+                stacked[client] += n
+        if stacked != self.client_stacked:
+            raise ValueError("Miscounted tasks per client in stacks",
+                             dict(stacked), self.client_stacked)
 
     @gen.coroutine
     def feed(self, stream, function=None, setup=None, teardown=None, interval=1, **kwargs):
@@ -1074,33 +2683,177 @@ class Scheduler(Server):
 
     def get_who_has(self, stream, keys=None):
         if keys is not None:
-            return {k: self.who_has[k] for k in keys}
+            return {k: self.who_has.get(k, set()) for k in keys}
         else:
-            return self.who_has
+            return dict(self.who_has)
 
     def get_has_what(self, stream, keys=None):
         if keys is not None:
-            return {k: self.has_what[k] for k in keys}
+            return {k: self.has_what.get(k, set()) for k in keys}
         else:
-            return self.has_what
+            return dict(self.has_what)
+
+    def get_client_occupancy(self, stream=None):
+        """ Tasks that each client has processing, stacked and wanted
+
+        ``share`` is the fraction of all cores that the client's processing
+        tasks take up.
+        """
+        ncores = sum(ws.ncores or 1 for ws in self.worker_states.values())
+        clients = (set(self.client_wants) | set(self.client_processing) |
+                   set(self.client_stacked))
+        return {client: {'processing': self.client_processing.get(client, 0),
+                         'share': self.client_processing.get(client, 0) /
+                                  max(ncores, 1),
+                         'stacked': self.client_stacked.get(client, 0),
+                         'wants': len(self.client_wants.get(client, ()))}
+                for client in clients}
 
     def get_ncores(self, stream, addresses=None):
         if addresses is not None:
             return {k: self.ncores.get(k, None) for k in addresses}
         else:
-            return self.ncores
+            return dict(self.ncores)
 
     @gen.coroutine
     def broadcast(self, stream, msg=None):
         """ Broadcast message to workers, return all results """
-        workers = list(self.ncores)
+        workers = list(self.worker_states)
         results = yield All([send_recv(ip=ip, port=port, close=True, **msg)
                              for ip, port in workers])
         raise Return(dict(zip(workers, results)))
 
 
+class OccupancyIndex(object):
+    """ Heap of workers ordered by how busy they are
+
+    ``decide_worker`` uses this to find the least busy worker in
+    ``O(log(workers))`` rather than by looking at every worker.  By default a
+    worker is as busy as its stack is long.  The scheduler passes its own
+    ``cost`` function instead, see ``Scheduler.worker_load``.
+
+    The heap holds ``(cost, count, worker)`` entries and is lazy: entries may
+    be out of date, we check them against ``cost`` when they reach the top.
+    Costs may grow without telling the index but whenever a cost shrinks or a
+    worker arrives we must call ``update``.  Ties go to the worker that we
+    updated first.
+
+    >>> stacks = {'alice': ['x', 'y'], 'bob': ['z']}
+    >>> occupancy = OccupancyIndex(stacks)
+    >>> occupancy.best()
+    'bob'
+    >>> stacks['bob'].extend(['a', 'b'])
+    >>> occupancy.best()
+    'alice'
+    """
+    def __init__(self, stacks, cost=None):
+        self.stacks = stacks
+        self.cost = cost or (lambda worker: len(stacks[worker]))
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __str__(self):
+        return '<OccupancyIndex: %d workers, %d entries>' % (len(self.stacks),
+                                                             len(self.heap))
+
+    __repr__ = __str__
+
+    def rebuild(self):
+        """ Throw away all entries and index every worker again """
+        self.counter = 0
+        self.heap = []
+        for worker in self.stacks:
+            self.update(worker)
+
+    def update(self, worker):
+        """ Record the current cost of worker """
+        self.counter += 1
+        heapq.heappush(self.heap, (self.cost(worker), self.counter, worker))
+        if len(self.heap) > 2 * len(self.stacks) + 100:
+            self.rebuild()
+
+    def remove(self, worker):
+        """ Forget about a worker, we drop its entries when they surface """
+        if len(self.heap) > 2 * len(self.stacks) + 100:
+            self.rebuild()
+
+    def best(self):
+        """ The least busy worker, None if there are no workers """
+        heap = self.heap
+        while heap:
+            old, _, worker = heap[0]
+            if worker not in self.stacks:
+                heapq.heappop(heap)
+                continue
+            cost = self.cost(worker)
+            if cost != old:
+                self.counter += 1
+                heapq.heapreplace(heap, (cost, self.counter, worker))
+            else:
+                return worker
+        return None
+
+
+def order_keys(keys, dependencies, outputs=()):
+    """ Number keys depth first from the outputs, lower numbers run first
+
+    This finishes one subtree of the graph before moving on to the next.  We
+    only follow dependencies between the given keys and visit each key and
+    dependency once.  Outputs go in the given order, followed by any other
+    keys on which nothing depends.
+
+    >>> dependencies = {'a': set(), 'b': {'a'}, 'c': set(), 'd': {'b', 'c'},
+    ...                 'e': set()}
+    >>> o = order_keys('abcde', dependencies, outputs=['e', 'd'])
+    >>> o['e'], o['d']
+    (0, 1)
+    >>> o['b'] < o['a']
+    True
+
+    See Also
+    --------
+    Scheduler.prioritize
+    """
+    result = dict()
+    _exhaust(_order_keys_steps(keys, dependencies, outputs, result))
+    return result
+
+
+def _order_keys_steps(keys, dependencies, outputs, result, chunk=10000):
+    """ Steps of ``order_keys``, fill in result and yield every chunk keys """
+    keys = list(keys)
+    keyset = set(keys)
+    depended_on = set()
+    for i, key in enumerate(keys):
+        if i and not i % chunk:
+            yield
+        for dep in dependencies[key]:
+            if dep in keyset:
+                depended_on.add(dep)
+
+    roots = []
+    for i, k in enumerate(chain(outputs, keys)):
+        if i and not i % chunk:
+            yield
+        if k in keyset and k not in depended_on:
+            roots.append(k)
+
+    stack = roots[::-1]
+    while stack:
+        key = stack.pop()
+        if key in result:
+            continue
+        result[key] = len(result)
+        if not len(result) % chunk:
+            yield
+        stack.extend(dep for dep in dependencies[key]
+                     if dep in keyset and dep not in result)
+
+
 def decide_worker(dependencies, stacks, who_has, restrictions,
-                  loose_restrictions, nbytes, key):
+                  loose_restrictions, nbytes, key, occupancy=None, full=()):
     """ Decide which worker should take task
 
     >>> dependencies = {'c': {'b'}, 'b': {'a'}}
@@ -1141,11 +2894,35 @@ def decide_worker(dependencies, stacks, who_has, restrictions,
 
     >>> decide_worker(dependencies, stacks, who_has, {}, set(), nbytes, 'c')
     ('bob', 8000)
+
+    If nobody holds any dependencies then any worker will do and we choose the
+    one with the shortest stack.  Provide an ``OccupancyIndex`` to find it
+    without looking at every worker.  Its ``cost`` then also measures how busy
+    workers are instead of the lengths of their stacks.
+
+    >>> dependencies = {'d': set()}
+    >>> stacks = {('alice', 8000): ['x'], ('bob', 8000): []}
+    >>> occupancy = OccupancyIndex(stacks)
+    >>> decide_worker(dependencies, stacks, {}, {}, set(), {}, 'd',
+    ...               occupancy=occupancy)
+    ('bob', 8000)
+
+    Workers in ``full`` are near their memory limit.  We avoid them, even if
+    that means moving data, as long as some other worker may run the task.
+
+    >>> dependencies = {'b': {'a'}}
+    >>> who_has = {'a': {('alice', 8000)}}
+    >>> nbytes = {'a': 100}
+    >>> decide_worker(dependencies, stacks, who_has, {}, set(), nbytes, 'b',
+    ...               full={('alice', 8000)})
+    ('bob', 8000)
     """
     deps = dependencies[key]
     workers = frequencies(w for dep in deps
                             for w in who_has[dep])
     if not workers:
+        if occupancy is not None and key not in restrictions and stacks:
+            return occupancy.best()
         workers = stacks
     if key in restrictions:
         r = restrictions[key]
@@ -1155,9 +2932,18 @@ def decide_worker(dependencies, stacks, who_has, restrictions,
             if not workers:
                 if key in loose_restrictions:
                     return decide_worker(dependencies, stacks, who_has,
-                                         {}, set(), nbytes, key)
+                                         {}, set(), nbytes, key, occupancy,
+                                         full)
                 else:
                     raise ValueError("Task has no valid workers", key, r)
+    if full:
+        roomy = {w for w in workers if w not in full}
+        if not roomy:
+            r = restrictions.get(key)
+            roomy = {w for w in stacks
+                     if w not in full and (r is None or w[0] in r)}
+        if roomy:
+            workers = roomy
     if not workers or not stacks:
         raise ValueError("No workers found")
 
@@ -1168,7 +2954,10 @@ def decide_worker(dependencies, stacks, who_has, restrictions,
     minbytes = min(commbytes.values())
 
     workers = {w for w, nb in commbytes.items() if nb == minbytes}
-    worker = min(workers, key=lambda w: len(stacks[w]))
+    if occupancy is not None:
+        worker = min(workers, key=occupancy.cost)
+    else:
+        worker = min(workers, key=lambda w: len(stacks[w]))
     return worker
 
 
@@ -1181,7 +2970,9 @@ def update_state(tasks, dependencies, dependents, who_wants, wants_what,
     This should operate in linear time relative to the size of edges of the
     added graph.  It assumes that the current runtime state is valid.
     """
-    tasks.update(new_tasks)
+    for key, task in new_tasks.items():
+        if key not in tasks:  # don't overwrite work already underway
+            tasks[key] = task
     if not isinstance(new_keys, set):
         new_keys = set(new_keys)
 
@@ -1427,8 +3218,186 @@ def heal(dependencies, dependents, who_has, stacks, processing, waiting,
 _round_robin = [0]
 
 
+def independent_group(tasks, keys, dependencies, known_tasks, who_has):
+    """ Shared dependencies of a group of independent new tasks, else None
+
+    A group qualifies for ``Scheduler.add_independent_group`` if it has more
+    than one task, asks for all of them and none of them is known yet, not
+    even as data.  All tasks must depend on the same data, which is already
+    in memory on at least one worker, like the tasks of ``Executor.map`` over
+    a sequence and some futures.  We check the cheap things first so that
+    other graphs fail fast.
+
+    >>> independent_group({'x': 1, 'y': 2}, ['x', 'y'],
+    ...                   {'x': {'a'}, 'y': {'a'}}, {}, {'a': {'alice'}})
+    {'a'}
+    >>> independent_group({'x': 1, 'y': 2}, ['x', 'y'],
+    ...                   {'x': set(), 'y': {'x'}}, {}, {})  # y needs x
+    """
+    group = []
+    _exhaust(_independent_group_steps(tasks, keys, dependencies, known_tasks,
+                                      who_has, group))
+    return group[0] if group else None
+
+
+def _independent_group_steps(tasks, keys, dependencies, known_tasks, who_has,
+                             group, chunk=10000):
+    """ Steps of ``independent_group``, one per chunk of keys
+
+    We append the shared dependencies to ``group`` if the group qualifies.
+    ``known_tasks`` holds all keys that we know, also those only as data, so
+    we look up each key rather than compare whole sets.
+    """
+    if (len(tasks) < 2 or len(keys) != len(tasks) or
+        len(dependencies) != len(tasks)):
+        return
+    shared = set(dependencies.get(keys[0], ()))
+    if shared and not set.intersection(*[set(who_has.get(dep, ()))
+                                         for dep in shared]):
+        return
+    seen = set()
+    values = iter(dependencies.values())
+    for start in range(0, len(keys), chunk):
+        if start:
+            yield
+        part = keys[start:start + chunk]
+        seen.update(part)
+        if (not all(map(tasks.__contains__, part)) or
+            any(map(known_tasks.__contains__, part))):
+            return
+        if not shared:
+            if any(islice(values, chunk)):
+                return
+        else:
+            for key in part:
+                deps = dependencies.get(key, ())
+                if len(deps) != len(shared) or not shared.issuperset(deps):
+                    return
+    # so keys are all the tasks, none of which we share
+    if len(seen) == len(keys) and shared.isdisjoint(seen):
+        group.append(shared)
+
+
+def group_leaves(leaves, dependents, depth=2, limit=None):
+    """ Group ordered leaves that feed the same tasks
+
+    Leaves that share a dependent up to ``depth`` levels above them, like the
+    inputs of a reduction or the blocks of two arrays that we add, end up in
+    the same group.  We stop growing groups at ``limit`` leaves.  Groups come
+    in the order of their first leaves and keep the order of their leaves.
+
+    Parameters
+    ----------
+    leaves: list
+        Keys or ``TaskState`` objects in order of priority
+    dependents: callable
+        Gives the dependents of a leaf or of one of its dependents
+
+    >>> dependents = {'a': ['x'], 'b': ['y'], 'c': ['x'], 'd': ['y']}
+    >>> group_leaves(['a', 'b', 'c', 'd'], lambda k: dependents.get(k, ()))
+    [['a', 'c'], ['b', 'd']]
+    """
+    parent = dict()
+    size = dict()  # leaves under each root
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(x, y):
+        x, y = find(x), find(y)
+        if x == y or limit is not None and size[x] + size[y] > limit:
+            return
+        if size[x] < size[y]:
+            x, y = y, x
+        parent[y] = x
+        size[x] += size[y]
+
+    for leaf in leaves:
+        parent[leaf] = leaf
+        size[leaf] = 1
+
+    frontier = leaves  # closer relatives join first, one level at a time
+    for _ in range(depth):
+        upper = []
+        for node in frontier:
+            for dep in dependents(node):
+                if dep not in parent:
+                    parent[dep] = dep
+                    size[dep] = 0
+                    upper.append(dep)
+                union(node, dep)
+        frontier = upper
+
+    groups = dict()
+    roots = []
+    for leaf in leaves:
+        root = find(leaf)
+        if root not in groups:
+            groups[root] = []
+            roots.append(root)
+        groups[root].append(leaf)
+    return [groups[root] for root in roots]
+
+
+def split_leaves(leaves, stacks, dependents=None, depth=2):
+    """ Split ordered leaves into one contiguous run per worker
+
+    Neighboring leaves often share dependents, so we keep them together.  The
+    first run goes to a different worker each time.  Runs come reversed
+    because workers pop tasks from the end of their stacks.
+
+    >>> split_leaves(['a', 'b', 'c', 'd', 'e'], {'alice': [], 'bob': []})  # doctest: +SKIP
+    {'alice': ['c', 'b', 'a'], 'bob': ['e', 'd']}
+
+    Given ``dependents`` we also keep leaves together that aren't neighbors
+    but feed the same tasks, see ``group_leaves``.  We only cut runs between
+    groups, wherever that gets us closest to an even split.
+
+    >>> dependents = {'a': ['x'], 'b': ['y'], 'c': ['x'], 'd': ['y']}
+    >>> split_leaves(['a', 'b', 'c', 'd'], {'alice': [], 'bob': []},
+    ...              lambda k: dependents.get(k, ()))  # doctest: +SKIP
+    {'alice': ['c', 'a'], 'bob': ['d', 'b']}
+    """
+    workers = list(stacks)
+
+    k = _round_robin[0] % len(workers)
+    workers = workers[k:] + workers[:k]
+    _round_robin[0] += 1
+
+    if dependents is None:
+        groups = [[leaf] for leaf in leaves]
+    else:
+        groups = group_leaves(leaves, dependents, depth,
+                              int(ceil(len(leaves) / len(workers))))
+
+    result = dict()
+    remaining = len(leaves)
+    target = remaining / len(workers)
+    run = []
+    i = 0
+    for group in groups:
+        # cut when adding the group overshoots more than leaving it undershoots
+        if (run and i < len(workers) - 1 and
+            2 * len(run) + len(group) > 2 * target):
+            result[workers[i]] = run[::-1]
+            remaining -= len(run)
+            i += 1
+            target = remaining / (len(workers) - i)
+            run = []
+        run.extend(group)
+    if run:
+        result[workers[i]] = run[::-1]
+    return result
+
+
 def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
-        restrictions, loose_restrictions, nbytes, keys):
+        restrictions, loose_restrictions, nbytes, keys, occupancy=None,
+        full=()):
     """ Assign many new ready tasks to workers
 
     Often at the beginning of computation we have to assign many new leaves to
@@ -1440,7 +3409,8 @@ def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
 
     This mutates waiting and stacks in place and returns a dictionary,
     new_stacks, that serves as a diff between the old and new stacks.  These
-    new tasks have yet to be put on worker queues.
+    new tasks have yet to be put on worker queues.  Workers in ``full`` only
+    get tasks when no other worker may run them, see ``decide_worker``.
     """
     leaves = list()  # ready tasks without data dependencies
     ready = list()   # ready tasks with data dependencies
@@ -1456,23 +3426,21 @@ def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
     if not stacks:
         raise ValueError("No workers found")
 
-    leaves = sorted(leaves, key=keyorder.get)
-
-    workers = list(stacks)
-
-    k = _round_robin[0] % len(workers)
-    workers = workers[k:] + workers[:k]
-    _round_robin[0] += 1
+    dependents = defaultdict(list)
+    for key, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(key)
 
-    k = int(ceil(len(leaves) / len(workers)))
-    for i, worker in enumerate(workers):
-        keys = leaves[i*k: (i + 1)*k][::-1]
+    leaves = sorted(leaves, key=keyorder.get)
+    roomy = {w: stack for w, stack in stacks.items() if w not in full}
+    for worker, keys in split_leaves(leaves, roomy or stacks,
+                                     lambda k: dependents.get(k, ())).items():
         new_stacks[worker].extend(keys)
         stacks[worker].extend(keys)
 
     for key in ready:
         worker = decide_worker(dependencies, stacks, who_has, restrictions,
-                loose_restrictions, nbytes, key)
+                loose_restrictions, nbytes, key, occupancy, full)
         new_stacks[worker].append(key)
         stacks[worker].append(key)
 
@@ -1484,27 +3452,36 @@ def heal_missing_data(tasks, dependencies, dependents,
     """ Return to healthy state after discovering missing data
 
     When we identify that we're missing certain keys we rewind runtime state to
-    evaluate those keys.
+    evaluate those keys.  We walk dependencies before their dependents with a
+    stack rather than by recursion so that long chains don't hit the
+    recursion limit.
     """
     logger.debug("Healing missing: %s", missing)
     for key in missing:
         if key in in_play:
             in_play.remove(key)
 
-    def ensure_key(key):
-        if key in in_play:
-            return
-        for dep in dependencies[key]:
-            ensure_key(dep)
-            waiting_data[dep].add(key)
-        waiting[key] = {dep for dep in dependencies[key] if not who_has.get(dep)}
-        logger.debug("Added key to waiting: %s", key)
-        waiting_data[key] = {dep for dep in dependents[key] if dep in in_play
-                                                    and not who_has.get(dep)}
-        in_play.add(key)
-
     for key in missing:
-        ensure_key(key)
+        if key in in_play:
+            continue
+        stack = [(key, iter(dependencies[key]))]
+        while stack:
+            key, deps = stack[-1]
+            for dep in deps:
+                if dep not in in_play:
+                    stack.append((dep, iter(dependencies[dep])))
+                    break
+                waiting_data[dep].add(key)
+            else:
+                stack.pop()
+                waiting[key] = {dep for dep in dependencies[key]
+                                if not who_has.get(dep)}
+                logger.debug("Added key to waiting: %s", key)
+                waiting_data[key] = {dep for dep in dependents[key]
+                                     if dep in in_play and not who_has.get(dep)}
+                in_play.add(key)
+                if stack:
+                    waiting_data[key].add(stack[-1][0])
 
     assert set(missing).issubset(in_play)
 
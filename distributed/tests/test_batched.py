@@ -0,0 +1,169 @@
+from time import time
+
+from tornado import gen
+
+from distributed.batched import BatchedSend
+from distributed.core import Server, connect, read, write
+from distributed.utils_test import loop
+
+
+class EchoServer(Server):
+    """ Echo every message back over the same stream until the stream closes
+    """
+    def __init__(self):
+        self.count = 0
+        super(EchoServer, self).__init__({'echo': self.echo})
+
+    @gen.coroutine
+    def echo(self, stream):
+        while True:
+            try:
+                msg = yield read(stream)
+            except Exception:
+                break
+            self.count += 1
+            yield write(stream, msg)
+
+
+@gen.coroutine
+def echo_stream(server):
+    stream = yield connect('127.0.0.1', server.port)
+    yield write(stream, {'op': 'echo', 'reply': False})
+    raise gen.Return(stream)
+
+
+def test_BatchedSend(loop):
+    @gen.coroutine
+    def f():
+        server = EchoServer()
+        server.listen(0)
+        stream = yield echo_stream(server)
+
+        b = BatchedSend(interval=10)
+        assert str(len(b.buffer)) in str(b)
+        b.send('hello')  # buffered until we have a stream
+        b.start(stream)
+
+        result = yield read(stream)
+        assert result == ['hello']
+
+        b.send('world')
+        b.send('HELLO')
+        b.send('HELLO')
+        result = yield read(stream)
+        assert result == ['world', 'HELLO', 'HELLO']
+        assert b.message_count == 4
+        assert b.batch_count == 2
+
+        yield b.close()
+        assert stream.closed()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_send_before_quiet_period_is_batched(loop):
+    @gen.coroutine
+    def f():
+        server = EchoServer()
+        server.listen(0)
+        stream = yield echo_stream(server)
+
+        b = BatchedSend(interval=20)
+        b.start(stream)
+        b.send('a')
+        result = yield read(stream)
+        assert result == ['a']  # goes out right away
+
+        start = time()
+        for i in range(100):
+            b.send(i)
+            yield gen.sleep(0)
+        result = yield read(stream)
+        assert result == list(range(100))
+        assert time() - start >= 0.015
+
+        yield b.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_close_flushes_buffer(loop):
+    @gen.coroutine
+    def f():
+        server = EchoServer()
+        server.listen(0)
+        stream = yield echo_stream(server)
+
+        b = BatchedSend(interval=1000)
+        b.start(stream)
+        b.send('a')
+        result = yield read(stream)
+        b.send('b')
+        b.send('c')
+        yield b.close(close_stream=False)
+        result = yield read(stream)
+        assert result == ['b', 'c']
+        stream.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_unserializable_message_is_dropped(loop):
+    class Unpicklable(object):
+        def __reduce__(self):
+            raise TypeError("Can't pickle me")
+
+    @gen.coroutine
+    def f():
+        server = EchoServer()
+        server.listen(0)
+        stream = yield echo_stream(server)
+
+        b = BatchedSend(interval=10)
+        b.send('a')
+        b.send(Unpicklable())
+        b.send('b')
+        b.start(stream)
+
+        result = yield read(stream)
+        assert result == ['a']
+        result = yield read(stream)
+        assert result == ['b']
+
+        b.send('c')  # the stream still works
+        result = yield read(stream)
+        assert result == ['c']
+
+        yield b.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_limit_signals_room(loop):
+    @gen.coroutine
+    def f():
+        server = EchoServer()
+        server.listen(0)
+        stream = yield echo_stream(server)
+
+        b = BatchedSend(interval=10, limit=3)
+        b.send('a')
+        b.send('b')
+        assert not b.full and b.room.is_set()
+        b.send('c')
+        assert b.full and not b.room.is_set()
+
+        b.start(stream)
+        yield b.room.wait()
+        assert not b.full
+        result = yield read(stream)
+        assert result == ['a', 'b', 'c']
+
+        yield b.close()
+        server.stop()
+
+    loop.run_sync(f)
@@ -17,14 +17,16 @@ def test_metadata():
     stream = yield TCPClient().connect('127.0.0.1', 8006)
 
     cc = rpc(stream)
-    response = yield cc.register(address='alice', ncores=4)
+    response = yield cc.register(address='alice', ncores=4,
+                                 memory_limit=1000)
     assert 'alice' in c.has_what
     assert c.ncores['alice'] == 4
 
     response = yield cc.add_keys(address='alice', keys=['x', 'y'])
     assert response == b'OK'
 
-    response = yield cc.register(address='bob', ncores=4)
+    response = yield cc.register(address='bob', ncores=4,
+                                 resources={'GPU': 2})
     response = yield cc.add_keys(address='bob', keys=['y', 'z'])
     assert response == b'OK'
 
@@ -42,10 +44,17 @@ def test_metadata():
     response = yield cc.ncores(addresses=['alice', 'charlie'])
     assert response == {'alice': 4, 'charlie': None}
 
+    response = yield cc.memory_limit()
+    assert response == {'alice': 1000, 'bob': None}
+    response = yield cc.resources()
+    assert response == {'alice': {}, 'bob': {'GPU': 2}}
+
     response = yield cc.unregister(address='alice', close=True)
     assert response == b'OK'
     assert 'alice' not in c.has_what
     assert 'alice' not in c.ncores
+    assert 'alice' not in c.memory_limit
+    assert 'alice' not in c.resources
 
     yield c.terminate()
 
@@ -2,11 +2,17 @@ from functools import partial
 from multiprocessing import Process
 import socket
 
+from time import time
+
 from tornado import gen, ioloop
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
 import pytest
 
 from distributed.core import (read, write, pingpong, Server, rpc, connect,
-        coerce_to_rpc)
+        coerce_to_rpc, sentinel, dumps, loads, ConnectionPool, default_pool,
+        Multiplexer, read_frames)
+from distributed.protocol import compressions, choose_compression
 from distributed.utils_test import slow, loop
 
 def test_server(loop):
@@ -72,6 +78,296 @@ def test_rpc_with_many_connections(loop):
     loop.run_sync(f)
 
 
+def test_connection_pool(loop):
+    @gen.coroutine
+    def slow_ping(stream, delay=0.01):
+        yield gen.sleep(delay)
+        raise gen.Return(b'pong')
+
+    @gen.coroutine
+    def f():
+        servers = [Server({'ping': slow_ping}) for i in range(3)]
+        for server in servers:
+            server.listen(0)
+
+        pool = ConnectionPool(limit=4, limit_per_peer=2)
+        remotes = [rpc(ip='127.0.0.1', port=server.port, pool=pool)
+                   for server in servers]
+
+        # sequential calls reuse one stream
+        for i in range(5):
+            response = yield remotes[0].ping()
+            assert response == b'pong'
+        assert pool.connections == 1
+        assert pool.hits == 4 and pool.misses == 1
+        assert pool.open == 1
+
+        # concurrent calls respect the per-peer limit
+        responses = yield [remotes[0].ping() for i in range(10)]
+        assert responses == [b'pong'] * 10
+        assert pool.open == 2
+        assert pool.connections == 2
+
+        # the total limit evicts idle streams of other peers
+        yield [remotes[1].ping() for i in range(2)]
+        assert pool.open == 4
+        yield [remotes[2].ping() for i in range(2)]
+        assert pool.open == 4
+        assert pool.evictions == 2
+        assert len(pool.available[('127.0.0.1', servers[2].port)]) == 2
+
+        # closed streams leave the pool
+        yield remotes[1].ping(close=True)
+        assert pool.open == 3
+        stream = yield pool.connect('127.0.0.1', servers[2].port)
+        pool.reuse(stream)
+        stream.close()
+        yield gen.sleep(0.01)
+        assert stream not in pool.streams
+        assert pool.open == 2
+
+        remotes[2].close_streams()
+        assert pool.open == 1
+        pool.close()
+        assert pool.open == 0
+
+        for server in servers:
+            server.stop()
+
+    loop.run_sync(f)
+
+
+def test_rpc_uses_default_pool(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'ping': pingpong})
+        server.listen(8887)
+        pool = default_pool()
+        assert default_pool() is pool
+        before = pool.connections
+
+        remote = rpc(ip='127.0.0.1', port=8887)
+        yield remote.ping()
+        yield rpc(ip='127.0.0.1', port=8887).ping()
+        assert pool.connections == before + 1
+
+        remote.close_streams()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+@gen.coroutine
+def sleep_and_echo(stream, x=None, delay=0):
+    yield gen.sleep(delay)
+    raise gen.Return(x)
+
+
+def test_tagged_requests_reply_out_of_order(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': sleep_and_echo})
+        server.listen(0)
+        stream = yield connect('127.0.0.1', server.port)
+        assert stream.peer_multiplex
+
+        yield write(stream, {'op': 'echo', 'x': 'slow', 'delay': 0.2,
+                             'rid': 1})
+        yield write(stream, {'op': 'echo', 'x': 'fast', 'rid': 2})
+        start = time()
+        response = yield read(stream)
+        assert response == {'rid': 2, 'status': 'OK', 'result': 'fast'}
+        assert time() - start < 0.15
+        response = yield read(stream)
+        assert response == {'rid': 1, 'status': 'OK', 'result': 'slow'}
+
+        # untagged messages are still handled in order
+        yield write(stream, {'op': 'echo', 'x': 1, 'delay': 0.02})
+        yield write(stream, {'op': 'echo', 'x': 2})
+        response = yield read(stream)
+        assert response == 1
+        response = yield read(stream)
+        assert response == 2
+
+        stream.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_multiplexer(loop):
+    def bad(stream):
+        raise ZeroDivisionError('bad')
+
+    @gen.coroutine
+    def f():
+        server = Server({'echo': sleep_and_echo, 'bad': bad})
+        server.listen(0)
+        stream = yield connect('127.0.0.1', server.port)
+        mux = Multiplexer(stream)
+
+        results = yield [mux.send_recv(op='echo', x=i, delay=(10 - i) / 100.)
+                         for i in range(10)]
+        assert results == list(range(10))
+        assert not mux.pending
+
+        with pytest.raises(ZeroDivisionError):
+            yield mux.send_recv(op='bad')
+        result = yield mux.send_recv(op='echo', x=1)  # stream still works
+        assert result == 1
+
+        future = mux.send_recv(op='echo', x=1, delay=1)
+        yield gen.sleep(0.01)
+        server.stop()
+        stream.close()
+        with pytest.raises(StreamClosedError):
+            yield future
+        assert not mux.pending
+
+    loop.run_sync(f)
+
+
+def test_tagged_requests_per_connection_limit(loop):
+    running = [0, 0]  # now, at most
+
+    @gen.coroutine
+    def slow(stream):
+        running[0] += 1
+        running[1] = max(running)
+        yield gen.sleep(0.05)
+        running[0] -= 1
+
+    @gen.coroutine
+    def f():
+        server = Server({'slow': slow, 'echo': sleep_and_echo},
+                        concurrency=2)
+        server.listen(0)
+        stream = yield connect('127.0.0.1', server.port)
+        mux = Multiplexer(stream)
+        futures = [mux.send_recv(op='slow') for i in range(6)]
+
+        # untagged requests don't wait for slots
+        other = yield connect('127.0.0.1', server.port)
+        start = time()
+        yield write(other, {'op': 'echo', 'x': 1})
+        result = yield read(other)
+        assert result == 1
+        assert time() - start < 0.05
+
+        yield futures
+        assert running[1] == 2
+        assert server.queued_handlers == 4
+        assert 0.04 < server.max_queue_time < 0.5
+        assert server.max_queue_time < server.queue_time
+
+        stream.close()
+        other.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_metrics(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': sleep_and_echo})
+        server.listen(0)
+        pool = ConnectionPool()
+        remote = rpc(ip='127.0.0.1', port=server.port, pool=pool)
+        mremote = rpc(ip='127.0.0.1', port=server.port, pool=pool,
+                      multiplex=True)
+        data = b'0' * 100000
+        for i in range(5):
+            yield remote.echo(x=data, delay=0.01)
+        yield [mremote.echo(x=data, delay=0.01) for i in range(5)]
+
+        hists = server.metrics.ops['echo']
+        assert hists['handler'].count == 10
+        assert 0.01 <= hists['handler'].min < 1
+        for name in ['bytes-in', 'bytes-out']:
+            assert hists[name].count == 10
+            assert hists[name].min > len(data)
+        assert hists['deserialize'].count == hists['serialize'].count == 10
+
+        hists = pool.metrics.ops['echo']
+        assert hists['latency'].count == 10
+        assert hists['latency'].min >= 0.01
+        assert hists['bytes-in'].count == hists['bytes-out'].count == 10
+        assert hists['bytes-in'].min > len(data)
+
+        response = yield remote.metrics()
+        assert response['server']['echo']['handler']['count'] == 10
+        assert 'rpc' in response
+
+        pool.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_loop_monitor(loop):
+    @gen.coroutine
+    def f():
+        server = Server({}, loop_interval=10)
+        assert not server.loop_monitor.running
+        server.listen(0)
+        assert server.loop_monitor.running
+        remote = rpc(ip='127.0.0.1', port=server.port)
+        yield gen.sleep(0.05)
+
+        response = yield remote.loop_monitor()
+        assert response['lag']['count'] > 1
+        assert response['stalls'] == []
+
+        remote.close_streams()
+        server.stop()
+        assert not server.loop_monitor.running
+
+        server = Server({})  # off by default
+        server.listen(0)
+        assert server.loop_monitor is None
+        remote = rpc(ip='127.0.0.1', port=server.port)
+        response = yield remote.loop_monitor()
+        assert response is None
+        remote.close_streams()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_rpc_multiplex_shares_one_stream(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': sleep_and_echo})
+        server.listen(0)
+        pool = ConnectionPool()
+        remotes = [rpc(ip='127.0.0.1', port=server.port, pool=pool,
+                       multiplex=True) for i in range(3)]
+
+        start = time()
+        results = yield [r.echo(x=i, delay=0.1)
+                         for i in range(100) for r in remotes]
+        assert time() - start < 1
+        assert sorted(results) == sorted(list(range(100)) * 3)
+        assert pool.open == 0  # multiplexed streams don't count
+        assert len(pool.multiplexers) == 1
+        identity = yield remotes[0].identity()
+        assert identity['type'] == 'Server'
+
+        mux = pool.multiplexers[('127.0.0.1', server.port)].result()
+        remotes[0].close_streams()
+        assert mux.closed()
+        assert not pool.multiplexers
+
+        result = yield remotes[1].echo(x=1)  # reconnects
+        assert result == 1
+        pool.close()
+        assert not pool.multiplexers
+        server.stop()
+
+    loop.run_sync(f)
+
+
 @slow
 def test_large_packets(loop):
     """ tornado has a 100MB cap by default """
@@ -146,3 +442,213 @@ def test_coerce_to_rpc():
     assert (r.ip, r.port) == ('127.0.0.1', 8000)
     r = coerce_to_rpc('127.0.0.1:8000')
     assert (r.ip, r.port) == ('127.0.0.1', 8000)
+
+
+def test_handshake_negotiates_frames(loop):
+    def echo(stream, x):
+        return x
+
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo})
+        server.listen(8887)
+
+        stream = yield connect('127.0.0.1', 8887)
+        assert stream.protocol == 'frames'
+
+        data = b'123' + sentinel + b'456'  # sentinel within payload is fine
+        yield write(stream, {'op': 'echo', 'x': data})
+        response = yield read(stream)
+        assert response == data
+
+        stream.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_handshake_without_common_protocol(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'ping': pingpong}, protocols=())
+        server.listen(8887)
+
+        stream = yield connect('127.0.0.1', 8887)
+        assert stream.protocol is None
+
+        yield write(stream, {'op': 'ping'})
+        response = yield read(stream)
+        assert response == b'pong'
+
+        stream.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_large_frames_arrive_writeable(loop):
+    np = pytest.importorskip('numpy')
+
+    def echo(stream, x):
+        return x
+
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo})
+        server.listen(8887)
+
+        for compression in [None, 'zlib']:
+            stream = yield connect('127.0.0.1', 8887)
+            stream.compression = compression
+            x = np.arange(100000)
+            data = b'0' * 300000
+            yield write(stream, {'op': 'echo', 'x': [x, data]})
+            y, data2 = yield read(stream)
+            assert (y == x).all()
+            assert y.flags.writeable
+            y[0] = -1
+            assert type(data2) is bytes and data2 == data
+            stream.close()
+
+        stream = yield connect('127.0.0.1', 8887)
+        yield write(stream, {'op': 'echo', 'x': np.arange(100000)})
+        frames = yield read_frames(stream)
+        assert type(frames[0]) is bytes  # the header
+        assert [type(frame) for frame in frames[1:]] == [bytearray]
+
+        stream.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+class LegacyServer(TCPServer):
+    """ Speaks only the sentinel-delimited protocol, like older versions """
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        while True:
+            msg = yield stream.read_until(sentinel)
+            msg = loads(msg[:-len(sentinel)])
+            if msg['op'] == 'ping':
+                result = b'pong'
+            else:
+                result = b'No handler found: ' + msg['op'].encode()
+            yield stream.write(dumps(result) + sentinel)
+
+
+def test_connect_to_legacy_server(loop):
+    @gen.coroutine
+    def f():
+        server = LegacyServer()
+        server.listen(8887)
+
+        stream = yield connect('127.0.0.1', 8887)
+        assert stream.protocol is None
+
+        yield write(stream, {'op': 'ping'})
+        response = yield read(stream)
+        assert response == b'pong'
+
+        remote = rpc(ip='127.0.0.1', port=8887)
+        response = yield remote.ping()
+        assert response == b'pong'
+
+        stream.close()
+        remote.close_streams()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_rpc_multiplex_falls_back_with_legacy_server(loop):
+    @gen.coroutine
+    def f():
+        server = LegacyServer()
+        server.listen(8887)
+        pool = ConnectionPool()
+        remote = rpc(ip='127.0.0.1', port=8887, pool=pool,
+                     multiplex=True)
+        response = yield remote.ping()
+        assert response == b'pong'
+        assert pool.connections == 1
+        assert pool.multiplexers[('127.0.0.1', 8887)].result() is None
+
+        pool.close()
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_compression_negotiation(loop):
+    def get_compression(stream):
+        return stream.compression
+
+    def echo(stream, x):
+        return x
+
+    @gen.coroutine
+    def f():
+        data = b'1,Alice,100\n2,Bob,200\n' * 100000
+        for server_setting, client_setting in [('zlib', None), (None, 'auto'),
+                                               ('auto', 'zlib')]:
+            server = Server({'compression': get_compression, 'echo': echo},
+                            compression=server_setting)
+            server.listen(8887)
+            stream = yield connect('127.0.0.1', 8887,
+                                   compression=client_setting,
+                                   transports=('tcp',))
+            assert stream.compression == choose_compression(client_setting,
+                                                            compressions)
+
+            yield write(stream, {'op': 'compression'})
+            response = yield read(stream)
+            assert response == choose_compression(server_setting,
+                                                  compressions)
+
+            yield write(stream, {'op': 'echo', 'x': data})
+            response = yield read(stream)
+            assert response == data
+
+            stream.close()
+            server.stop()
+
+    loop.run_sync(f)
+
+
+def test_server_rejects_unknown_compression():
+    with pytest.raises(ValueError):
+        Server({}, compression='foo')
+
+
+@slow
+@pytest.mark.parametrize('n', [int(1e3), int(1e6), int(1e8), int(1e9)])
+def test_bandwidth(loop, n):
+    """ Compare throughput of framed and sentinel protocols
+
+    Run with ``py.test --runslow -s`` to see MB/s
+    """
+    def echo(stream, x):
+        return x
+
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo})
+        server.listen(8887)
+        data = b'0' * n
+        repeats = max(1, min(1000, int(1e9 // n)))
+
+        for name, protocols in [('frames', ('frames',)), ('sentinel', ())]:
+            stream = yield connect('127.0.0.1', 8887, protocols=protocols)
+            start = time()
+            for i in range(repeats):
+                yield write(stream, {'op': 'echo', 'x': data})
+                result = yield read(stream)
+                assert len(result) == n
+            duration = time() - start
+            print("%-8s %10d bytes: %8.1f MB/s" % (name, n,
+                  2 * n * repeats / duration / 1e6))
+            stream.close()
+
+        server.stop()
+
+    loop.run_sync(f, timeout=600)
@@ -27,7 +27,7 @@ from distributed.client import WrappedKey
 from distributed.executor import (Executor, Future, CompatibleExecutor, _wait,
         wait, _as_completed, as_completed, tokenize, _global_executor,
         default_executor, _first_completed, ensure_default_get, futures_of)
-from distributed.scheduler import Scheduler
+from distributed.scheduler import Scheduler, WorkerState
 from distributed.sizeof import sizeof
 from distributed.utils import ignoring, sync, tmp_text
 from distributed.utils_test import (cluster, cluster_center, slow,
@@ -299,6 +299,23 @@ def test_gather(s, a, b):
     yield e._shutdown()
 
 
+@gen_cluster(transports=('tcp',))
+def test_scatter_gather_compression(s, a, b):
+    text = b'1,Alice,100\n2,Bob,200\n' * 100000
+
+    for compression in [None, 'zlib']:
+        e = Executor((s.ip, s.port), start=False, compression=compression)
+        yield e._start()
+        assert e.scheduler_stream.compression == compression
+
+        [x] = yield e._scatter([text])
+        y = e.submit(len, x)
+        result = yield e._gather([x, y])
+        assert result == [text, len(text)]
+
+        yield e._shutdown()
+
+
 def test_gather_sync(loop):
     with cluster() as (s, [a, b]):
         with Executor(('127.0.0.1', s['port']), loop=loop) as e:
@@ -567,9 +584,10 @@ def test_missing_data_heals(s, a, b):
 @gen_cluster()
 def test_missing_worker(s, a, b):
     bad = ('bad-host', 8788)
-    s.ncores[bad] = 4
-    s.who_has['b'] = {bad}
-    s.has_what[bad] = {'b'}
+    ws = s.worker_states[bad] = WorkerState(bad, ncores=4)
+    ts = s.task_state('b')
+    ts.who_has = {ws}
+    ws.has_what.add(ts)
 
     e = Executor((s.ip, s.port), start=False)
     yield e._start()
@@ -1940,6 +1958,60 @@ def test_waiting_data(s, a, b):
     yield e._shutdown()
 
 
+@gen_cluster()
+def test_resources_submit_map_compute(s, a, b):
+    from dask.imperative import do
+    s.worker_states[b.address].resources = {'GPU': 1}
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1, resources={'GPU': 1})
+    L = e.map(inc, range(5), resources={'GPU': 1})
+    y = e.compute(do(inc)(10), resources={'GPU': 1})
+    yield _wait([x, y] + L)
+
+    assert s.resources[x.key] == {'GPU': 1}
+    assert all(f.key in b.data and f.key not in a.data for f in [x, y] + L)
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_priority_submit_map_compute_persist(s, a, b):
+    from dask.imperative import do
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1, priority=1)
+    L = e.map(inc, range(10, 13), priority=-1)
+    y = e.compute(do(inc)(100), priority=2)
+    z = e.persist(do(inc)(200), priority=3)
+    yield _wait([x, y] + L)
+
+    assert s.keyorder[x.key][0] == -1
+    assert all(s.keyorder[f.key][0] == 1 for f in L)
+    assert s.keyorder[y.key][0] == -2
+    assert s.keyorder[z.key][0] == -3
+    assert s.clients[x.key] == e.id
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_reports_are_batched(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    futures = e.map(inc, range(100))
+    result = yield e._gather(futures)
+    assert result == list(range(1, 101))
+    bstream = s.streams[e.id]
+    assert bstream.message_count > 100
+    assert bstream.batch_count < bstream.message_count
+
+    yield e._shutdown()
+
+
 @gen_cluster()
 def test_multi_executor(s, a, b):
     e = Executor((s.ip, s.port), start=False)
@@ -0,0 +1,39 @@
+from time import sleep
+
+from tornado import gen
+
+from distributed.loop_monitor import LoopMonitor
+from distributed.utils_test import loop
+
+
+def block_the_loop(seconds):
+    sleep(seconds)
+
+
+def test_loop_monitor(loop):
+    @gen.coroutine
+    def f():
+        monitor = LoopMonitor(interval=10, stall_threshold=0.1)
+        monitor.start(loop)
+        yield gen.sleep(0.1)
+        assert monitor.lag.count > 3
+        assert not monitor.stalls
+
+        block_the_loop(0.3)
+        yield gen.sleep(0.05)
+        [stall] = monitor.stalls
+        assert 0.2 < stall['duration'] < 1
+        assert 'block_the_loop' in stall['stack']
+        assert monitor.lag.max == stall['duration']
+
+        d = monitor.to_dict()
+        assert d['lag']['count'] == monitor.lag.count
+        assert d['stalls'] == [stall]
+
+        monitor.stop()
+        assert not monitor.running
+        count = monitor.lag.count
+        yield gen.sleep(0.05)
+        assert monitor.lag.count == count
+
+    loop.run_sync(f)
@@ -0,0 +1,57 @@
+from math import ceil
+import random
+
+from distributed.metrics import Histogram, Metrics
+
+
+def test_histogram_quantiles_are_accurate():
+    h = Histogram()
+    data = [random.lognormvariate(0, 3) for i in range(10000)]
+    for x in data:
+        h.add(x)
+    data.sort()
+    assert h.count == len(data)
+    assert abs(h.total - sum(data)) < 1e-6 * sum(data)
+    assert h.min == data[0] and h.max == data[-1]
+
+    for q in [0.01, 0.25, 0.5, 0.9, 0.99]:
+        expected = data[int(ceil(q * len(data))) - 1]
+        assert abs(h.quantile(q) - expected) <= expected / h.sub_buckets
+    assert h.quantile(1) == h.max
+
+
+def test_histogram_buckets():
+    h = Histogram(sub_buckets=4, min_exponent=-2, max_exponent=2)
+    assert len(h.counts) == 17
+    assert h.index(0) == 0
+    assert h.index(1e-9) == 1
+    assert h.index(1e9) == 16
+    for i in range(1, 17):
+        lower, upper = h.bounds(i)
+        assert h.index(lower) == i
+        assert lower < upper
+        if i < 16:
+            assert h.bounds(i + 1)[0] == upper
+
+
+def test_histogram_empty_and_zero():
+    h = Histogram()
+    assert h.quantile(0.5) is None
+    assert h.to_dict()['mean'] is None
+    h.add(0)
+    h.add(0)
+    assert h.quantile(0.5) == 0
+    assert h.to_dict()['count'] == 2
+
+
+def test_metrics():
+    m = Metrics()
+    for i in range(10):
+        m.add('get_data', 'handler', 0.001)
+        m.add('get_data', 'bytes-out', 1000)
+    m.add('ping', 'handler', 0.0001)
+    d = m.to_dict()
+    assert set(d) == {'get_data', 'ping'}
+    assert d['get_data']['handler']['count'] == 10
+    assert abs(d['get_data']['bytes-out']['50%'] - 1000) < 1000 / 16
+    assert 'bytes-out' not in d['ping']
@@ -0,0 +1,242 @@
+from collections import OrderedDict
+import os
+from time import time
+
+import pytest
+from tornado import gen
+
+from distributed.core import Server, connect, write_frames, dumps
+from distributed.protocol import (dumps_msg, loads_msg, BIG_BUFFER,
+        register_serializer, serializers, serializer_types, compressions,
+        compress_frames, maybe_compress, choose_compression)
+from distributed.utils_test import slow, loop
+
+
+def test_small_messages_are_single_frames():
+    msg = {'op': 'update-data', 'data': {'x': 1, 'y': b'123'}}
+    frames = dumps_msg(msg)
+    assert len(frames) == 1
+    assert loads_msg(frames) == msg
+
+
+def test_control_messages_are_marshalled():
+    msg = {'op': 'compute', 'key': ('x', 1), 'who_has': {('y', 0): {'a:1'}},
+           'task': None, 'priority': [1.5, -2, True]}
+    frames = dumps_msg(msg)
+    assert frames[0][:1] == b'M'
+    result = loads_msg(frames)
+    assert result == msg
+    assert type(result['key']) is tuple
+
+
+def test_subclasses_are_pickled():
+    for x in [OrderedDict([('a', 1)]), bytearray(b'123')]:
+        frames = dumps_msg({'x': x})
+        assert frames[0][:1] == b'P'
+        assert type(loads_msg(frames)['x']) is type(x)
+
+    np = pytest.importorskip('numpy')
+    frames = dumps_msg({'x': np.float64(1.5)})
+    assert frames[0][:1] == b'P'
+    assert type(loads_msg(frames)['x']) is np.float64
+
+
+def test_functions_are_pickled():
+    frames = dumps_msg({'op': 'compute', 'function': lambda x: x + 1})
+    assert frames[0][:1] == b'P'
+    assert loads_msg(frames)['function'](1) == 2
+
+
+class MyObj(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class MySubObj(MyObj):
+    pass
+
+
+def test_register_serializer():
+    def dumps_myobj(obj):
+        return type(obj).__name__, [obj.data[::-1]]
+
+    def loads_myobj(header, frames):
+        assert header in ('MyObj', 'MySubObj')
+        return MyObj(frames[0][::-1])
+
+    register_serializer(MyObj, 'myobj', dumps_myobj, loads_myobj)
+    try:
+        a, b = MyObj(b'abc'), MySubObj(b'def')
+        frames = dumps_msg({'x': [a, b, a]})
+        assert frames[1:] == [b'cba', b'fed']
+
+        result = loads_msg(frames)['x']
+        assert [o.data for o in result] == [b'abc', b'def', b'abc']
+        assert result[0] is result[2]
+    finally:
+        del serializers['myobj']
+        del serializer_types[MyObj]
+
+
+def test_bytes_out_of_band():
+    b = b'0' * BIG_BUFFER
+    frames = dumps_msg({'x': b, 'y': [b]})
+    assert len(frames) == 2
+    assert frames[1] is b
+    assert len(frames[0]) < 1000
+
+    result = loads_msg(frames)
+    assert result['x'] is frames[1]
+    assert result['y'][0] is result['x']
+
+
+def test_numpy():
+    np = pytest.importorskip('numpy')
+    x = np.arange(100000).reshape((1000, 100))
+    for a in [x, x.T, x.astype('M8[ns]'), x.astype('f4'), np.ones(10)]:
+        frames = dumps_msg({'data': {'a': a}})
+        if a.nbytes >= BIG_BUFFER:
+            assert len(frames) == 2
+            assert len(frames[1]) == a.nbytes
+        y = loads_msg([bytes(frame) for frame in frames])['data']['a']
+        assert y.dtype == a.dtype
+        assert y.shape == a.shape
+        assert (y == a).all()
+
+
+def test_numpy_received_arrays_are_writeable():
+    np = pytest.importorskip('numpy')
+    x = np.arange(100000)
+    frames = dumps_msg({'x': x})
+    assert len(frames) == 2
+    y = loads_msg([bytes(frame) for frame in frames])['x']
+    assert y.flags.writeable
+    y[0] = -1
+    assert y[0] == -1 and x[0] == 0
+
+    # we build arrays on writable frames, like those of read_frames
+    frames = [bytes(frames[0]), bytearray(frames[1])]
+    y = loads_msg(frames)['x']
+    y[0] = -1
+    assert frames[1][:y.itemsize] == y[:1].tobytes()
+
+
+def test_numpy_non_contiguous_and_object():
+    np = pytest.importorskip('numpy')
+    x = np.arange(100000).reshape((1000, 100))[::2, ::2]
+    assert (loads_msg(dumps_msg(x)) == x).all()
+
+    o = np.array(['a' * 10] * 100000, dtype=object)
+    frames = dumps_msg(o)
+    assert (loads_msg(frames) == o).all()
+
+
+def test_pandas():
+    pd = pytest.importorskip('pandas')
+    np = pytest.importorskip('numpy')
+    df = pd.DataFrame({'x': np.arange(100000),
+                       'y': np.random.random(100000),
+                       'z': ['a'] * 100000})
+    frames = dumps_msg({'df': df})
+    assert len(frames) >= 3
+    assert sum(map(len, frames[1:])) >= df.x.nbytes + df.y.nbytes
+
+    result = loads_msg([bytes(frame) for frame in frames])['df']
+    assert result.equals(df)
+
+
+
+def test_choose_compression():
+    assert choose_compression(None, ['zlib']) is None
+    assert choose_compression('zlib', ['zlib', 'lz4']) == 'zlib'
+    assert choose_compression('zlib', ['lz4']) is None
+    assert choose_compression('auto', []) is None
+    assert choose_compression('auto', list(compressions)) in compressions
+    with pytest.raises(ValueError):
+        choose_compression('foo', ['zlib'])
+
+
+@pytest.mark.parametrize('compression', sorted(compressions))
+def test_maybe_compress(compression):
+    text = b'1,Alice,100\n2,Bob,200\n' * 10000
+    name, frame = maybe_compress(text, compression)
+    assert name == compression
+    assert len(frame) < len(text) / 2
+    assert compressions[name]['decompress'](frame) == text
+
+    assert maybe_compress(b'0' * 1000, compression) == (None, b'0' * 1000)
+
+    random = os.urandom(1000000)
+    name, frame = maybe_compress(random, compression)
+    assert name is None
+    assert frame is random
+
+
+@pytest.mark.parametrize('compression', sorted(compressions))
+def test_dumps_msg_compression(compression):
+    text = b'1,Alice,100\n2,Bob,200\n' * 10000
+    random = os.urandom(1000000)
+    msg = {'op': 'update-data', 'data': {'text': text, 'random': random}}
+
+    frames = dumps_msg(msg, compression=compression)
+    assert frames[0][:1] == b'C'
+    assert sum(map(len, frames)) < len(text) / 2 + len(random) + 1000
+    assert loads_msg(frames) == msg
+
+    small = {'op': 'compute', 'key': 'x'}
+    assert dumps_msg(small, compression=compression) == dumps_msg(small)
+
+
+def test_compress_frames_leaves_incompressible_frames_alone():
+    frames = [b'P123', os.urandom(100000)]
+    assert compress_frames(frames, 'zlib') is frames
+
+
+@slow
+def test_control_message_throughput(loop):
+    """ Messages per second on the scheduler-worker control path
+
+    Compares pickling every message, as we used to, with the marshal fast
+    path.  Run with ``py.test --runslow -s`` to see messages/s.
+    """
+    msg = {'op': 'compute', 'key': ('inc', 123), 'function': None,
+           'args': None, 'kwargs': None, 'task': b'x' * 100,
+           'needed': [('x', 1), ('x', 2)],
+           'who_has': {('x', 1): ['127.0.0.1:8000'],
+                       ('x', 2): ['127.0.0.1:8001']},
+           'close': False, 'reply': False}
+    n = 20000
+
+    def pickled(msg):
+        return [b'P' + dumps(msg)]
+
+    for name, func in [('pickle', pickled), ('fast', dumps_msg)]:
+        start = time()
+        for i in range(n):
+            loads_msg(func(msg))
+        print("%-7s round trips: %8.0f messages/s"
+              % (name, n / (time() - start)))
+
+    counter = [0]
+
+    def count(stream, **kwargs):
+        counter[0] += 1
+
+    @gen.coroutine
+    def f():
+        server = Server({'compute': count})
+        server.listen(8887)
+        for name, func in [('pickle', pickled), ('fast', dumps_msg)]:
+            counter[0] = 0
+            stream = yield connect('127.0.0.1', 8887)
+            start = time()
+            for i in range(n):
+                write_frames(stream, func(msg))
+            while counter[0] < n:
+                yield gen.sleep(0.001)
+            print("%-7s over TCP:      %8.0f messages/s"
+                  % (name, n / (time() - start)))
+            stream.close()
+        server.stop()
+
+    loop.run_sync(f, timeout=120)
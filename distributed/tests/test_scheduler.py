@@ -1,5 +1,7 @@
 from collections import defaultdict
 from copy import deepcopy
+from itertools import chain
+import pickle
 from operator import add
 from time import time
 
@@ -15,8 +17,10 @@ from distributed.core import connect, read, write, rpc, loads
 from distributed.client import WrappedKey
 from distributed.scheduler import (validate_state, heal, update_state,
         decide_worker, assign_many_tasks, heal_missing_data, Scheduler,
-        _maybe_complex, dumps_function, dumps_task, apply)
-from distributed.utils_test import inc, ignoring, dec
+        _maybe_complex, dumps_function, dumps_task, apply, OccupancyIndex,
+        order_keys, independent_group, TaskState, WorkerState, group_leaves,
+        split_leaves, _independent_group_steps, _exhaust)
+from distributed.utils_test import inc, ignoring, dec, div, slow
 
 
 alice = 'alice'
@@ -349,6 +353,88 @@ def test_decide_worker_without_stacks():
         result = decide_worker({'x': []}, [], {}, {}, set(), {}, 'x')
 
 
+def test_occupancy_index():
+    stacks = {'alice': [1, 2], 'bob': [1], 'charlie': [1, 2, 3]}
+    occupancy = OccupancyIndex(stacks)
+    assert occupancy.best() == 'bob'
+
+    stacks['bob'].extend([2, 3, 4])     # growth needs no update
+    assert occupancy.best() == 'alice'
+
+    stacks['charlie'][:] = []           # shrinking does
+    occupancy.update('charlie')
+    assert occupancy.best() == 'charlie'
+
+    del stacks['charlie']
+    occupancy.remove('charlie')
+    assert occupancy.best() == 'alice'
+
+    stacks['david'] = []
+    occupancy.update('david')
+    assert occupancy.best() == 'david'
+
+    for i in range(1000):
+        occupancy.update('david')
+    assert len(occupancy) < 1000
+
+    stacks.clear()
+    assert occupancy.best() is None
+
+
+def test_decide_worker_with_occupancy_index():
+    dependencies = {'x': set(), 'y': set(), 'z': {'x'}}
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    stacks = {alice: [], bob: [], charlie: []}
+    who_has = {'x': {alice}}
+    occupancy = OccupancyIndex(stacks)
+
+    for i in range(30):
+        key = 'y' if i % 2 else 'x'
+        worker = decide_worker(dependencies, stacks, who_has, {}, set(), {},
+                               key, occupancy)
+        assert len(stacks[worker]) == min(map(len, stacks.values()))
+        stacks[worker].append(key)
+    assert all(len(v) == 10 for v in stacks.values())
+
+    # data locality still wins
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), {'x': 1},
+                         'z', occupancy) == alice
+
+    # restrictions don't use the index
+    restrictions = {'y': {'charlie'}}
+    assert decide_worker(dependencies, stacks, who_has, restrictions, set(),
+                         {}, 'y', occupancy) == charlie
+
+
+def test_order_keys():
+    dsk = {('x', i): (inc, i) for i in range(4)}
+    dsk.update({('y', i): (add, ('x', 2 * i), ('x', 2 * i + 1))
+                for i in range(2)})
+    dsk['z'] = (add, ('y', 0), ('y', 1))
+    dsk['w'] = 1
+    dependencies, dependents = get_deps(dsk)
+
+    o = order_keys(list(dsk), dependencies, outputs=['z', 'w'])
+    assert sorted(o.values()) == list(range(len(dsk)))
+    assert o['z'] == 0 and o['w'] == len(dsk) - 1
+
+    # finish one subtree before starting the next
+    first, second = sorted([0, 1], key=lambda i: o[('y', i)])
+    assert (max(o[('x', 2 * first)], o[('x', 2 * first + 1)]) <
+            min(o[('x', 2 * second)], o[('x', 2 * second + 1)]))
+
+    # only order the given keys
+    o = order_keys([('y', 0), 'z'], dependencies)
+    assert o == {'z': 0, ('y', 0): 1}
+
+
+def test_order_keys_long_chain():
+    n = 100000
+    dependencies = {i: {i - 1} if i else set() for i in range(n)}
+    o = order_keys(range(n), dependencies)
+    assert o[n - 1] == 0 and o[0] == n - 1
+
+
 def test_validate_state():
     dsk = {'x': 1, 'y': (inc, 'x')}
     dependencies = {'x': set(), 'y': {'x'}}
@@ -481,15 +567,12 @@ from distributed.utils_test import gen_cluster, gen_test
 from distributed.utils import All
 from tornado import gen
 
-def div(x, y):
-    return x / y
-
 @gen_cluster()
 def test_scheduler(s, a, b):
     stream = yield connect(s.ip, s.port)
     yield write(stream, {'op': 'register-client', 'client': 'ident'})
-    msg = yield read(stream)
-    assert msg['op'] == 'stream-start'
+    msgs = yield read(stream)
+    assert msgs[0]['op'] == 'stream-start'
 
     # Test update graph
     yield write(stream, {'op': 'update-graph',
@@ -502,8 +585,9 @@ def test_scheduler(s, a, b):
                          'keys': ['x', 'z'],
                          'client': 'ident'})
     while True:
-        msg = yield read(stream)
-        if msg['op'] == 'key-in-memory' and msg['key'] == 'z':
+        msgs = yield read(stream)
+        if any(msg['op'] == 'key-in-memory' and msg['key'] == 'z'
+               for msg in msgs):
             break
 
     assert a.data.get('x') == 2 or b.data.get('x') == 2
@@ -518,16 +602,18 @@ def test_scheduler(s, a, b):
                          'client': 'ident'})
 
     while True:
-        msg = yield read(stream)
-        if msg['op'] == 'task-erred' and msg['key'] == 'b':
+        msgs = yield read(stream)
+        if any(msg['op'] == 'task-erred' and 'b' in msg['keys']
+               for msg in msgs):
             break
 
     # Test missing data
     yield write(stream, {'op': 'missing-data', 'missing': ['z']})
 
     while True:
-        msg = yield read(stream)
-        if msg['op'] == 'key-in-memory' and msg['key'] == 'z':
+        msgs = yield read(stream)
+        if any(msg['op'] == 'key-in-memory' and msg['key'] == 'z'
+               for msg in msgs):
             break
 
     # Test missing data without being informed
@@ -540,8 +626,9 @@ def test_scheduler(s, a, b):
                          'keys': ['zz'],
                          'client': 'ident'})
     while True:
-        msg = yield read(stream)
-        if msg['op'] == 'key-in-memory' and msg['key'] == 'zz':
+        msgs = yield read(stream)
+        if any(msg['op'] == 'key-in-memory' and msg['key'] == 'zz'
+               for msg in msgs):
             break
 
     write(stream, {'op': 'close'})
@@ -600,13 +687,16 @@ def test_server(s, a, b):
                          'client': 'ident'})
 
     while True:
-        msg = yield read(stream)
-        if msg['op'] == 'key-in-memory' and msg['key'] == 'y':
+        msgs = yield read(stream)
+        if any(msg['op'] == 'key-in-memory' and msg['key'] == 'y'
+               for msg in msgs):
             break
 
     yield write(stream, {'op': 'close-stream'})
-    msg = yield read(stream)
-    assert msg == {'op': 'stream-closed'}
+    msgs = yield read(stream)
+    assert msgs == [{'op': 'stream-closed'}]
+    with pytest.raises(StreamClosedError):  # framed reads stop at message end
+        yield read(stream)
     assert stream.closed()
     stream.close()
 
@@ -623,7 +713,7 @@ def test_remove_worker_from_scheduler(s, a, b):
     dsk = {('x', i): (inc, i) for i in range(10)}
     s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
                    dependencies={k: set() for k in dsk})
-    assert s.stacks[a.address]
+    assert s.stacks[a.address] or s.processing[a.address]
 
     assert a.address in s.worker_queues
     s.remove_worker(address=a.address)
@@ -634,6 +724,91 @@ def test_remove_worker_from_scheduler(s, a, b):
     s.validate()
 
 
+@gen_cluster()
+def test_remove_worker_heals_affected_keys(s, a, b):
+    dsk = {'x': (inc, 1), 'y': (inc, 'x'), 'z': (inc, 'y'), 'w': (inc, 0)}
+    dependencies = {'x': set(), 'y': {'x'}, 'z': {'y'}, 'w': set()}
+    s.update_graph(tasks=valmap(dumps_task, {k: dsk[k] for k in ['x', 'y']}),
+                   keys=['y'], client='client',
+                   dependencies={'x': set(), 'y': {'x'}})
+    while not s.who_has.get('y'):
+        yield gen.sleep(0.01)
+    assert not s.who_has.get('x')  # nobody needs x any more
+
+    [lost] = s.task_states['y'].who_has
+    kept = [w for w in [a, b] if w.address != lost.address][0]
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=['z', 'w'],
+                   client='client', dependencies=dependencies)
+    s.remove_worker(address=lost.address)
+    s.validate(allow_overlap=True)
+    assert {'x', 'y', 'z'} <= set(s.in_play)
+    assert s.waiting.get('z', {'y'}) == {'y'}
+
+    while not s.who_has.get('z'):
+        yield gen.sleep(0.01)
+    assert kept.data['z'] == 4
+    s.validate(allow_overlap=True)
+
+
+@gen_cluster()
+def test_worker_nbytes(s, a, b):
+    s.update_data(who_has={'x': [a.address], 'y': [a.address, b.address]},
+                  nbytes={'x': 10, 'y': 20})
+    assert s.worker_states[a.address].nbytes == 30
+    assert s.worker_states[b.address].nbytes == 20
+
+    s.set_nbytes(s.task_states['y'], 5)
+    assert s.worker_states[a.address].nbytes == 15
+    assert s.worker_states[b.address].nbytes == 5
+
+    s.delete_data(keys=['x', 'y'])
+    assert s.worker_states[a.address].nbytes == 0
+    assert s.worker_states[b.address].nbytes == 0
+
+
+@gen_cluster()
+def test_full_workers_get_no_new_tasks(s, a, b):
+    s.worker_states[a.address].memory_limit = 1000
+    a.data['x'] = b'0' * 900
+    s.update_data(who_has={'x': [a.address]}, nbytes={'x': 900},
+                  client='client')
+    assert s.full_workers == {a.address}
+
+    dsk = {('y', i): (inc, i) for i in range(20)}
+    dsk['z'] = (len, 'x')
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client',
+                   dependencies=merge({k: set() for k in dsk},
+                                      {'z': {'x'}}))
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+    assert all(s.who_has[k] == {b.address} for k in dsk)
+    assert b.data['z'] == 900
+
+
+@gen_cluster()
+def test_rebalance_memory(s, a, b):
+    s.worker_states[a.address].memory_limit = 1000
+    a.data['x'] = b'0' * 900
+    a.data['y'] = b'0' * 10
+    s.update_data(who_has={'x': [a.address], 'y': [a.address]},
+                  nbytes={'x': 900, 'y': 10}, client='client')
+    assert s.full_workers == {a.address}
+
+    yield s.rebalance_memory()
+    assert s.who_has['x'] == {b.address}
+    assert s.who_has['y'] == {a.address}
+    assert b.data['x'] == b'0' * 900
+    assert not s.full_workers
+    assert s.worker_states[a.address].nbytes == 10
+    assert s.worker_states[b.address].nbytes == 900
+
+    yield s.clear_data_from_workers()
+    assert 'x' not in a.data
+    s.validate()
+
+
 @gen_cluster()
 def test_add_worker(s, a, b):
     w = Worker(s.ip, s.port, ncores=3, ip='127.0.0.1')
@@ -666,11 +841,26 @@ def test_feed(s, a, b):
 
     for i in range(5):
         response = yield read(stream)
-        expected = s.processing, s.stacks
+        expected = dict(s.processing), dict(s.stacks)
+        assert response == expected
 
     stream.close()
 
 
+@gen_cluster()
+def test_views_pickle_as_plain_containers(s, a, b):
+    s.update_graph(tasks={'x': dumps_task((inc, 1))}, keys=['x'],
+                   dependencies={'x': set()}, client='client')
+    while 'x' not in s.who_has:
+        yield gen.sleep(0.01)
+
+    for view in [s.processing, s.stacks, s.who_has, s.nbytes, s.in_play]:
+        result = pickle.loads(pickle.dumps(view))
+        assert type(result) in (dict, set)
+        assert result == view
+    assert len(s.ncores) == 2
+
+
 @gen_cluster()
 def test_feed_setup_teardown(s, a, b):
     def setup(scheduler):
@@ -754,12 +944,11 @@ def test_rpc(s, a, b):
 @gen_cluster()
 def test_delete_callback(s, a, b):
     a.data['x'] = 1
-    s.who_has['x'].add(a.address)
-    s.has_what[a.address].add('x')
+    s.update_data(who_has={'x': {a.address}}, nbytes={'x': 1})
 
     s.delete_data(keys=['x'])
-    assert not s.who_has['x']
-    assert not s.has_what['y']
+    assert 'x' not in s.who_has
+    assert not s.has_what[a.address]
     assert a.data['x'] == 1  # still in memory
     assert s.deleted_keys == {a.address: {'x'}}
     yield s.clear_data_from_workers()
@@ -811,10 +1000,10 @@ def test_filtered_communication(s, a, b):
                     'client': 'f',
                     'keys': ['z']})
 
-    msg = yield read(e)
+    [msg] = yield read(e)
     assert msg['op'] == 'key-in-memory'
     assert msg['key'] == 'y'
-    msg = yield read(f)
+    [msg] = yield read(f)
     assert msg['op'] == 'key-in-memory'
     assert msg['key'] == 'z'
 
@@ -848,3 +1037,915 @@ def test_dumps_task():
     assert loads(d['function'])(1, 2) == 3
     assert loads(d['args']) == (1,)
     assert loads(d['kwargs']) == {'y': 10}
+
+
+@gen_cluster()
+def test_worker_streams_batch_tasks(s, a, b):
+    dsk = {('x', i): (inc, i) for i in range(100)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: set() for k in dsk})
+
+    for w in [a, b]:
+        assert len(s.processing[w.address]) <= w.ncores + s.saturation
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+    assert set(s.worker_streams) == {a.address, b.address}
+    bstream = s.worker_streams[a.address]
+    assert 0 < bstream.batch_count < bstream.message_count
+    assert len(a.data) + len(b.data) == len(dsk)
+    s.validate()
+
+
+@gen_cluster()
+def test_worker_stream_reports_errors(s, a, b):
+    s.update_graph(tasks={'x': dumps_task((div, 1, 0))}, keys=['x'],
+                   client='client', dependencies={'x': set()})
+    while 'x' not in s.exceptions:
+        yield gen.sleep(0.01)
+    assert isinstance(s.exceptions['x'], ZeroDivisionError)
+    assert not any(s.processing.values())
+
+
+def slowinc(x, delay=0.02):
+    from time import sleep
+    sleep(delay)
+    return x + 1
+
+
+@gen_cluster(ncores=[('127.0.0.1', 2), ('127.0.0.1', 2)])
+def test_resources(s, a, b):
+    s.worker_states[a.address].resources = {'A': 1}
+    dsk = {('x', i): (slowinc, i, 0.05) for i in range(4)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: set() for k in dsk},
+                   resources={k: {'A': 1} for k in dsk})
+    assert s.resources[('x', 0)] == {'A': 1}
+
+    most = 0
+    while not all(s.who_has.get(k) for k in dsk):
+        most = max(most, len(s.processing[a.address]))
+        yield gen.sleep(0.01)
+    assert most <= 1  # a has two cores but only one A
+    assert all(s.who_has[k] == {a.address} for k in dsk)
+
+
+@gen_test()
+def test_resources_through_center():
+    c = Center('127.0.0.1')
+    c.listen(0)
+    a = Worker(c.ip, c.port, ncores=2, ip='127.0.0.1', resources={'A': 1})
+    yield a._start(0)
+    b = Worker(c.ip, c.port, ncores=2, ip='127.0.0.1')
+    yield b._start(0)
+    s = Scheduler((c.ip, c.port))
+    try:
+        yield s.sync_center()
+        s.start(0)
+        assert s.worker_states[a.address].resources == {'A': 1}
+        assert s.worker_states[b.address].resources == {}
+
+        dsk = {('x', i): (inc, i) for i in range(4)}
+        s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                       client='client', dependencies={k: set() for k in dsk},
+                       resources={k: {'A': 1} for k in dsk})
+        while not all(s.who_has.get(k) for k in dsk):
+            yield gen.sleep(0.01)
+        assert all(s.who_has[k] == {a.address} for k in dsk)
+    finally:
+        yield a._close()
+        yield b._close()
+        s.stop()
+        c.stop()
+
+
+@gen_test()
+def test_memory_limit_through_center():
+    c = Center('127.0.0.1')
+    c.listen(0)
+    a = Worker(c.ip, c.port, ncores=1, ip='127.0.0.1', memory_limit=1000)
+    a.data['x'] = 1
+    yield a._start(0)
+    b = Worker(c.ip, c.port, ncores=1, ip='127.0.0.1')
+    yield b._start(0)
+    s = Scheduler((c.ip, c.port))
+    try:
+        yield s.sync_center()
+        assert s.worker_states[a.address].memory_limit == 1000
+        assert s.worker_states[b.address].memory_limit is None
+        s.set_nbytes(s.task_states['x'], 900)
+        assert s.full_workers == {a.address}
+
+        yield s.sync_center()
+        assert s.worker_states[a.address].nbytes == 900
+        assert s.full_workers == {a.address}
+    finally:
+        yield a._close()
+        yield b._close()
+        c.stop()
+
+
+@gen_cluster()
+def test_resources_held_tasks_keep_their_place(s, a, b):
+    ws = s.worker_states[a.address]
+    ws.resources = {'A': 1}
+    dsk = {'x': (slowinc, 1, 0.2), 'y': (inc, 1), 'z': (inc, 2)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: set() for k in dsk},
+                   resources={'x': {'A': 1}, 'y': {'A': 1}},
+                   restrictions={'z': {a.ip}})
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    assert not ws.stack
+    assert ws.stack_duration == 0
+
+
+@gen_cluster()
+def test_task_durations(s, a, b):
+    dsk = {('slowinc', i): (slowinc, i) for i in range(10)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: set() for k in dsk})
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+    assert 0.015 < s.task_duration['slowinc'] < 0.2
+    assert s.expected_duration(('slowinc', 100)) == s.task_duration['slowinc']
+    assert s.expected_duration('unknown-1') == s.default_duration
+    assert all(v == 0 for v in s.stack_duration.values())
+    assert all(v == 0 for v in s.processing_duration.values())
+    assert s.worker_load(a.address) == 0
+
+
+@gen_cluster()
+def test_ensure_occupied_holds_back_long_tasks(s, a, b):
+    s.task_duration['long'] = 100
+    dsk = {('long', i): (inc, i) for i in range(10)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: set() for k in dsk})
+    assert len(s.processing[a.address]) == a.ncores
+    assert len(s.processing[b.address]) == b.ncores
+    assert s.processing_duration[b.address] == 100 * b.ncores
+    assert sum(s.stack_duration.values()) == 100 * (10 - a.ncores - b.ncores)
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    assert s.task_duration['long'] < 100
+
+
+def test_decide_worker_balances_expected_durations():
+    durations = {'long': 10, 'short': 0.1}
+    stacks = {alice: ['long'], bob: ['short'] * 5}
+    cost = lambda w: sum(durations[k] for k in stacks[w])
+    occupancy = OccupancyIndex(stacks, cost)
+    dependencies = {'x': set(), 'y': {'z'}}
+    who_has = {'z': {alice, bob}}
+
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), {}, 'x',
+                         occupancy) == bob
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), {'z': 1},
+                         'y', occupancy) == bob
+
+
+def test_decide_worker_avoids_full_workers():
+    stacks = {alice: [], bob: ['x', 'y']}
+    dependencies = {'b': {'a'}}
+    who_has = {'a': {alice}}
+    nbytes = {'a': 100}
+
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), nbytes,
+                         'b') == alice
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), nbytes,
+                         'b', full={alice}) == bob
+    assert decide_worker(dependencies, stacks, who_has, {}, set(), nbytes,
+                         'b', full={alice, bob}) == alice
+
+
+def test_assign_many_tasks_avoids_full_workers():
+    dependencies = {'x': set(), 'y': set(), 'z': {'x'}}
+    waiting = {'x': set(), 'y': set(), 'z': set()}
+    keyorder = {'x': 1, 'y': 2, 'z': 3}
+    who_has = {'x': {alice}}
+    stacks = {alice: [], bob: []}
+    nbytes = {'x': 10}
+
+    new_stacks = assign_many_tasks(dependencies, waiting, keyorder, who_has,
+            stacks, {}, set(), nbytes, ['x', 'y', 'z'], full={alice})
+    assert not stacks[alice]
+    assert set(stacks[bob]) == {'x', 'y', 'z'}
+    assert alice not in new_stacks
+    assert set(new_stacks[bob]) == {'x', 'y', 'z'}
+
+
+def slowadd(x, y, delay=0.02):
+    from time import sleep
+    sleep(delay)
+    return x + y
+
+
+def skewed_graph(s, worker, n, name='slowadd', nbytes=1, delay=0.02):
+    """ Put n tasks on the stack of worker, they depend on data it holds """
+    worker.data['d'] = 1
+    s.update_data(who_has={'d': {worker.address}}, nbytes={'d': nbytes})
+    dsk = {(name, i): (slowadd, 'd', i, delay) for i in range(n)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: {'d'} for k in dsk})
+    return dsk
+
+
+@gen_cluster()
+def test_steal_work(s, a, b):
+    s._steal_periodic_callback.stop()
+    dsk = skewed_graph(s, a, 20)
+    assert not s.stacks[b.address] and not s.processing[b.address]
+    assert len(s.stacks[a.address]) > 10
+    total = sum(s.stack_duration.values())
+
+    s.steal_work()
+    assert s.stacks[b.address] or s.processing[b.address]
+    assert s.steal_log
+    assert all(victim == a.address and thief == b.address
+               for _, key, victim, thief in s.steal_log)
+    assert abs(sum(s.stack_duration.values()) +
+               s.processing_duration[b.address] - total) < 1e-9
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    assert any(k in b.data for k in dsk)
+
+
+@gen_cluster()
+def test_dont_steal_tasks_with_expensive_data(s, a, b):
+    s._steal_periodic_callback.stop()
+    dsk = skewed_graph(s, a, 20, nbytes=1e12, delay=0.001)
+    assert s.stacks[a.address]
+    s.steal_work()
+    assert not s.steal_log
+    assert not s.stacks[b.address] and not s.processing[b.address]
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+
+@slow
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 4, timeout=120)
+def test_steal_makespan(s, a, b, c, d):
+    """ Time to finish a skewed workload, with and without work stealing
+
+    All tasks depend on one small piece of data on one worker so they all
+    land there.  Run with ``py.test --runslow -s`` to see the makespans.
+    """
+    n = 100
+    for steal in [False, True]:
+        if not steal:
+            s._steal_periodic_callback.stop()
+        else:
+            s._steal_periodic_callback.start()
+        name = 'steal' if steal else 'nosteal'
+        start = time()
+        dsk = skewed_graph(s, a, n, name=name, delay=0.05)
+        while not all(s.who_has.get(k) for k in dsk):
+            yield gen.sleep(0.01)
+        end = time()
+        print("%d tasks of 50ms, stealing=%-5s: %.2fs, %d tasks stolen"
+              % (n, steal, end - start, len(s.steal_log)))
+
+
+@gen_cluster()
+def test_prioritize_submissions(s, a, b):
+    def submit(key, task, deps=()):
+        s.update_graph(tasks={key: dumps_task(task)}, keys=[key],
+                       client='client', dependencies={key: set(deps)})
+
+    submit('x', (slowinc, 1, 0.3))
+    submit('y', (inc, 2))
+    assert s.keyorder['x'] < s.keyorder['y']
+    assert s.keyorder['x'][1] < s.keyorder['y'][1]  # generation
+
+    # follow-up work on x joins x's generation, ahead of y
+    dsk = {('z', i): (inc, 'x') for i in range(3)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                   client='client', dependencies={k: {'x'} for k in dsk})
+    assert all(s.keyorder['x'] < s.keyorder[k] < s.keyorder['y']
+               for k in dsk)
+
+    # a single key on x shares x's order, it sorts just behind x
+    submit('v', (inc, 'x'), deps=['x'])
+    assert s.keyorder['v'][:3] == s.keyorder['x'][:3]
+    assert s.keyorder['x'] < s.keyorder['v'] < s.keyorder['y']
+
+    # and a key on v just behind v
+    submit('u', (inc, 'v'), deps=['v'])
+    assert s.keyorder['u'][:3] == s.keyorder['v'][:3]
+    assert s.keyorder['v'] < s.keyorder['u'] < s.keyorder['y']
+
+    while not all(s.who_has.get(k) for k in list(dsk) + ['u']):
+        yield gen.sleep(0.01)
+
+    # once x is in memory new work on it is new work
+    submit('w', (inc, 'x'), deps=['x'])
+    assert s.keyorder['w'][1] > s.keyorder['y'][1]
+
+    # resubmission keeps the old priority
+    old = s.keyorder['y']
+    submit('y', (inc, 2))
+    assert s.keyorder['y'] == old
+
+
+def submit_many(s, keys, client='client', priority=0, delay=0.05):
+    dsk = {k: (slowinc, i, delay) for i, k in enumerate(keys)}
+    s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(keys),
+                   client=client, dependencies={k: set() for k in keys},
+                   priority=priority)
+
+
+@gen_cluster(ncores=[('127.0.0.1', 1)])
+def test_user_priority(s, a):
+    s.saturation = 0  # one task at a time
+    low = [('low', i) for i in range(5)]
+    high = [('high', i) for i in range(3)]
+    lower = [('lower', i) for i in range(3)]
+    submit_many(s, low)
+    submit_many(s, high, priority=1)
+    submit_many(s, lower, priority=-1)
+    assert s.keyorder[high[0]] < s.keyorder[low[0]] < s.keyorder[lower[0]]
+
+    levels = [s.keyorder[k][0] for k in s.stacks[a.address]]
+    assert levels == sorted(levels, reverse=True)  # high on top
+
+    keys = low + high + lower
+    while not all(s.who_has.get(k) for k in keys):
+        yield gen.sleep(0.01)
+    done = [k for k in a.data if k in keys]
+    assert done[0] == ('low', 0)  # was running already
+    assert {k[0] for k in done[1:4]} == {'high'}
+    assert {k[0] for k in done[4:8]} == {'low'}
+    assert {k[0] for k in done[8:]} == {'lower'}
+
+
+@gen_cluster(ncores=[('127.0.0.1', 2)])
+def test_fair_share_between_clients(s, a):
+    s.saturation = 0
+    bob = [('bob', i) for i in range(3)]
+    alice = [('alice', i) for i in range(10)]
+    submit_many(s, bob, client='bob')
+    submit_many(s, alice, client='alice')  # goes on top of bob's tasks
+    assert s.clients[bob[0]] == 'bob'
+
+    occupancy = s.get_client_occupancy()
+    assert occupancy['bob']['processing'] == 2
+    assert occupancy['bob']['share'] == 1
+    assert occupancy['alice']['processing'] == 0
+    assert occupancy['alice']['stacked'] == 10
+    assert occupancy['alice']['wants'] == 10
+
+    keys = bob + alice
+    while not all(s.who_has.get(k) for k in keys):
+        yield gen.sleep(0.01)
+    done = [k for k in a.data if k in keys]
+    assert max(done.index(k) for k in bob) < 6  # bob's last doesn't wait
+    assert not s.client_processing
+    assert not s.client_stacked
+
+
+def stacked_task(s, ws, key, client, priority=(0, 0, 0, 0), index=None):
+    ts = TaskState(key, (inc, 1))
+    ts.client = client
+    ts.priority = priority
+    ws.stack.insert(len(ws.stack) if index is None else index, ts)
+    s._stacked(ws, ts)
+    return ts
+
+
+def test_next_task_looks_down_only_for_clients_on_the_stack():
+    s = Scheduler()
+    ws = WorkerState(alice)
+    for i in range(3):
+        stacked_task(s, ws, ('bob', i), 'bob')
+    s.client_processing.update({'bob': 2, 'carol': 1})
+    assert s.next_task(ws, nclients=2) == 2  # carol has nothing here
+    assert s.next_task(ws) == 2
+
+    carol = stacked_task(s, ws, ('carol', 0), 'carol', index=0)
+    assert ws.clients == {'bob': 3, 'carol': 1}
+    assert s.client_stacked == {'bob': 3, 'carol': 1}
+    assert s.next_task(ws, nclients=2) == 0
+    assert s.next_task(ws, held={carol}, nclients=2) == 3
+    assert s.next_task(ws, held={ws.stack[3]}, nclients=2) == 0
+    assert s.next_task(ws) == 3  # one client has everything to itself
+
+    s.client_processing['bob'] = 1  # bob has no more than its share
+    assert s.next_task(ws, nclients=2) == 3
+
+
+class SentMessages(list):
+    send = list.append
+
+
+def test_ensure_occupied_leaves_held_tasks_in_place():
+    s = Scheduler()
+    s.saturation = 2  # look past both held tasks
+    ws = s.worker_states[alice] = WorkerState(alice, ncores=2,
+                                              resources={'A': 1})
+    s.worker_streams[alice] = sent = SentMessages()
+    stacked_task(s, ws, 'first', 'bob')
+    held = [stacked_task(s, ws, ('held', i), 'bob') for i in range(2)]
+    for ts in held:
+        ts.resources = {'A': 1}
+    stacked_task(s, ws, 'ready', 'bob')
+    user = stacked_task(s, ws, 'user', 'bob')
+    user.resources = {'A': 1}
+
+    s.ensure_occupied(ws)
+    assert [msg['key'] for msg in sent] == ['user', 'ready', 'first']
+    assert ws.stack == held  # in their original order
+    assert ws.clients == {'bob': 2}
+    assert s.client_processing == {'bob': 3}
+
+
+@slow
+@gen_cluster(ncores=[('127.0.0.1', 4)], timeout=120)
+def test_tiny_task_throughput(s, a):
+    """ Tasks per second with many tiny tasks on a single worker
+
+    Run with ``py.test --runslow -s`` to see tasks/s.  Note that the worker
+    shares its process with the scheduler here.
+    """
+    n = 20000
+    dsk = {('x', i): (inc, i) for i in range(n)}
+    tasks = valmap(dumps_task, dsk)
+    start = time()
+    yield gen.maybe_future(s.update_graph(tasks=tasks, keys=list(dsk),
+            client='client', dependencies={k: set() for k in dsk}))
+    while len(a.data) < n:
+        yield gen.sleep(0.01)
+    end = time()
+    bstream = s.worker_streams[a.address]
+    print("%d tasks in %.2fs: %.0f tasks/s, %.1f tasks per batch"
+          % (n, end - start, n / (end - start),
+             bstream.message_count / bstream.batch_count))
+
+
+@slow
+def test_decide_worker_throughput():
+    """ Tasks per second that decide_worker assigns, by number of workers
+
+    Run with ``py.test --runslow -s`` to see tasks/s with and without an
+    ``OccupancyIndex``.
+    """
+    n = 20000
+    dependencies = {i: set() for i in range(n)}
+    for nworkers in [10, 100, 1000]:
+        for use_index in [False, True]:
+            stacks = {('127.0.0.1', i): [] for i in range(nworkers)}
+            occupancy = OccupancyIndex(stacks) if use_index else None
+            start = time()
+            for key in range(n):
+                worker = decide_worker(dependencies, stacks, {}, {}, set(), {},
+                                       key, occupancy)
+                stack = stacks[worker]
+                stack.append(key)
+                if len(stack) > 10:  # workers run tasks
+                    stack.pop()
+                    if use_index:
+                        occupancy.update(worker)
+            end = time()
+            print("%4d workers, index=%-5s: %.0f tasks/s"
+                  % (nworkers, use_index, n / (end - start)))
+
+
+def test_group_leaves():
+    dependents = {'a': ['x'], 'b': ['y'], 'c': ['x'], 'd': ['y'],
+                  'x': ['z'], 'y': ['z'], 'e': ['w']}
+    get = lambda k: dependents.get(k, ())
+    leaves = ['a', 'b', 'c', 'd', 'e']
+
+    assert group_leaves(leaves, get, depth=1) == [['a', 'c'], ['b', 'd'],
+                                                  ['e']]
+    assert group_leaves(leaves, get) == [['a', 'b', 'c', 'd'], ['e']]
+    assert group_leaves(leaves, get, limit=3) == [['a', 'c'], ['b', 'd'],
+                                                  ['e']]
+    assert group_leaves(leaves, lambda k: ()) == [[k] for k in leaves]
+
+
+def test_split_leaves_keeps_groups_together():
+    dependents = {k: [('add', i // 2)] for i, k in
+                  enumerate(concat([('x', i), ('y', i)] for i in range(8)))}
+    leaves = sorted(dependents)  # all x before all y
+    stacks = {alice: [], bob: []}
+
+    runs = split_leaves(leaves, stacks, lambda k: dependents.get(k, ()))
+    assert sorted(map(len, runs.values())) == [8, 8]
+    for run in runs.values():
+        assert {k[1] for k in run if k[0] == 'x'} == \
+               {k[1] for k in run if k[0] == 'y'}
+
+
+@slow
+def test_tree_reduction_transfer_bytes():
+    """ Bytes that a tree reduction moves between workers, by seeding
+
+    We add two arrays block by block and sum up the result in a binary tree.
+    Run with ``py.test --runslow -s`` to see the bytes transferred when we
+    split the leaves in order only and when we also keep leaves together
+    that feed the same tasks.
+    """
+    n = 1024
+    nbytes = 1000000
+    dependencies = {}
+    for i in range(n):
+        dependencies[('x', i)] = set()
+        dependencies[('y', i)] = set()
+        dependencies[('sum', 0, i)] = {('x', i), ('y', i)}
+    level, width = 0, n
+    while width > 1:
+        for i in range(width // 2):
+            dependencies[('sum', level + 1, i)] = {('sum', level, 2 * i),
+                                                   ('sum', level, 2 * i + 1)}
+        level += 1
+        width //= 2
+    dependents = defaultdict(list)
+    for key, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(key)
+    leaves = sorted(k for k, deps in dependencies.items() if not deps)
+    reducers = sorted(k for k in dependencies if k[0] == 'sum')
+
+    transferred = {}
+    for grouped in [False, True]:
+        stacks = {('127.0.0.1', i): [] for i in range(8)}
+        get = (lambda k: dependents.get(k, ())) if grouped else None
+        who_has = {}
+        for worker, keys in split_leaves(leaves, stacks, get).items():
+            for key in keys:
+                who_has[key] = {worker}
+        total = 0
+        for key in reducers:
+            worker = decide_worker(dependencies, stacks, who_has, {}, set(),
+                                   dict.fromkeys(who_has, nbytes), key)
+            total += sum(nbytes for dep in dependencies[key]
+                         if worker not in who_has[dep])
+            who_has[key] = {worker}
+            stacks[worker].append(key)
+        transferred[grouped] = total
+        print("%d leaves on 8 workers, grouped=%-5s: %d MB transferred"
+              % (len(leaves), grouped, total / 1e6))
+
+    assert transferred[True] < transferred[False]
+
+
+def test_independent_group():
+    tasks = {'x': 1, 'y': 2}
+    assert independent_group(tasks, ['x', 'y'], {'x': set(), 'y': set()},
+                             {}, {}) == set()
+    assert independent_group(tasks, ['x', 'y'], {'x': {'a'}, 'y': {'a'}},
+                             {}, {'a': {alice}}) == {'a'}
+
+    # a is not in memory
+    assert independent_group(tasks, ['x', 'y'], {'x': {'a'}, 'y': {'a'}},
+                             {}, {'a': set()}) is None
+    # nobody holds both a and b
+    assert independent_group(tasks, ['x', 'y'],
+                             {'x': {'a', 'b'}, 'y': {'a', 'b'}},
+                             {}, {'a': {alice}, 'b': {bob}}) is None
+    # different dependencies
+    assert independent_group(tasks, ['x', 'y'], {'x': {'a'}, 'y': set()},
+                             {}, {'a': {alice}}) is None
+    # y depends on x
+    assert independent_group(tasks, ['x', 'y'], {'x': set(), 'y': {'x'}},
+                             {}, {}) is None
+    # x is known already
+    assert independent_group(tasks, ['x', 'y'], {'x': set(), 'y': set()},
+                             {'x': 1}, {}) is None
+    # we don't want y
+    assert independent_group(tasks, ['x'], {'x': set(), 'y': set()},
+                             {}, {}) is None
+    # single tasks take the usual path
+    assert independent_group({'x': 1}, ['x'], {'x': set()}, {}, {}) is None
+
+
+def test_independent_group_in_chunks():
+    keys = list(range(10))
+    tasks = {k: k for k in keys}
+    group = []
+    steps = _independent_group_steps(tasks, keys, {k: set() for k in keys},
+                                     {}, {}, group, chunk=3)
+    assert len(list(steps)) == 3  # we yield between the four chunks
+    assert group == [set()]
+
+    group = []
+    _exhaust(_independent_group_steps(tasks, keys[:9] + [0],
+                                      {k: set() for k in keys}, {}, {}, group,
+                                      chunk=3))
+    assert not group  # 0 twice, 9 missing
+
+
+@gen_cluster()
+def test_update_graph_independent_group(s, a, b):
+    n = 100
+    keys = [('x', i) for i in range(n)]
+    s.update_graph(tasks={k: dumps_task((inc, i)) for i, k in enumerate(keys)},
+                   keys=keys, client='client',
+                   dependencies={k: set() for k in keys})
+    s.validate(allow_overlap=True)
+    assert s.stacks[a.address] and s.stacks[b.address]
+    assert [s.keyorder[k] for k in keys] == sorted(s.keyorder[k] for k in keys)
+    assert all(s.who_wants[k] == {'client'} for k in keys)
+    for stack in s.stacks.values():
+        assert stack == sorted(stack, key=s.keyorder.get, reverse=True)
+
+    while not all(s.who_has.get(k) for k in keys):
+        yield gen.sleep(0.01)
+    assert a.data.get(('x', 5), b.data.get(('x', 5))) == 6
+    assert not any(s.processing.values())
+    assert not s.assigned_duration
+
+    # tasks on the same data stay with it
+    s._steal_periodic_callback.stop()
+    dsk = skewed_graph(s, a, 20)
+    assert not s.stacks[b.address] and not s.processing[b.address]
+    assert s.dependents['d'] == set(dsk)
+    assert all(s.dependencies[k] == {'d'} for k in dsk)
+    assert all(s.keyorder[k] > s.keyorder[('x', 0)] for k in dsk)
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    assert a.data[('slowadd', 3)] == 4
+
+
+@slow
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 4, timeout=120)
+def test_update_graph_throughput(s, a, b, c, d):
+    """ Seconds that update_graph takes for many independent tasks
+
+    Run with ``py.test --runslow -s`` to see timings.
+    """
+    for n in [10000, 100000]:
+        dsk = {('x', n, i): (inc, i) for i in range(n)}
+        tasks = valmap(dumps_task, dsk)
+        dependencies = {k: set() for k in dsk}
+        start = time()
+        yield gen.maybe_future(s.update_graph(tasks=tasks, keys=list(dsk),
+                client='client', dependencies=dependencies))
+        end = time()
+        print("update_graph with %d tasks: %.2fs, stalled at most %.3fs" %
+              (n, end - start, s.metrics.ops['update-graph']['stall'].max))
+        s.client_releases_keys(keys=list(dsk), client='client')
+
+
+@slow
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 2, timeout=600)
+def test_update_graph_memory(s, a, b):
+    """ Bytes of scheduler state per task
+
+    Run with ``py.test --runslow -s`` to see sizes.
+    """
+    tracemalloc = pytest.importorskip('tracemalloc')
+    n = 1000000
+    dsk = {('x', i): (inc, i) for i in range(n)}
+    tasks = valmap(dumps_task, dsk)
+    dependencies = {k: set() for k in dsk}
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        yield s.update_graph(tasks=tasks, keys=list(dsk), client='client',
+                             dependencies=dependencies)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    print("Scheduler state per task: %d bytes" % ((after - before) / n))
+    assert after - before < 2000 * n
+    s.client_releases_keys(keys=list(dsk), client='client')
+
+
+@gen_cluster()
+def test_update_graph_in_chunks(s, a, b):
+    s.graph_chunk_size = 100
+    ticks = [0]
+
+    @gen.coroutine
+    def tick():
+        while True:
+            ticks[0] += 1
+            yield gen.moment
+
+    tick()
+    dsk = {}
+    for i in range(500):
+        dsk[('x', i)] = (inc, i)
+        dsk[('y', i)] = (inc, ('x', i))
+    dependencies = {k: set(v[1:]) if k[0] == 'y' else set()
+                    for k, v in dsk.items()}
+    future = s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                            client='client', dependencies=dependencies)
+    assert not future.done()
+    before = ticks[0]
+    yield future
+    assert ticks[0] > before  # the event loop kept running
+    s.validate(allow_overlap=True)
+    assert len(set(s.keyorder.values())) == len(dsk)
+    assert s.metrics.ops['update-graph']['stall'].count > 10
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+    keys = [('z', i) for i in range(1000)]
+    future = s.update_graph(tasks={k: dumps_task((inc, i))
+                                   for i, k in enumerate(keys)},
+                            keys=keys, client='client',
+                            dependencies={k: set() for k in keys})
+    while not any(ws.processing for ws in s.worker_states.values()):
+        assert not future.done()  # workers start on the first chunks
+        yield gen.moment
+    yield future
+    s.validate(allow_overlap=True)
+    assert [s.keyorder[k] for k in keys] == sorted(s.keyorder[k]
+                                                   for k in keys)
+    while not all(s.who_has.get(k) for k in keys):
+        yield gen.sleep(0.01)
+
+
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 3)
+def test_remove_worker_during_chunked_update_graph(s, a, b, c):
+    s.graph_chunk_size = 100
+    s.update_graph(tasks={'d': dumps_task((slowinc, 0, 0.5))}, keys=['d'],
+                   client='client', dependencies={'d': set()})
+    while not s.who_has.get('d'):
+        yield gen.sleep(0.01)
+    [lost] = s.task_states['d'].who_has
+
+    # a group of independent tasks that need d, which we lose
+    keys = [('x', i) for i in range(1000)]
+    future = s.update_graph(tasks={k: dumps_task((add, 'd', i))
+                                   for i, k in enumerate(keys)},
+                            keys=keys, client='client',
+                            dependencies={k: {'d'} for k in keys})
+    while ('x', 100) not in s.task_states:  # in the middle of the group
+        yield gen.moment
+    assert not future.done()
+    epoch = s.epoch
+    s.remove_worker(address=lost.address)
+    assert s.epoch == epoch + 1
+    while not future.done():
+        for ws in s.worker_states.values():  # nothing runs without d
+            for ts in chain(ws.stack, ws.processing):
+                assert all(dep.who_has for dep in ts.dependencies)
+        yield gen.moment
+    s.validate(allow_overlap=True)
+    while not all(s.who_has.get(k) for k in keys):
+        yield gen.sleep(0.01)
+
+    # a graph with dependencies
+    dsk = {}
+    for i in range(500):
+        dsk[('y', i)] = (inc, i)
+        dsk[('z', i)] = (inc, ('y', i))
+    dependencies = {k: set(v[1:]) if k[0] == 'z' else set()
+                    for k, v in dsk.items()}
+    future = s.update_graph(tasks=valmap(dumps_task, dsk), keys=list(dsk),
+                            client='client', dependencies=dependencies)
+    yield gen.moment
+    assert not future.done()
+    [worker, kept] = list(s.worker_states)
+    s.remove_worker(address=worker)
+    yield future
+    s.validate(allow_overlap=True)
+    assert set(s.keyorder) >= set(dsk)
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    assert s.who_has[('z', 499)] == {kept}
+
+
+def add_waiting_states(s, dependencies, wanted):
+    """ Put tasks into scheduler by hand, all of them waiting to run """
+    for key in dependencies:
+        s.task_states[key] = TaskState(key, dumps_task((inc, 1)))
+    for key, deps in dependencies.items():
+        ts = s.task_states[key]
+        ts.in_play = True
+        if not deps:
+            continue
+        ts.dependencies = {s.task_states[dep] for dep in deps}
+        ts.waiting_on = set(ts.dependencies)
+        for dep in ts.dependencies:
+            if not dep.dependents:
+                dep.dependents = set()
+            dep.dependents.add(ts)
+            if dep.waiters is None:
+                dep.waiters = set()
+            dep.waiters.add(ts)
+    s.client_wants_keys(keys=wanted, client='client')
+
+
+def fail_and_forget(s, root, wanted):
+    """ Fail the root task, then release wanted, return report messages """
+    q = Queue()
+    s.report_queues.append(q)
+    ts = s.task_states[root]
+    ts.exception = ZeroDivisionError()
+    s.mark_failed(ts, ts)
+    assert not s.in_play
+    assert all(ts.exception_blame is s.task_states[root]
+               for ts in s.task_states.values())
+    s.client_releases_keys(keys=wanted, client='client')
+    assert not s.task_states
+    return [q.get_nowait() for i in range(q.qsize())]
+
+
+def test_mark_failed_and_forget_deep_chain():
+    n = 10000  # deeper than the recursion limit
+    keys = [('x', i) for i in range(n)]
+    s = Scheduler()
+    add_waiting_states(s, {k: {keys[i - 1]} if i else set()
+                           for i, k in enumerate(keys)}, [keys[-1]])
+    [msg] = fail_and_forget(s, keys[0], [keys[-1]])
+    assert msg['op'] == 'task-erred'
+    assert sorted(msg['keys']) == keys
+
+
+def test_heal_missing_data_deep_chain():
+    n = 10000  # deeper than the recursion limit
+    keys = [('x', i) for i in range(n)]
+    dependencies = {k: {keys[i - 1]} if i else set()
+                    for i, k in enumerate(keys)}
+    s = Scheduler()
+    add_waiting_states(s, dependencies, [keys[-1]])
+    states = [s.task_states[k] for k in keys]
+    for ts in states:
+        ts.in_play = False
+        ts.waiting_on = ts.waiters = None
+
+    s.my_heal_missing_data([states[-1]])
+    assert s.in_play == set(keys)
+    assert s.waiting[keys[0]] == set()
+    assert s.waiting[keys[-1]] == {keys[-2]}
+    assert s.waiting_data[keys[0]] == {keys[1]}
+    assert s.waiting_data[keys[-1]] == set()
+
+    dependents = {k: {keys[i + 1]} if i < n - 1 else set()
+                  for i, k in enumerate(keys)}
+    waiting, waiting_data, in_play = {}, {}, set()
+    heal_missing_data(None, dependencies, dependents, {}, in_play, waiting,
+                      waiting_data, [keys[-1]])
+    assert in_play == set(keys)
+    assert waiting == {k: set(v) for k, v in dependencies.items()}
+    assert waiting_data == dependents
+
+
+def test_mark_failed_and_forget_wide_fan_out():
+    n = 1000
+    keys = [('x', i) for i in range(n)]
+    s = Scheduler()
+    add_waiting_states(s, merge({'root': set()}, {k: {'root'} for k in keys}),
+                       keys)
+    [msg] = fail_and_forget(s, 'root', keys)
+    assert sorted(msg['keys'], key=str) == sorted(['root'] + keys, key=str)
+
+
+@slow
+def test_mark_failed_and_forget_throughput():
+    """ Seconds to fail and forget long chains and wide fan-outs
+
+    Run with ``py.test --runslow -s`` to see timings.
+    """
+    n = 100000
+    keys = [('x', i) for i in range(n)]
+    s = Scheduler()
+    add_waiting_states(s, {k: {keys[i - 1]} if i else set()
+                           for i, k in enumerate(keys)}, [keys[-1]])
+    start = time()
+    fail_and_forget(s, keys[0], [keys[-1]])
+    print("fail and forget a chain of %d tasks: %.2fs" % (n, time() - start))
+
+    n = 1000000
+    keys = [('x', i) for i in range(n)]
+    s = Scheduler()
+    add_waiting_states(s, merge({'root': set()}, {k: {'root'} for k in keys}),
+                       keys)
+    start = time()
+    fail_and_forget(s, 'root', keys)
+    print("fail and forget a fan-out of %d tasks: %.2fs" % (n, time() - start))
+
+
+@gen_cluster()
+def test_task_states(s, a, b):
+    s.update_graph(tasks={'x': dumps_task((inc, 1)),
+                          'y': dumps_task((inc, 'x'))},
+                   keys=['y'], client='client',
+                   dependencies={'x': set(), 'y': {'x'}})
+    while not s.who_has.get('y'):
+        yield gen.sleep(0.01)
+
+    tx = s.task_states['x']
+    ty = s.task_states['y']
+    assert ty.dependencies == {tx} and tx.dependents == {ty}
+    assert s.dependencies['y'] == {'x'}
+    assert {ws.address for ws in ty.who_has} == s.who_has['y']
+    assert all(ty in s.worker_states[w].has_what for w in s.who_has['y'])
+    assert s.who_has['z'] == set() and 'z' not in s.who_has
+
+    with pytest.raises(TypeError):
+        s.who_has['z'] = {a.address}  # views are read-only
+
+    s.client_releases_keys(keys=['y'], client='client')
+    assert not s.task_states
@@ -0,0 +1,179 @@
+import os
+import socket
+from threading import Thread
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+import pytest
+
+from distributed import Executor
+from distributed.core import Server, connect, read, write, rpc, ConnectionPool
+from distributed.transport import (InProcStream, is_local, unix_path,
+        unix_dir, choose_transport, inproc_servers)
+from distributed.utils_test import gen_cluster, inc, loop
+
+
+def echo(stream, x=None):
+    return x
+
+
+def test_is_local():
+    assert is_local('127.0.0.1')
+    assert is_local('127.0.0.2')
+    assert is_local(socket.gethostname())
+    assert not is_local('192.0.2.1')
+
+
+def test_unix_socket_for_local_peers(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo})
+        server.listen(0)
+        path = unix_path(server.port)
+        assert os.path.exists(path)
+        assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+        assert choose_transport('127.0.0.1', server.port) == 'unix'
+        assert choose_transport('192.0.2.1', server.port) == 'tcp'
+
+        stream = yield connect('127.0.0.1', server.port)
+        assert stream.socket.family == socket.AF_UNIX
+        assert stream.protocol == 'frames'
+        assert stream.compression is None
+
+        data = b'0' * 1000000  # compressible but we don't compress locally
+        yield write(stream, {'op': 'echo', 'x': data})
+        response = yield read(stream)
+        assert response == data
+
+        stream = yield connect('127.0.0.1', server.port, transports=('tcp',))
+        assert stream.socket.family == socket.AF_INET
+
+        server.stop()
+        assert not os.path.exists(path)
+
+    loop.run_sync(f)
+
+
+def test_stale_unix_socket_falls_back_to_tcp(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo}, transports=('tcp',))
+        server.listen(0)
+        path = unix_path(server.port)
+        if os.path.exists(path):  # left over from an earlier run
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)  # nobody listens on this
+        sock.close()
+        try:
+            stream = yield connect('127.0.0.1', server.port)
+            assert stream.socket.family == socket.AF_INET
+            yield write(stream, {'op': 'echo', 'x': 1})
+            response = yield read(stream)
+            assert response == 1
+        finally:
+            os.remove(path)
+        server.stop()
+
+    loop.run_sync(f)
+
+
+def test_unix_dir_must_be_private(tmpdir, monkeypatch):
+    monkeypatch.setattr('tempfile.tempdir', str(tmpdir))
+    path = unix_dir()
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert unix_dir() == path
+
+    os.chmod(path, 0o777)  # as if another user had made it for us
+    assert unix_dir() is None
+    assert unix_path(8786) is None
+    assert choose_transport('127.0.0.1', 8786) == 'tcp'
+
+
+def test_inproc_passes_references(loop):
+    @gen.coroutine
+    def f():
+        server = Server({'echo': echo}, transports=('inproc', 'tcp'))
+        server.listen(0)
+        assert inproc_servers[server.port] is server
+        assert not os.path.exists(unix_path(server.port))
+
+        stream = yield connect('127.0.0.1', server.port)
+        assert isinstance(stream, InProcStream)
+        obj = object()  # can't be serialized
+        msg = {'op': 'echo', 'x': obj}
+        yield write(stream, msg)
+        response = yield read(stream)
+        assert response is obj
+        assert msg == {'op': 'echo', 'x': obj}  # server didn't pop from it
+
+        pool = ConnectionPool()
+        remote = rpc(ip='127.0.0.1', port=server.port, pool=pool,
+                     multiplex=True)
+        results = yield [remote.echo(x=i) for i in range(10)]
+        assert results == list(range(10))
+        pool.close()
+
+        stream.close()
+        assert stream.peer.closed()
+        with pytest.raises(StreamClosedError):
+            yield write(stream, {'op': 'echo', 'x': 1})
+        server.stop()
+        assert server.port not in inproc_servers
+
+    loop.run_sync(f)
+
+
+def test_inproc_stream_across_loops(loop):
+    other = IOLoop()
+    thread = Thread(target=other.start)
+    thread.daemon = True
+    thread.start()
+
+    a, b = InProcStream.pipe(loop, other)
+
+    @gen.coroutine
+    def pong():
+        while True:
+            try:
+                msg = yield read(b)
+            except StreamClosedError:
+                break
+            yield write(b, msg + 1)
+
+    other.add_callback(pong)
+
+    @gen.coroutine
+    def f():
+        for i in range(10):
+            yield write(a, i)
+            result = yield read(a)
+            assert result == i + 1
+        a.close()
+        while not b.closed():
+            yield gen.sleep(0.01)
+
+    loop.run_sync(f)
+    other.add_callback(other.stop)
+    thread.join()
+    other.close()
+
+
+@gen_cluster(transports=('inproc', 'tcp'))
+def test_gen_cluster_inproc(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+    assert isinstance(e.scheduler_stream, InProcStream)
+    assert all(isinstance(bs.stream, InProcStream)
+               for bs in s.worker_streams.values())
+
+    data = [1, 2, 3]
+    [future] = yield e._scatter([data])
+    assert a.data.get(future.key) is data or b.data.get(future.key) is data
+
+    futures = e.map(inc, range(100))
+    results = yield e._gather(futures)
+    assert results == list(range(1, 101))
+
+    yield e._shutdown()
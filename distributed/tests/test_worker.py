@@ -8,12 +8,14 @@ import pytest
 from toolz import pluck
 from tornado import gen
 from tornado.ioloop import TimeoutError
+from tornado.iostream import StreamClosedError
 
 from distributed.center import Center
-from distributed.core import rpc, dumps, loads
+from distributed.core import rpc, dumps, loads, connect, read, write
 from distributed.sizeof import sizeof
 from distributed.worker import Worker
-from distributed.utils_test import loop, _test_cluster, inc, gen_cluster
+from distributed.utils_test import (loop, _test_cluster, inc, div,
+        gen_cluster)
 
 
 
@@ -53,6 +55,7 @@ def test_worker(loop):
         assert b.data['y'] == 13
         assert c.who_has['y'] == set([(b.ip, b.port)])
         assert info['nbytes'] == sizeof(b.data['y'])
+        assert 0 <= info['compute_stop'] - info['compute_start'] < 1
 
         def bad_func():
             1 / 0
@@ -262,6 +265,18 @@ def test_worker_waits_for_center_to_come_up(loop):
         pass
 
 
+@gen_cluster()
+def test_worker_registers_resources(s, a, b):
+    w = Worker(s.ip, s.port, ncores=1, ip='127.0.0.1', memory_limit=1000,
+               resources={'GPU': 2})
+    yield w._start(0)
+    ws = s.worker_states[w.address]
+    assert ws.resources == {'GPU': 2}
+    assert ws.memory_limit == 1000
+    assert s.worker_states[a.address].resources == {}
+    yield w._close()
+
+
 @gen_cluster()
 def test_worker_task(s, a, b):
     aa = rpc(ip=a.ip, port=a.port)
@@ -287,3 +302,56 @@ def test_worker_task_bytes(s, a, b):
 
     yield aa.compute(function=dumps(inc), args=dumps((10,)), key='y', serialized=True)
     assert a.data['y'] == 11
+
+
+@gen_cluster()
+def test_update_and_get_numpy_data(s, a, b):
+    np = pytest.importorskip('numpy')
+    x = np.arange(1000000).reshape((1000, 1000))
+    aa = rpc(ip=a.ip, port=a.port)
+
+    response, info = yield aa.update_data(data={'x': x, 'y': x.T},
+                                          report=False)
+    assert response == b'OK'
+    assert info['nbytes']['x'] == x.nbytes
+    assert (a.data['x'] == x).all()
+
+    result = yield aa.get_data(keys=['x', 'y'])
+    assert (result['x'] == x).all()
+    assert (result['y'] == x.T).all()
+    assert result['y'].flags.f_contiguous
+
+
+@gen_cluster()
+def test_compute_stream(s, a, b):
+    stream = yield connect(a.ip, a.port)
+    yield write(stream, {'op': 'compute-stream', 'reply': False})
+
+    yield write(stream, [{'op': 'compute-task', 'key': 'x',
+                          'task': (inc, 1), 'report': False},
+                         {'op': 'compute-task', 'key': 'y',
+                          'function': dumps(div), 'args': dumps((1, 0)),
+                          'serialized': True, 'report': False},
+                         {'op': 'compute-task', 'key': 'z',
+                          'task': (inc, 'w'), 'who_has': {'w': {b.address}},
+                          'report': False}])
+    reports = []
+    while len(reports) < 3:
+        msgs = yield read(stream)
+        reports.extend(msgs)
+    reports = {msg['key']: msg for msg in reports}
+
+    assert reports['x']['op'] == 'task-finished'
+    assert reports['x']['nbytes'] == sizeof(2)
+    assert loads(reports['x']['type']) == int
+    assert a.data['x'] == 2
+
+    assert reports['y']['op'] == 'task-erred'
+    assert isinstance(reports['y']['exception'], ZeroDivisionError)
+
+    assert reports['z']['op'] == 'missing-data'
+    assert reports['z']['missing'] == ('w',)
+
+    yield write(stream, [{'op': 'close'}])
+    with pytest.raises(StreamClosedError):
+        yield read(stream)
@@ -0,0 +1,274 @@
+""" Transports that carry streams between servers on the same host
+
+Every server listens on TCP and we address it by ``ip:port`` wherever it
+runs.  When client and server share a host we can do better:
+
+*  ``'unix'``: The server also listens on a Unix domain socket whose path we
+   derive from its TCP port, see ``unix_path``.  Local clients connect to
+   this socket instead.  This skips the TCP stack and we don't compress.
+   Sockets live in a directory that only their user may enter, so other
+   users on the host stay on TCP.
+*  ``'inproc'``: The server registers itself in this process.  Clients in the
+   same process get an ``InProcStream`` that passes messages to the server by
+   reference, without serialization.  Senders must not change messages that
+   they have sent.  Receivers get their own copy of each message dict so that
+   they may pop keys from it.
+
+``core.connect`` picks the first of these that the server offers and falls
+back to TCP otherwise.  Servers choose their transports with the
+``transports=`` keyword, see ``core.Server``.
+"""
+from __future__ import print_function, division, absolute_import
+
+from datetime import timedelta
+import errno
+import logging
+import os
+import socket
+import stat
+import tempfile
+import weakref
+
+from toolz import memoize
+from tornado import gen
+from tornado.gen import Return
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.queues import Queue
+
+from .utils import get_ip, ignoring
+
+
+logger = logging.getLogger(__name__)
+
+
+# Transports in order of preference, TCP always works
+TRANSPORTS = ('inproc', 'unix', 'tcp')
+
+# Transports on which servers listen unless told otherwise
+DEFAULT_TRANSPORTS = ('unix', 'tcp')
+
+# Servers in this process that accept in-process streams, by TCP port
+inproc_servers = weakref.WeakValueDictionary()
+
+
+@memoize
+def local_ips():
+    """ Names and addresses under which other processes on this host see us
+    """
+    ips = {'localhost', '0.0.0.0', socket.gethostname()}
+    with ignoring(Exception):
+        ips.add(get_ip())
+    with ignoring(Exception):
+        ips.add(socket.gethostbyname(socket.gethostname()))
+    return ips
+
+
+def is_local(ip):
+    """ Is ip an address of this host?
+
+    >>> is_local('127.0.0.1')
+    True
+    """
+    return ip.startswith('127.') or ip in local_ips()
+
+
+def unix_dir():
+    """ Directory of our Unix domain sockets, private to the current user
+
+    Returns None if we can't create it or if it isn't ours alone, for example
+    because another user created it first.
+    """
+    if not hasattr(os, 'getuid'):
+        return None
+    uid = os.getuid()
+    path = os.path.join(tempfile.gettempdir(), 'distributed-%d' % uid)
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.info("Could not create %s: %s", path, e)
+            return None
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or
+            st.st_mode & 0o077):
+        logger.info("Not using %s for sockets, it isn't private", path)
+        return None
+    return path
+
+
+def unix_path(port):
+    """ Path of the Unix domain socket of the server with the given TCP port
+
+    TCP ports are unique on a host so their sockets are too.  Returns None if
+    we have no private directory for sockets, see ``unix_dir``.
+    """
+    directory = unix_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, '%d.sock' % port)
+
+
+def choose_transport(ip, port, transports=TRANSPORTS):
+    """ Best transport to reach the server at ip:port
+
+    >>> choose_transport('192.0.2.1', 8786)
+    'tcp'
+    """
+    if is_local(ip):
+        if 'inproc' in transports and port in inproc_servers:
+            return 'inproc'
+        if 'unix' in transports:
+            path = unix_path(port)
+            if path is not None and os.path.exists(path):
+                return 'unix'
+    return 'tcp'
+
+
+def listen_unix(server, port):
+    """ Accept connections to ``server`` on its Unix domain socket
+
+    Returns the path of the socket or None if we couldn't bind it, for
+    example because another user owns a stale socket file.
+    """
+    path = unix_path(port)
+    if path is None:
+        return None
+    try:
+        sock = bind_unix_socket(path)
+    except (OSError, socket.error, ValueError) as e:
+        logger.info("Could not listen on %s: %s", path, e)
+        return None
+    server.add_socket(sock)
+    return path
+
+
+@gen.coroutine
+def connect_unix(port, timeout=3, max_buffer_size=None):
+    """ Open a stream to the Unix domain socket of the server on port
+
+    Raises ``StreamClosedError`` if nobody listens on the socket, perhaps
+    because its server died without removing it.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stream = IOStream(sock, max_buffer_size=max_buffer_size)
+    try:
+        yield gen.with_timeout(timedelta(seconds=timeout),
+                               stream.connect(unix_path(port)))
+    except gen.TimeoutError:
+        stream.close()
+        raise StreamClosedError()
+    raise Return(stream)
+
+
+def connect_inproc(port):
+    """ Open an in-process stream to the server on port """
+    server = inproc_servers[port]
+    client_end, server_end = InProcStream.pipe(IOLoop.current(),
+                                               server.io_loop)
+    server.io_loop.add_callback(server.handle_stream, server_end, 'inproc')
+    return client_end
+
+
+_EOF = object()
+
+
+def _copy_message(msg):
+    """ Shallow copy of the dicts of a message, or of a batch of them
+
+    Receivers pop keys like ``'op'`` from messages, the sender may still hold
+    on to them.
+
+    >>> msg = {'op': 'ping'}
+    >>> _copy_message(msg) is msg
+    False
+    """
+    if type(msg) is dict:
+        return msg.copy()
+    if type(msg) is list:
+        return [m.copy() if type(m) is dict else m for m in msg]
+    return msg
+
+
+class InProcStream(object):
+    """ One end of a connection between two coroutines in the same process
+
+    This quacks enough like an ``IOStream`` for ``core.read`` and
+    ``core.write``, which hand whole messages to the other end.  The two ends
+    may live on different IOLoops.
+
+    >>> a, b = InProcStream.pipe()  # doctest: +SKIP
+    >>> yield write(a, {'op': 'ping'})  # doctest: +SKIP
+    >>> yield read(b)  # doctest: +SKIP
+    {'op': 'ping'}
+    """
+    protocol = 'inproc'
+    compression = None
+    peer_compression = ()
+    peer_multiplex = True
+
+    def __init__(self, loop=None):
+        self.loop = loop or IOLoop.current()
+        self.queue = Queue()
+        self.peer = None
+        self._closed = False
+        self._close_callback = None
+
+    @classmethod
+    def pipe(cls, loop=None, peer_loop=None):
+        """ Two connected ends, the first one on loop, the second on peer_loop
+        """
+        a = cls(loop)
+        b = cls(peer_loop or loop)
+        a.peer, b.peer = b, a
+        return a, b
+
+    def __str__(self):
+        return '<InProcStream: %d waiting>' % self.queue.qsize()
+
+    __repr__ = __str__
+
+    def _call_soon(self, func, *args):
+        if IOLoop.current() is self.loop:
+            func(*args)
+        else:
+            self.loop.add_callback(func, *args)
+
+    def send(self, msg):
+        """ Give a message to the other end """
+        if self._closed:
+            raise StreamClosedError()
+        self.peer._call_soon(self.peer.queue.put_nowait, msg)
+
+    @gen.coroutine
+    def recv(self):
+        """ Wait for the next message from the other end """
+        msg = yield self.queue.get()
+        if msg is _EOF:
+            self.queue.put_nowait(_EOF)  # later reads fail too
+            raise StreamClosedError()
+        raise Return(_copy_message(msg))
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._on_close()
+            self.peer._call_soon(self.peer._on_close)
+
+    def _on_close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put_nowait(_EOF)
+        if self._close_callback is not None:
+            callback, self._close_callback = self._close_callback, None
+            callback()
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def set_nodelay(self, value):
+        pass
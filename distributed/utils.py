@@ -2,6 +2,7 @@ from __future__ import print_function, division, absolute_import
 
 from collections import Iterable
 from contextlib import contextmanager
+import gc
 import logging
 import os
 import re
@@ -45,6 +46,22 @@ def ignoring(*exceptions):
         pass
 
 
+@contextmanager
+def gc_paused():
+    """ Turn off the cyclic garbage collector for a block
+
+    Creating millions of containers triggers collections that walk all live
+    objects again and again.  Use this around bulk updates of large state.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 @gen.coroutine
 def ignore_exceptions(coroutines, *exceptions):
     """ Process list of coroutines, ignoring certain exceptions
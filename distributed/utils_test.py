@@ -15,6 +15,7 @@ from tornado.ioloop import IOLoop, TimeoutError
 from tornado.iostream import StreamClosedError
 
 from .core import connect, read, write, rpc
+from .transport import DEFAULT_TRANSPORTS
 from .utils import ignoring, log_errors
 import pytest
 
@@ -163,13 +164,19 @@ def scheduler(cport, **kwargs):
 
 
 @contextmanager
-def cluster(nworkers=2, nanny=False):
+def cluster(nworkers=2, nanny=False, transports=DEFAULT_TRANSPORTS):
+    """ A scheduler and workers in their own processes
+
+    These talk over Unix domain sockets by default, pass
+    ``transports=('tcp',)`` to use TCP instead.
+    """
     if nanny:
         _run_worker = run_nanny
     else:
         _run_worker = run_worker
     scheduler_q = Queue()
-    scheduler = Process(target=run_scheduler, args=(scheduler_q,))
+    scheduler = Process(target=run_scheduler, args=(scheduler_q,),
+                        kwargs={'transports': transports})
     scheduler.daemon = True
     scheduler.start()
     sport = scheduler_q.get()
@@ -179,7 +186,8 @@ def cluster(nworkers=2, nanny=False):
         q = Queue()
         fn = '_test_worker-%s' % uuid.uuid1()
         proc = Process(target=_run_worker, args=(q, sport),
-                        kwargs={'ncores': 1, 'local_dir': fn})
+                        kwargs={'ncores': 1, 'local_dir': fn,
+                                'transports': transports})
         workers.append({'proc': proc, 'queue': q, 'dir': fn})
 
     for worker in workers:
@@ -380,10 +388,11 @@ from .worker import Worker
 from .executor import Executor
 
 @gen.coroutine
-def start_cluster(ncores, Worker=Worker):
-    s = Scheduler(ip='127.0.0.1')
+def start_cluster(ncores, Worker=Worker, transports=DEFAULT_TRANSPORTS):
+    s = Scheduler(ip='127.0.0.1', transports=transports)
     done = s.start(0)
-    workers = [Worker(s.ip, s.port, ncores=v, ip=k) for k, v in ncores]
+    workers = [Worker(s.ip, s.port, ncores=v, ip=k, transports=transports)
+               for k, v in ncores]
 
     yield [w._start() for w in workers]
 
@@ -406,13 +415,16 @@ def end_cluster(s, workers):
 
 
 def gen_cluster(ncores=[('127.0.0.1', 1), ('127.0.0.1', 2)], timeout=10,
-        Worker=Worker):
+        Worker=Worker, transports=DEFAULT_TRANSPORTS):
     """ Coroutine test with small cluster
 
     @gen_cluster()
     def test_foo(scheduler, worker1, worker2):
         yield ...  # use tornado coroutines
 
+    Pass ``transports=('inproc', 'tcp')`` to skip serialization between the
+    scheduler and workers, see ``distributed.transport``.
+
     See also:
         start
         end
@@ -426,7 +438,7 @@ def gen_cluster(ncores=[('127.0.0.1', 1), ('127.0.0.1', 2)], timeout=10,
             loop.make_current()
 
             s, workers = loop.run_sync(lambda: start_cluster(ncores,
-                                                             Worker=Worker))
+                                    Worker=Worker, transports=transports))
             try:
                 loop.run_sync(lambda: cor(s, *workers), timeout=timeout)
             finally:
@@ -2,6 +2,7 @@ from __future__ import print_function, division, absolute_import
 
 from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import partial
 from importlib import import_module
 import logging
 from multiprocessing.pool import ThreadPool
@@ -10,17 +11,19 @@ import pkg_resources
 import tempfile
 import shutil
 import sys
+from time import time
 
 from dask.core import istask
 from toolz import merge
 from tornado.gen import Return
 from tornado import gen
-from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 
+from .batched import BatchedSend
 from .client import _gather, pack_data, gather_from_workers
 from .compatibility import reload
-from .core import rpc, Server, pingpong, dumps, loads
+from .core import rpc, Server, pingpong, dumps, loads, read
 from .sizeof import sizeof
 from .utils import (funcname, get_ip, get_traceback, truncate_exception,
     ignoring)
@@ -64,6 +67,16 @@ class Worker(Server):
     * **services:** ``{str: Server}``:
         Auxiliary web servers running on this worker
     * **service_ports:** ``{str: port}``:
+    * **compression:** ``str``:
+        Compression for large frames sent to peers, one of ``'auto'``,
+        ``'lz4'``, ``'blosc'``, ``'zlib'`` or None.  See ``Server``
+    * **batch_interval:** ``float``:
+        Milliseconds over which we batch task reports to the scheduler
+    * **memory_limit:** ``int``:
+        Bytes of data that the scheduler should let us hold, None for no limit
+    * **resources:** ``{str: float}``:
+        Amounts of abstract resources like ``{'GPU': 2}`` that we offer to
+        tasks that ask for them
 
     Examples
     --------
@@ -91,7 +104,8 @@ class Worker(Server):
 
     def __init__(self, center_ip, center_port, ip=None, ncores=None,
                  loop=None, local_dir=None, services=None, service_ports=None,
-                 **kwargs):
+                 compression='auto', batch_interval=2, memory_limit=None,
+                 resources=None, **kwargs):
         self.ip = ip or get_ip()
         self._port = 0
         self.ncores = ncores or _ncores
@@ -100,8 +114,12 @@ class Worker(Server):
         self.status = None
         self.local_dir = local_dir or tempfile.mkdtemp(prefix='worker-')
         self.executor = ThreadPoolExecutor(self.ncores)
-        self.center = rpc(ip=center_ip, port=center_port)
+        self.center = rpc(ip=center_ip, port=center_port,
+                          compression=compression, multiplex=True)
         self.active = set()
+        self.batch_interval = batch_interval
+        self.memory_limit = memory_limit
+        self.resources = resources or {}
         if services is not None:
             self.services = {k: v(self) for k, v in services.items()}
         else:
@@ -115,14 +133,17 @@ class Worker(Server):
             sys.path.insert(0, self.local_dir)
 
         handlers = {'compute': self.compute,
+                    'compute-stream': self.compute_stream,
                     'get_data': self.get_data,
                     'update_data': self.update_data,
                     'delete_data': self.delete_data,
+                    'gather': self.gather,
                     'terminate': self.terminate,
                     'ping': pingpong,
                     'upload_file': self.upload_file}
 
-        super(Worker, self).__init__(handlers, **kwargs)
+        super(Worker, self).__init__(handlers, compression=compression,
+                                     **kwargs)
 
     @gen.coroutine
     def _start(self, port=0):
@@ -138,9 +159,15 @@ class Worker(Server):
                     self.center.ip, self.center.port)
         while True:
             try:
+                kwargs = {}
+                if self.memory_limit is not None:
+                    kwargs['memory_limit'] = self.memory_limit
+                if self.resources:
+                    kwargs['resources'] = self.resources
                 resp = yield self.center.register(
                         ncores=self.ncores, address=(self.ip, self.port),
-                        keys=list(self.data), services=self.service_ports)
+                        keys=list(self.data), services=self.service_ports,
+                        **kwargs)
                 break
             except (OSError, StreamClosedError):
                 logger.debug("Unable to register with center.  Waiting")
@@ -205,7 +232,9 @@ class Worker(Server):
                 if who_has:
                     logger.info("gather %d keys from peers: %s",
                                 len(who_has), str(who_has))
-                    other = yield gather_from_workers(who_has)
+                    other = yield gather_from_workers(who_has,
+                            rpc=partial(rpc, compression=self.compression,
+                                        multiplex=True))
                 elif needed:
                     logger.info("gather %d keys from peers: %s",
                                 len(needed), str(needed))
@@ -252,27 +281,10 @@ class Worker(Server):
         try:
             job_counter[0] += 1
             i = job_counter[0]
-            logger.info("Start job %d: %s - %s", i, funcname(function), key)
-            future = self.executor.submit(function, *args2, **kwargs)
-            pc = PeriodicCallback(lambda: logger.debug("future state: %s - %s",
-                key, future._state), 1000)
-            pc.start()
-            try:
-                if sys.version_info < (3, 2):
-                    yield future
-                else:
-                    while not future.done() and future._state != 'FINISHED':
-                        try:
-                            yield gen.with_timeout(timedelta(seconds=1), future)
-                            break
-                        except gen.TimeoutError:
-                            logger.info("work queue size: %d", self.executor._work_queue.qsize())
-                            logger.info("future state: %s", future._state)
-                            logger.info("Pending job %d: %s", i, future)
-            finally:
-                pc.stop()
-            result = future.result()
-            logger.info("Finish job %d: %s - %s", i, funcname(function), key)
+            logger.debug("Start job %d: %s - %s", i, funcname(function), key)
+            result, start, stop = yield self.executor.submit(
+                    apply_function, function, args2, kwargs)
+            logger.debug("Finish job %d: %s - %s", i, funcname(function), key)
             self.data[key] = result
             if report:
                 response = yield self.center.add_keys(address=(self.ip, self.port),
@@ -280,7 +292,9 @@ class Worker(Server):
                 if not response == b'OK':
                     logger.warn('Could not report results to center: %s',
                                 response.decode())
-            out = (b'OK', {'nbytes': sizeof(result)})
+            out = (b'OK', {'nbytes': sizeof(result),
+                           'compute_start': start,
+                           'compute_stop': stop})
             if result is not None:
                 out[1]['type'] = type(result)
         except Exception as e:
@@ -306,6 +320,70 @@ class Worker(Server):
             self.active.remove(key)
         raise Return(out)
 
+    @gen.coroutine
+    def compute_stream(self, stream):
+        """ Compute many tasks sent over one long-lived stream
+
+        The scheduler sends batches of ``compute-task`` messages over this
+        stream.  We run all of them concurrently and send back batched
+        ``task-finished``, ``task-erred`` and ``missing-data`` reports over the
+        same stream.  The scheduler ends the conversation with a ``close``
+        message.
+
+        See Also
+        --------
+        Worker.compute
+        distributed.scheduler.Scheduler.worker
+        distributed.batched.BatchedSend
+        """
+        bstream = BatchedSend(interval=self.batch_interval, loop=self.loop)
+        bstream.start(stream)
+        closed = False
+        try:
+            while not closed:
+                try:
+                    msgs = yield read(stream)
+                except StreamClosedError:
+                    break
+                if not isinstance(msgs, list):
+                    msgs = [msgs]
+                for msg in msgs:
+                    op = msg.pop('op', None)
+                    if op == 'close':
+                        closed = True
+                        break
+                    elif op == 'compute-task':
+                        future = self.compute(None, **msg)
+                        self.loop.add_future(future, partial(
+                            self._report_compute, bstream, msg.get('key')))
+                    else:
+                        logger.warn("Unknown operation %s, %s", op, msg)
+        finally:
+            closing = bstream.close()  # don't yield here, we may be exiting
+        yield closing
+
+    def _report_compute(self, bstream, key, future):
+        """ Report the outcome of ``compute`` onto a batched stream """
+        try:
+            response, content = future.result()
+            if response == b'OK':
+                msg = {'op': 'task-finished', 'key': key,
+                       'nbytes': content['nbytes'],
+                       'compute_start': content['compute_start'],
+                       'compute_stop': content['compute_stop']}
+                if 'type' in content:
+                    msg['type'] = dumps_type(content['type'])
+            elif response == b'error':
+                msg = {'op': 'task-erred', 'key': key,
+                       'exception': content['exception'],
+                       'traceback': content['traceback']}
+            else:
+                msg = {'op': 'missing-data', 'key': key,
+                       'missing': content.args}
+            bstream.send(msg)
+        except Exception as e:
+            logger.exception(e)
+
     @gen.coroutine
     def update_data(self, stream, data=None, report=True):
         self.data.update(data)
@@ -328,6 +406,24 @@ class Worker(Server):
                                           keys=keys)
         raise Return(b'OK')
 
+    @gen.coroutine
+    def gather(self, stream=None, who_has=None):
+        """ Copy data from peers into local memory
+
+        Unlike ``update_data`` we don't tell the center, which asked for the
+        copies and keeps track of them itself.
+        """
+        who_has = {k: v for k, v in who_has.items() if k not in self.data}
+        try:
+            data = yield gather_from_workers(who_has,
+                    rpc=partial(rpc, compression=self.compression,
+                                multiplex=True))
+        except KeyError as e:
+            logger.warn("Could not find data to gather from peers: %s", e)
+            raise Return(b'missing-data')
+        self.data.update(data)
+        raise Return(b'OK')
+
     def get_data(self, stream, keys=None):
         return {k: self.data[k] for k in keys if k in self.data}
 
@@ -361,6 +457,43 @@ class Worker(Server):
 job_counter = [0]
 
 
+_type_cache = dict()
+
+
+def dumps_type(typ):
+    """ Serialize the type of a result, memoized
+
+    Sending types as bytestrings keeps our reports to the scheduler cheap to
+    serialize.  The scheduler forwards them to clients untouched.
+    """
+    try:
+        return _type_cache[typ]
+    except KeyError:
+        pass
+    except TypeError:  # unhashable
+        return dumps(typ)
+    result = dumps(typ)
+    if len(_type_cache) < 1000:
+        _type_cache[typ] = result
+    return result
+
+
+def apply_function(function, args, kwargs):
+    """ Call function, also return when it started and stopped
+
+    We run this in the thread pool so that the times don't include waiting
+    for a free thread.
+
+    >>> result, start, stop = apply_function(max, (1, 2), {})
+    >>> result
+    2
+    """
+    start = time()
+    result = function(*args, **kwargs)
+    stop = time()
+    return result, start, stop
+
+
 def execute_task(task):
     """ Evaluate a nested task
 